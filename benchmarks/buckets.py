@@ -0,0 +1,110 @@
+#!usr/bin/python
+
+"""Compare word removal from plain lists against the current buckets"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import options
+import textrearranger
+
+parser = argparse.ArgumentParser(description=
+    "Times replacing words from one very large bucket, as built without "
+    "-n and -l, for the modes that remove words from their buckets.")
+parser.add_argument("-s", "--size", type=int, default=200000,
+                    help="number of word occurences in the bucket")
+parser.add_argument("-v", "--vocabulary", type=int, default=5000,
+                    help="number of unique words in the bucket")
+parser.add_argument("-n", "--replacements", type=int, default=20000,
+                    help="number of words to replace")
+parser.add_argument("-R", "--random-seed", type=int, default=0,
+                    help="seeds random with given number")
+
+MODES = [["-M"], ["-u", "-g"], ["-r", "-U"]]
+
+
+def make_command(args):
+    """Return a cmd dict for the given arguments, without opening files"""
+    cmd = vars(options.parser.parse_args(args))
+    options.validate_command(cmd)
+    return cmd
+
+
+def list_replacement(cmd, wordList, word):
+    """The original replacement search, retrying draws on a plain list"""
+    if len(wordList) == 1:
+        return wordList[0]
+    if cmd["map_words"] or cmd["get_different"]:
+        newWord = word
+        attempts = 0
+        while newWord == word and attempts < cmd["get_attempts"]:
+            newWord = textrearranger.get_random_word(wordList)
+            attempts += 1
+        if cmd["limited_usage"] or cmd["map_words"]:
+            wordList.remove(newWord)
+    else:
+        newWord = textrearranger.get_random_word(wordList)
+    if cmd["force_limited_usage"] and word in wordList:
+        wordList.remove(word)
+    return newWord
+
+
+def time_list(cmd, wordList, words):
+    """Return the seconds taken to replace every word from a plain list"""
+    start = time.time()
+    for word in words:
+        if wordList:
+            list_replacement(cmd, wordList, word)
+    return time.time() - start
+
+
+def time_buckets(cmd, dictionary, words):
+    """Return the seconds taken to replace every word in turn"""
+    find_replacement = textrearranger.compile_find_replacement(
+        cmd, dictionary, {})
+    start = time.time()
+    for word in words:
+        find_replacement(word)
+    return time.time() - start
+
+
+def main():
+    """Run the benchmark"""
+    args = parser.parse_args()
+    vocabulary = ["w%d" % i for i in range(args.vocabulary)]
+
+    for mode in MODES:
+        random.seed(args.random_seed)
+        occurences = [random.choice(vocabulary) for _ in range(args.size)]
+        # -M takes a word out per unique word, the others per occurence
+        count = min(args.replacements, len(set(occurences)) if "-M" in mode
+                    else args.size)
+        words = [random.choice(occurences) for _ in range(count)]
+
+        cmd = make_command(mode)
+        bucket = textrearranger.new_bucket(cmd)
+        for word in occurences:
+            bucket.append(word)
+        dictionary = textrearranger.prepare_dictionary(
+            cmd, {("", "", 0): bucket})
+        # prepared before timing, like every other bucket setup
+        dictionary.get(("", "", 0))
+        plain = list(set(occurences)) if "-M" in mode else list(occurences)
+
+        random.seed(args.random_seed)
+        listTime = time_list(cmd, plain, words)
+        random.seed(args.random_seed)
+        bucketTime = time_buckets(cmd, dictionary, words)
+        print("%-8s %6d words  list %8.3fs  bucket %8.3fs  %6.1fx" % (
+            " ".join(mode), count, listTime, bucketTime,
+            listTime / max(bucketTime, 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
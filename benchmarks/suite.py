@@ -0,0 +1,256 @@
+#!usr/bin/python
+
+"""Time every stage of the main modes on generated corpora"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import bisect
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import options
+import textrearranger
+
+parser = argparse.ArgumentParser(description=
+    "Generates a seeded corpus, then times each stage of every mode on it "
+    "in a fresh process, with tokens/sec and peak memory. Results can be "
+    "saved as a baseline, and later runs compared against it.")
+parser.add_argument("-w", "--words", type=int, default=200000,
+                    help="number of words in the corpus, defaults to 200000")
+parser.add_argument("-v", "--vocabulary", type=int, default=20000,
+                    help="number of unique words, defaults to 20000")
+parser.add_argument("-z", "--zipf", type=float, default=1.1,
+                    help="skew of word frequencies, where 0 weighs every "
+                        "word equally, defaults to 1.1")
+parser.add_argument("-p", "--punctuation", type=float, default=0.1,
+                    help="chance a word has punctuation, defaults to 0.1")
+parser.add_argument("-m", "--mode", type=str, action="append", default=None,
+                    help="define a mode to time, such as --mode=\"-I -q\", "
+                        "and can be used many times, defaults to every mode")
+parser.add_argument("-r", "--repeat", type=int, default=3,
+                    help="number of timed runs to take the best of, "
+                        "defaults to 3")
+parser.add_argument("-R", "--random-seed", type=int, default=0,
+                    help="seeds the corpus and every run with given number")
+parser.add_argument("--save", type=str, default=None,
+                    help="define a file to save results to as a baseline")
+parser.add_argument("--baseline", type=str, default=None,
+                    help="define a saved baseline to compare results to")
+parser.add_argument("--threshold", type=float, default=10.0,
+                    help="percent slower than the baseline a stage can be "
+                        "before it counts as a regression, defaults to 10")
+parser.add_argument("--child", type=json.loads, default=None,
+                    help=argparse.SUPPRESS)
+
+MODES = ["-d", "-r", "-e", "-M", "-a", "-g", "-I -q -Q", "-P -S", "-K -D"]
+STAGES = ["filter", "fill", "sort", "generate"]
+PUNCTUATION = [("", "."), ("", ","), ("\"", ""), ("", "!\""), ("(", ")"),
+               ("", "?"), ("'", "'"), ("", ";")]
+
+
+def make_vocabulary(size):
+    """Return size unique words of varied case, first letter and length"""
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = []
+    seen = set()
+    while len(words) < size:
+        length = min(1 + int(random.expovariate(0.25)), 16)
+        word = "".join(random.choice(letters) for _ in range(length))
+        style = random.random()
+        if style < 0.15:
+            word = word.title()
+        elif style < 0.18:
+            word = word.upper()
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def write_corpus(f, args, vocabulary):
+    """Write a corpus of Zipf distributed words in lines and paragraphs"""
+    total = 0.0
+    cumulative = []
+    for rank in range(1, len(vocabulary) + 1):
+        total += 1.0 / rank ** args.zipf
+        cumulative.append(total)
+    written = 0
+    while written < args.words:
+        line = []
+        for _ in range(random.randint(4, 16)):
+            word = vocabulary[bisect.bisect(cumulative,
+                                            random.random() * total)]
+            if random.random() < args.punctuation:
+                before, after = random.choice(PUNCTUATION)
+                word = before + word + after
+            line.append(word)
+        written += len(line)
+        f.write(" ".join(line) + "\n")
+        if random.random() < 0.1:
+            f.write("\n")
+    return written
+
+
+def time_stage(results, stage, run):
+    """Run one stage, adding the seconds it took to results"""
+    start = time.time()
+    value = run()
+    results[stage] = time.time() - start
+    return value
+
+
+def run_mode(mode, corpus, filterName, seed):
+    """Time every stage of one mode, returning seconds per stage"""
+    cmd = options.get_settings(mode.split() + ["-R", seed], no_cache=True)
+    random.seed(cmd["random_seed"])
+    cmd["source"] = cmd["input"] = open(corpus, "r")
+    cmd["filter"] = open(filterName, "r")
+    cmd["output"] = open(os.devnull, "w")
+    results = {}
+
+    # only modes with -S or -D load the filter, so only they time it
+    if cmd["filter_same"] or cmd["filter_different"]:
+        filterList = time_stage(results, "filter",
+                                lambda: textrearranger.get_filter_list(cmd))
+    else:
+        filterList = textrearranger.get_filter_list(cmd)
+    dictionary = {}
+    occurences, wordCount = time_stage(results, "fill",
+        lambda: textrearranger.fill_dictionary(cmd, dictionary, filterList))
+    # buckets are prepared as generate first uses them, so the time spent
+    # preparing them is taken from the sort stage --timings reports
+    cmd["timings"] = textrearranger.Timings()
+    dictionary = textrearranger.prepare_dictionary(cmd, dictionary)
+    cmd["input"] = open(corpus, "r")
+    if cmd["inspection_mode"]:
+        time_stage(results, "generate",
+                   lambda: textrearranger.generate_analysis(
+                       cmd, textrearranger.FrequencyIndex(
+                           cmd, occurences, wordCount)))
+    else:
+        time_stage(results, "generate",
+                   lambda: textrearranger.generate_text(
+                       cmd, dictionary, filterList, {}))
+    results["sort"] = cmd["timings"].seconds.get("sort", 0.0)
+    results["sort tokens"] = cmd["timings"].tokens.get("sort", 0)
+    results["generate"] -= results["sort"]
+    # ru_maxrss is in kilobytes on Linux
+    results["memory"] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss * 1024
+    return results
+
+
+def measure(mode, corpus, filterName, args):
+    """Return the best results of a mode, each run in a fresh process"""
+    best = None
+    for _ in range(args.repeat):
+        child = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__),
+             "--child", json.dumps([mode, corpus, filterName]),
+             "-R", str(args.random_seed)],
+            stdout=subprocess.PIPE)
+        output, _ = child.communicate()
+        if child.returncode:
+            sys.exit("ERROR: mode \"%s\" failed." % mode)
+        results = json.loads(output)
+        if best is None:
+            best = results
+            continue
+        for key, value in results.items():
+            best[key] = min(best[key], value)
+    return best
+
+
+def compare(seconds, baseline, threshold):
+    """Return a change from the baseline, and whether it regressed"""
+    if baseline is None:
+        return "", False
+    if not baseline:
+        return "   (new)", False
+    change = (seconds - baseline) / baseline * 100
+    # stages this quick are mostly timer noise
+    regressed = change > threshold and seconds - baseline > 0.01
+    return "%+7.1f%%%s" % (change, " REGRESSED" if regressed else ""), \
+        regressed
+
+
+def main():
+    """Run the benchmark"""
+    args = parser.parse_args()
+    if args.child:
+        mode, corpus, filterName = args.child
+        results = run_mode(mode, corpus, filterName, str(args.random_seed))
+        sys.stdout.write(json.dumps(results))
+        return
+
+    random.seed(args.random_seed)
+    vocabulary = make_vocabulary(args.vocabulary)
+    corpusSettings = dict((setting, getattr(args, setting)) for setting in
+                          ("words", "vocabulary", "zipf", "punctuation",
+                           "random_seed"))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline["corpus"] != corpusSettings:
+            print("WARNING: baseline was taken on a different corpus, %s." %
+                  ", ".join("%s %s" % pair for pair in
+                            sorted(baseline["corpus"].items())))
+
+    fd, corpus = tempfile.mkstemp(suffix=".txt")
+    filterFd, filterName = tempfile.mkstemp(suffix=".txt")
+    try:
+        with os.fdopen(fd, "w") as f:
+            tokens = write_corpus(f, args, vocabulary)
+        # the filter holds every third word of the vocabulary
+        with os.fdopen(filterFd, "w") as f:
+            f.write("\n".join(vocabulary[::3]) + "\n")
+        # words each stage reads, where sort only reads the buckets used
+        stageTokens = {"filter": len(vocabulary[::3]), "fill": tokens,
+                       "generate": tokens}
+
+        saved = {"corpus": corpusSettings, "modes": {}}
+        regressions = 0
+        print("%d words, %d unique, zipf %.2f, punctuation %.2f" % (
+            tokens, args.vocabulary, args.zipf, args.punctuation))
+        for mode in args.mode or MODES:
+            results = measure(mode, corpus, filterName, args)
+            saved["modes"][mode] = results
+            old = baseline["modes"].get(mode, {}) if baseline else None
+            print("%s  (peak memory %.1f MB)" % (
+                mode, results["memory"] / 1024.0 / 1024.0))
+            stageTokens["sort"] = results["sort tokens"]
+            for stage in STAGES:
+                if stage not in results:
+                    continue
+                seconds = results[stage]
+                change, regressed = compare(
+                    seconds, None if old is None else old.get(stage, 0),
+                    args.threshold)
+                regressions += regressed
+                rate = "%12.0f tokens/sec" % (
+                    stageTokens[stage] / max(seconds, 1e-9))
+                if not stageTokens[stage]:
+                    rate = " " * len(rate)
+                print("  %-9s %8.3fs %s %s" % (stage, seconds, rate, change))
+
+        if args.save:
+            with open(args.save, "w") as f:
+                json.dump(saved, f, indent=2, sort_keys=True)
+        if regressions:
+            sys.exit("%d stages regressed from the baseline." % regressions)
+    finally:
+        os.remove(corpus)
+        os.remove(filterName)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!usr/bin/python
+
+"""Compare tokenizer throughput against the old per-line generator"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import textrearranger
+
+parser = argparse.ArgumentParser(description=
+    "Times how many tokens per second each tokenizer produces from a "
+    "generated text file.")
+parser.add_argument("-l", "--lines", type=int, default=200000,
+                    help="number of lines to generate, defaults to 200000")
+parser.add_argument("-r", "--repeat", type=int, default=3,
+                    help="number of timed runs to take the best of")
+parser.add_argument("-R", "--random-seed", type=int, default=0,
+                    help="seeds the generated text with given number")
+
+
+def line_tokenizer(f):
+    """The original tokenizer, splitting one line at a time"""
+    for line in f:
+        for word in line.split(" "):
+            yield word
+
+
+def write_text(f, lines):
+    """Write some random lines of words, blank lines and double spaces"""
+    words = ["the", "The", "said,", "\"Hello", "world!\"", "a", "quick",
+             "fox", "jumps", "(maybe)", "end.", "", "don't", "UPPER"]
+    for _ in range(lines):
+        length = random.randint(0, 16)
+        f.write(" ".join(random.choice(words) for _ in range(length)))
+        f.write("\n")
+
+
+def time_tokenizer(name, fName, makeTokens, repeat):
+    """Print the best tokens/sec of a tokenizer over a few runs"""
+    best = None
+    for _ in range(repeat):
+        with open(fName, "r") as f:
+            start = time.time()
+            count = 0
+            for _ in makeTokens(f):
+                count += 1
+            taken = time.time() - start
+        if best is None or taken < best:
+            best = taken
+    print("%-12s %10d tokens %8.3fs %12.0f tokens/sec" % (
+        name, count, best, count / max(best, 1e-9)))
+
+
+def main():
+    """Run the benchmark"""
+    args = parser.parse_args()
+    random.seed(args.random_seed)
+
+    fd, fName = tempfile.mkstemp(suffix=".txt")
+    try:
+        with os.fdopen(fd, "w") as f:
+            write_text(f, args.lines)
+        time_tokenizer("line", fName, line_tokenizer, args.repeat)
+        time_tokenizer("block", fName, textrearranger.tokenizer, args.repeat)
+        time_tokenizer("block+mmap", fName,
+                       lambda f: textrearranger.tokenizer(f, True),
+                       args.repeat)
+    finally:
+        os.remove(fName)
+
+
+if __name__ == "__main__":
+    main()
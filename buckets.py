@@ -0,0 +1,739 @@
+#!usr/bin/python
+
+"""Compact storage for the words sharing a dictionary bucket"""
+
+from __future__ import print_function
+
+import copy
+import random
+import threading
+from array import array
+
+
+class CountedBucket(object):
+    """
+    Store each unique word once, alongside how often it occurs
+    Acts like the list of every occurrence it replaces, so indexing,
+    popping and removing words all work the same as with a list
+    """
+
+    def __init__(self):
+        self.words = []
+        self.index = {}
+        self.counts = array("l")
+        self.total = 0
+        # cumulative counts, only built once a word is picked by index
+        self.tree = None
+        # last index that may still have a word left, for popping
+        self.end = -1
+        self.randomPop = False
+
+    # words taken out, kept by spilled buckets to store in place of them
+    log = None
+
+    def __len__(self):
+        return self.total
+
+    def __contains__(self, word):
+        position = self.index.get(word)
+        return position is not None and self.counts[position] > 0
+
+    def __iter__(self):
+        for position, word in enumerate(self.words):
+            for _ in range(self.counts[position]):
+                yield word
+
+    def __getitem__(self, occurence):
+        """Return the word at a given occurence, as if stored in a list"""
+        if occurence < 0:
+            occurence += self.total
+        if occurence < 0 or occurence >= self.total:
+            raise IndexError("bucket index out of range")
+        return self.words[self.find(occurence)]
+
+    def append(self, word, count=1):
+        """Add one or more occurences of a word"""
+        position = self.index.get(word)
+        if position is None:
+            position = len(self.words)
+            self.index[word] = position
+            self.words.append(word)
+            self.counts.append(0)
+            self.tree = None
+        self.counts[position] += count
+        self.total += count
+        self.end = len(self.words) - 1
+        if self.tree is not None:
+            self.update(position, count)
+
+    def remove(self, word):
+        """Remove one occurence of a word, like list.remove"""
+        position = self.index.get(word)
+        if position is None or self.counts[position] <= 0:
+            raise ValueError("bucket.remove(x): x not in bucket")
+        self.counts[position] -= 1
+        self.total -= 1
+        if self.tree is not None:
+            self.update(position, -1)
+        if self.log is not None:
+            self.log.append(word)
+
+    def pop(self, rng=random):
+        """
+        Remove and return the last occurence, like list.pop
+        A shuffled bucket instead gives back a random occurence from rng
+        """
+        if not self.total:
+            raise IndexError("pop from empty bucket")
+        if self.randomPop:
+            word = self[rng.randint(0, self.total - 1)]
+        else:
+            while self.counts[self.end] <= 0:
+                self.end -= 1
+            word = self.words[self.end]
+        self.remove(word)
+        return word
+
+    def random_other(self, word, rng=random):
+        """
+        Return a random occurence of any word other than the given one
+        Only gives back the same word if the bucket holds nothing else
+        """
+        position = self.index.get(word)
+        if position is None or not self.counts[position]:
+            return self[rng.randint(0, self.total - 1)]
+        excluded = self.counts[position]
+        if excluded == self.total:
+            return word
+        occurence = rng.randint(0, self.total - excluded - 1)
+        # skip over every occurence of the excluded word
+        if occurence >= self.prefix(position):
+            occurence += excluded
+        return self.words[self.find(occurence)]
+
+    def copy(self):
+        """Return a copy that can be used up without changing this one"""
+        bucket = copy.copy(self)
+        bucket.log = None
+        bucket.words = list(self.words)
+        bucket.index = dict(self.index)
+        bucket.counts = array("l", self.counts)
+        if self.tree is not None:
+            bucket.tree = array("l", self.tree)
+        return bucket
+
+    def unique_words(self):
+        """Return every word that still has an occurence left"""
+        return [word for position, word in enumerate(self.words)
+                if self.counts[position] > 0]
+
+    def arrange(self, uniqueOnly, shuffle, alphabetical, rng=random):
+        """Reorganize the bucket the same way lists are prepared"""
+        words = self.unique_words()
+        counts = [self.counts[self.index[word]] for word in words]
+        if uniqueOnly:
+            counts = [1] * len(words)
+        pairs = list(zip(words, counts))
+        if shuffle:
+            rng.shuffle(pairs)
+        if alphabetical:
+            pairs.sort(key=lambda pair: pair[0].lower())
+            pairs.reverse()
+        self.__init__()
+        for word, count in pairs:
+            self.append(word, count)
+        # a shuffled list is popped from in a random order
+        self.randomPop = shuffle and not alphabetical
+
+    def build_tree(self):
+        """Build a binary indexed tree of the counts for weighted picks"""
+        size = len(self.counts)
+        tree = array("l", [0]) * (size + 1)
+        for i in range(1, size + 1):
+            tree[i] += self.counts[i - 1]
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def update(self, position, change):
+        """Change the count of a word in the binary indexed tree"""
+        i = position + 1
+        size = len(self.tree) - 1
+        while i <= size:
+            self.tree[i] += change
+            i += i & -i
+
+    def prefix(self, position):
+        """Return the number of occurences before a given word position"""
+        if self.tree is None:
+            self.build_tree()
+        total = 0
+        i = position
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, occurence):
+        """Return the position of the word covering a given occurence"""
+        if self.tree is None:
+            self.build_tree()
+        tree = self.tree
+        size = len(tree) - 1
+        position = 0
+        step = 1
+        while step * 2 <= size:
+            step *= 2
+        while step:
+            following = position + step
+            if following <= size and tree[following] <= occurence:
+                position = following
+                occurence -= tree[following]
+            step //= 2
+        return position
+
+
+class IndexedBucket(object):
+    """
+    List of word occurences that can remove any word in constant time
+    Unordered buckets move their last occurence into the gap left behind,
+    while ordered ones skip removed words when popping instead, which
+    are the first occurences stored, like list.remove
+    """
+
+    def __init__(self, words=(), ordered=False):
+        self.words = list(words)
+        self.ordered = ordered
+        self.total = len(self.words)
+        self.counts = {}
+        # ordered buckets: occurences removed but still stored
+        self.removed = {}
+        # unordered buckets: where each word is stored, and where each
+        # stored occurence sits in its word's list of positions
+        self.positions = {}
+        self.slots = array("l")
+        if ordered:
+            for word in self.words:
+                self.counts[word] = self.counts.get(word, 0) + 1
+            return
+        for position, word in enumerate(self.words):
+            if word not in self.positions:
+                self.positions[word] = []
+            self.slots.append(len(self.positions[word]))
+            self.positions[word].append(position)
+
+    # words taken out, kept by spilled buckets to store in place of them:
+    # the word removed, None for a pop, or the stored position taken
+    log = None
+
+    def __len__(self):
+        return self.total
+
+    def __contains__(self, word):
+        if self.ordered:
+            return self.counts.get(word, 0) > 0
+        return bool(self.positions.get(word))
+
+    def __iter__(self):
+        if self.ordered and self.removed:
+            self.compact()
+        return iter(self.words)
+
+    def __getitem__(self, occurence):
+        if self.ordered and self.removed:
+            self.compact()
+        return self.words[occurence]
+
+    def copy(self):
+        """Return a copy that can be used up without changing this one"""
+        bucket = copy.copy(self)
+        bucket.log = None
+        bucket.words = list(self.words)
+        bucket.counts = dict(self.counts)
+        bucket.removed = dict(self.removed)
+        bucket.positions = dict((word, list(wordPositions)) for
+                                word, wordPositions in self.positions.items())
+        bucket.slots = array("l", self.slots)
+        return bucket
+
+    def cut(self, start, end):
+        """
+        Return the occurences stored from start up to end as a new bucket,
+        which is only meant to be added back into one with extend
+        Unordered buckets keep where each occurence sits among its word's,
+        so pieces cut from one add back up to it exactly as it was
+        """
+        if self.ordered:
+            if self.removed:
+                self.compact()
+            return IndexedBucket(self.words[start:end], True)
+        bucket = IndexedBucket()
+        bucket.words = self.words[start:end]
+        bucket.slots = self.slots[start:end]
+        bucket.total = len(bucket.words)
+        return bucket
+
+    def extend(self, bucket):
+        """Add back every occurence of a piece cut from a bucket"""
+        self.total += bucket.total
+        if self.ordered:
+            for word in bucket:
+                self.counts[word] = self.counts.get(word, 0) + 1
+            self.words.extend(bucket)
+            return
+        for word, slot in zip(bucket.words, bucket.slots):
+            wordPositions = self.positions.setdefault(word, [])
+            # later pieces fill in any slots skipped over
+            if slot >= len(wordPositions):
+                wordPositions.extend([None] * (slot + 1 - len(wordPositions)))
+            wordPositions[slot] = len(self.words)
+            self.words.append(word)
+            self.slots.append(slot)
+
+    def compact(self):
+        """Drop removed words from an ordered bucket's storage"""
+        words = []
+        for word in self.words:
+            if self.removed.get(word):
+                self.removed[word] -= 1
+                continue
+            words.append(word)
+        self.words = words
+        self.removed = {}
+
+    def remove(self, word):
+        """Remove one occurence of a word, like list.remove"""
+        if word not in self:
+            raise ValueError("bucket.remove(x): x not in bucket")
+        if self.log is not None:
+            self.log.append(word)
+        self.total -= 1
+        if self.ordered:
+            self.counts[word] -= 1
+            self.removed[word] = self.removed.get(word, 0) + 1
+        else:
+            self.discard(self.positions[word][-1])
+
+    def pop(self):
+        """Remove and return the last occurence, like list.pop"""
+        if not self.total:
+            raise IndexError("pop from empty bucket")
+        if self.log is not None:
+            self.log.append(None)
+        self.total -= 1
+        if not self.ordered:
+            word = self.words[-1]
+            self.discard(len(self.words) - 1)
+            return word
+        while True:
+            word = self.words.pop()
+            # removed occurences come first, so the last one stored is
+            # only removed once none of the word is left
+            if not self.counts[word]:
+                self.removed[word] -= 1
+                continue
+            self.counts[word] -= 1
+            return word
+
+    def take(self, position):
+        """Remove and return the occurence stored at a position"""
+        if self.ordered:
+            word = self[position]
+            self.remove(word)
+            return word
+        if self.log is not None:
+            self.log.append(position)
+        word = self.words[position]
+        self.total -= 1
+        self.discard(position)
+        return word
+
+    def discard(self, position):
+        """Take out a stored occurence, filling its gap with the last one"""
+        word = self.words[position]
+        wordPositions = self.positions[word]
+        slot = self.slots[position]
+        # drop position from its word's list the same way
+        moved = wordPositions.pop()
+        if moved != position:
+            wordPositions[slot] = moved
+            self.slots[moved] = slot
+
+        last = len(self.words) - 1
+        if position != last:
+            lastWord = self.words[last]
+            lastSlot = self.slots[last]
+            self.positions[lastWord][lastSlot] = position
+            self.words[position] = lastWord
+            self.slots[position] = lastSlot
+        self.words.pop()
+        self.slots.pop()
+
+
+class GroupedBucket(object):
+    """
+    List of word occurences stored with every occurence of a word together
+    Lets a word be left out of random picks in constant time, for buckets
+    that are only ever picked from and never used up
+    """
+
+    def __init__(self, words=()):
+        counts = {}
+        # words in the order they first occur in
+        order = []
+        for word in words:
+            if word in counts:
+                counts[word] += 1
+            else:
+                counts[word] = 1
+                order.append(word)
+        self.words = []
+        # where each word's occurences start, and how many there are
+        self.spans = {}
+        for word in order:
+            self.spans[word] = (len(self.words), counts[word])
+            self.words.extend([word] * counts[word])
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.spans
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __getitem__(self, occurence):
+        return self.words[occurence]
+
+    def random_other(self, word, rng=random):
+        """
+        Return a random occurence of any word other than the given one
+        Only gives back the same word if the bucket holds nothing else
+        """
+        span = self.spans.get(word)
+        if span is None:
+            return self.words[rng.randint(0, len(self.words) - 1)]
+        start, excluded = span
+        if excluded == len(self.words):
+            return word
+        occurence = rng.randint(0, len(self.words) - excluded - 1)
+        # skip over every occurence of the excluded word
+        if occurence >= start:
+            occurence += excluded
+        return self.words[occurence]
+
+    def cut(self, start, end):
+        """Return the occurences from start up to end as a new bucket"""
+        return GroupedBucket(self.words[start:end])
+
+    def extend(self, bucket):
+        """
+        Add every occurence of another grouped bucket, like list.extend
+        Its first word's group carries on this one's last, if they match,
+        so pieces cut from a bucket add back up to it
+        """
+        for word in bucket:
+            if self.words and self.words[-1] == word:
+                start, count = self.spans[word]
+                self.spans[word] = (start, count + 1)
+            else:
+                self.spans[word] = (len(self.words), 1)
+            self.words.append(word)
+
+    def copy(self):
+        """Return a copy, which shares nothing that can be changed"""
+        bucket = GroupedBucket()
+        bucket.words = list(self.words)
+        bucket.spans = dict(self.spans)
+        return bucket
+
+
+class OffsetBucket(object):
+    """
+    List of word occurences stored as where each one is in a mapped source
+    Words are only made into strings when they are gotten or popped,
+    so each occurence takes five bytes instead of a list entry's eight
+    """
+
+    def __init__(self, text=None):
+        # the mapped source, attached again after being loaded or merged
+        self.text = text
+        # widened whenever an offset or length doesn't fit
+        self.offsets = array("I")
+        self.lengths = array("B")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        text = self.text
+        offsets = self.offsets
+        lengths = self.lengths
+        for occurence in xrange(len(offsets)):
+            offset = offsets[occurence]
+            yield text[offset:offset + lengths[occurence]]
+
+    def __getitem__(self, occurence):
+        offset = self.offsets[occurence]
+        return self.text[offset:offset + self.lengths[occurence]]
+
+    def __getstate__(self):
+        # mapped files can't be pickled, or sent to other processes
+        state = dict(self.__dict__)
+        state["text"] = None
+        return state
+
+    def add(self, offset, length):
+        """Add an occurence by where it is in the source"""
+        try:
+            self.offsets.append(offset)
+        except OverflowError:
+            self.offsets = array("L", self.offsets)
+            self.offsets.append(offset)
+        try:
+            self.lengths.append(length)
+        except OverflowError:
+            self.lengths = array("L", self.lengths)
+            self.lengths.append(length)
+
+    def extend(self, bucket):
+        """Add every occurence of another offset bucket, like list.extend"""
+        for name in ("offsets", "lengths"):
+            mine = getattr(self, name)
+            theirs = getattr(bucket, name)
+            if mine.typecode != theirs.typecode:
+                mine = array("L", mine)
+                theirs = array("L", theirs)
+            mine.extend(theirs)
+            setattr(self, name, mine)
+
+    def pop(self):
+        """Remove and return the last occurence, like list.pop"""
+        if not self.offsets:
+            raise IndexError("pop from empty bucket")
+        offset = self.offsets.pop()
+        return self.text[offset:offset + self.lengths.pop()]
+
+    def copy(self):
+        """Return a copy that can be used up without changing this one"""
+        return self.cut(0, len(self.offsets))
+
+    def cut(self, start, end):
+        """Return the occurences from start up to end as a new bucket"""
+        bucket = OffsetBucket(self.text)
+        bucket.offsets = self.offsets[start:end]
+        bucket.lengths = self.lengths[start:end]
+        return bucket
+
+    def shared_words(self):
+        """
+        Return every occurence as a list, with one string per unique word
+        the same way the token cache shares them, instead of one apiece
+        """
+        shared = {}
+        return [shared.setdefault(word, word) for word in self]
+
+    def sort(self, key, reverse=False):
+        """
+        Sort in place, in the same order sorted would, then reverse it
+        afterwards if asked, like list.reverse
+        Each unique word is only made into a string once while sorting
+        """
+        keys = {}
+        order = []
+        for word in self:
+            wordKey = keys.get(word)
+            if wordKey is None:
+                wordKey = keys[word] = key(word)
+            order.append(wordKey)
+        order = sorted(xrange(len(order)), key=order.__getitem__)
+        if reverse:
+            order.reverse()
+        self.offsets = array(self.offsets.typecode,
+                             [self.offsets[i] for i in order])
+        self.lengths = array(self.lengths.typecode,
+                             [self.lengths[i] for i in order])
+
+    def shuffle(self, rng=random):
+        """Shuffle in place, in the same order random.shuffle would"""
+        offsets = self.offsets
+        lengths = self.lengths
+        draw = rng.random
+        for i in reversed(xrange(1, len(offsets))):
+            j = int(draw() * (i + 1))
+            offsets[i], offsets[j] = offsets[j], offsets[i]
+            lengths[i], lengths[j] = lengths[j], lengths[i]
+
+
+def attach_source(dictionary, text):
+    """Give every offset bucket in a dictionary the mapped source"""
+    for wordList in dictionary.values():
+        if isinstance(wordList, OffsetBucket):
+            wordList.text = text
+
+
+def empty_bucket(wordList):
+    """Return an empty bucket of the same kind, to merge pieces into"""
+    if isinstance(wordList, CountedBucket):
+        bucket = CountedBucket()
+        bucket.randomPop = wordList.randomPop
+        return bucket
+    if isinstance(wordList, IndexedBucket):
+        return IndexedBucket(ordered=wordList.ordered)
+    if isinstance(wordList, GroupedBucket):
+        return GroupedBucket()
+    if isinstance(wordList, OffsetBucket):
+        return OffsetBucket(wordList.text)
+    return []
+
+
+def merge_bucket(merged, wordList):
+    """Add every occurence of a bucket to another of the same kind"""
+    if isinstance(wordList, CountedBucket):
+        for position, word in enumerate(wordList.words):
+            merged.append(word, wordList.counts[position])
+    else:
+        merged.extend(wordList)
+
+
+def split_bucket(wordList, size):
+    """
+    Iterator that yields a bucket in pieces of the same kind, each with
+    at most size occurences, or size unique words for counted buckets
+    Pieces merged in order into an empty bucket add back up to it, and
+    an empty bucket still yields one empty piece
+    """
+    if isinstance(wordList, CountedBucket):
+        for start in xrange(0, max(len(wordList.words), 1), size):
+            piece = empty_bucket(wordList)
+            for position in xrange(start,
+                                   min(start + size, len(wordList.words))):
+                if wordList.counts[position]:
+                    piece.append(wordList.words[position],
+                                 wordList.counts[position])
+            yield piece
+    elif isinstance(wordList, (IndexedBucket, GroupedBucket, OffsetBucket)):
+        for start in xrange(0, max(len(wordList), 1), size):
+            yield wordList.cut(start, start + size)
+    elif isinstance(wordList, list):
+        for start in xrange(0, max(len(wordList), 1), size):
+            yield wordList[start:start + size]
+    else:
+        yield wordList
+
+
+def take_random(wordList, rng=random):
+    """
+    Remove and return a random occurence of any kind of bucket
+    The last occurence is moved into the gap left behind
+    """
+    occurence = rng.randint(0, len(wordList) - 1)
+    if isinstance(wordList, IndexedBucket):
+        return wordList.take(occurence)
+    if isinstance(wordList, CountedBucket):
+        word = wordList[occurence]
+        wordList.remove(word)
+        return word
+    word = wordList[occurence]
+    if isinstance(wordList, OffsetBucket):
+        for stored in (wordList.offsets, wordList.lengths):
+            stored[occurence] = stored[-1]
+            stored.pop()
+    else:
+        wordList[occurence] = wordList[-1]
+        wordList.pop()
+    return word
+
+
+def copy_bucket(wordList):
+    """Return a copy of any kind of bucket"""
+    if isinstance(wordList, list):
+        return list(wordList)
+    return wordList.copy()
+
+
+class PreparedDictionary(object):
+    """
+    Dictionary that prepares each bucket the first time it is gotten
+    Buckets that are never looked up are never prepared, and a bucket
+    gotten by several threads at once is still only prepared once
+    Wraps the built dictionary, so every way of reading a bucket goes
+    through get, and an unprepared bucket can never be read
+    """
+
+    def __init__(self, dictionary, prepare):
+        self.dictionary = dict(dictionary)
+        self.prepare = prepare
+        self.prepared = set()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.dictionary)
+
+    def __contains__(self, key):
+        return key in self.dictionary
+
+    def __iter__(self):
+        return iter(self.dictionary)
+
+    def __getitem__(self, key):
+        wordList = self.get(key)
+        if wordList is None:
+            raise KeyError(key)
+        return wordList
+
+    def keys(self):
+        return self.dictionary.keys()
+
+    def get(self, key, default=None):
+        if key in self.prepared:
+            return self.dictionary[key]
+        with self.lock:
+            wordList = self.dictionary.get(key)
+            if wordList is None:
+                return default
+            if key not in self.prepared:
+                wordList = self.dictionary[key] = self.prepare(key, wordList)
+                self.prepared.add(key)
+            return wordList
+
+    def iteritems(self):
+        for key in self.dictionary.keys():
+            yield key, self.get(key)
+
+    def itervalues(self):
+        for key, wordList in self.iteritems():
+            yield wordList
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+
+class CopyOnWriteDictionary(object):
+    """
+    View of a dictionary that copies each bucket the first time it is used
+    Lets words be used up without changing the dictionary underneath
+    Each copy is passed through prepare, if given, before it is used
+    """
+
+    def __init__(self, dictionary, prepare=None):
+        self.dictionary = dictionary
+        self.prepare = prepare
+        self.copies = {}
+
+    def get(self, key, default=None):
+        wordList = self.copies.get(key)
+        if wordList is None:
+            wordList = self.dictionary.get(key)
+            if wordList is None:
+                return default
+            wordList = copy_bucket(wordList)
+            if self.prepare is not None:
+                wordList = self.prepare(key, wordList)
+            self.copies[key] = wordList
+        return wordList
@@ -0,0 +1,231 @@
+#!usr/bin/python
+
+"""Save and load built dictionaries, so a source is only parsed once"""
+
+from __future__ import print_function
+
+import os
+import time
+import hashlib
+import cPickle as pickle
+
+# bump whenever the layout of stored dictionaries changes
+CACHE_VERSION = 1
+# settings that change which words end up in which buckets
+BUCKET_SETTINGS = ["compare_case", "first_letter", "case_sensitive",
+                   "length_check", "compare_lower", "preserve_punctuation",
+                   "void_outer", "void_inner", "filter_source",
+                   "soft_truncate_newlines", "hard_truncate_newlines",
+                   "filter_same", "filter_different",
+                   # settings that change how buckets are stored
+                   "compact_buckets", "map_words", "get_different",
+                   "alphabetical_sort", "mmap_source",
+                   # -I only keeps word counts
+                   "inspection_mode"]
+# added to a dictionary's key for the -I frequency index sorted from it
+INDEX_SUFFIX = "-index"
+# file hashes remembered by path, size and time last changed
+HASHES_NAME = "hashes.index"
+# seconds a file must go unchanged before its hash is remembered
+HASH_SETTLE_TIME = 2
+
+
+def get_cache_dir(cmd):
+    """Return the folder cache files are kept in"""
+    if cmd["cache_dir"]:
+        return cmd["cache_dir"]
+    base = os.environ.get("XDG_CACHE_HOME",
+                          os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "text-rearranger")
+
+
+def hash_file(fName):
+    """Return a hash of the contents of a file"""
+    digest = hashlib.sha1()
+    with open(fName, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_file_hash(cmd, fName):
+    """
+    Return a hash of the contents of a file, remembered in the cache folder
+    by where the file is, its size, and when it was last changed, so an
+    unchanged file isn't read through again
+    """
+    path = os.path.realpath(fName)
+    stat = os.stat(path)
+    stamp = (stat.st_size, stat.st_mtime, stat.st_ino)
+    hashes = load_hashes(cmd)
+    if hashes.get(path, (None,))[0] == stamp:
+        return hashes[path][1]
+    digest = hash_file(path)
+    # a file changed this recently could change again without its stamp
+    # changing, so its hash is only remembered once it has sat a while
+    if time.time() - stat.st_mtime > HASH_SETTLE_TIME:
+        hashes[path] = (stamp, digest)
+        save_hashes(cmd, hashes)
+    return digest
+
+
+def load_hashes(cmd):
+    """Return the remembered hashes of files, by path"""
+    try:
+        with open(os.path.join(get_cache_dir(cmd), HASHES_NAME), "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        return {}
+
+
+def save_hashes(cmd, hashes):
+    """Save the remembered hashes of files, if the cache folder allows"""
+    folder = get_cache_dir(cmd)
+    path = os.path.join(folder, HASHES_NAME)
+    temp = "%s.%d.tmp" % (path, os.getpid())
+    # files that are gone are never asked about again
+    hashes = dict((fName, entry) for fName, entry in hashes.items()
+                  if os.path.exists(fName))
+    try:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(temp, "wb") as f:
+            pickle.dump(hashes, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp, path)
+    except (IOError, OSError):
+        remove(temp)
+
+
+def get_file_name(f):
+    """Return the path of an open file, if it is a regular file"""
+    fName = getattr(f, "name", None)
+    if isinstance(fName, str) and os.path.isfile(fName):
+        return fName
+    return None
+
+
+def get_cache_key(cmd):
+    """
+    Return a key for the dictionary cmd would build
+    Return None if the source can't be cached, such as standard input
+    """
+    sourceName = get_file_name(cmd["source"])
+    if not sourceName:
+        return None
+    parts = [str(CACHE_VERSION), get_file_hash(cmd, sourceName)]
+    parts += ["%s=%r" % (setting, cmd[setting]) for setting in BUCKET_SETTINGS]
+    # -g only counts words in its buckets when it takes them out
+    if cmd["get_different"]:
+        parts += ["%s=%r" % (setting, cmd[setting]) for setting in
+                  ("limited_usage", "force_limited_usage")]
+    if cmd["filter_same"] or cmd["filter_different"]:
+        filterName = get_file_name(cmd["filter"])
+        if not filterName:
+            return None
+        parts.append(get_file_hash(cmd, filterName))
+    return hashlib.sha1("\n".join(parts)).hexdigest()
+
+
+def load(cmd, key, limit=None):
+    """
+    Return the cached dictionary, counts and filter list for key
+    Return None if nothing usable is cached, or it is over limit bytes
+    """
+    path = os.path.join(get_cache_dir(cmd), key + ".pickle")
+    if not os.path.isfile(path):
+        return None
+    if limit and os.path.getsize(path) > limit:
+        return None
+    try:
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        # marks the file as recently used for trimming
+        os.utime(path, None)
+        return data
+    except Exception:
+        remove(path)
+        return None
+
+
+class CacheFull(Exception):
+    """Raised once a dictionary being saved is bigger than --cache-size"""
+
+
+class LimitedFile(object):
+    """File that stops taking writes once they pass limit bytes"""
+
+    def __init__(self, f, limit):
+        self.f = f
+        self.left = limit
+
+    def write(self, data):
+        self.left -= len(data)
+        if self.left < 0:
+            raise CacheFull()
+        self.f.write(data)
+
+
+def store(cmd, key, data):
+    """Save data to the cache under key, then trim the cache to size"""
+    # --cache-size 0 already warned that nothing is cached
+    if cmd["cache_size"] < 1:
+        return []
+    folder = get_cache_dir(cmd)
+    path = os.path.join(folder, key + ".pickle")
+    temp = "%s.%d.tmp" % (path, os.getpid())
+    limit = cmd["cache_size"] * 1024 * 1024
+    try:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        # stops dumping as soon as it is too big to keep
+        with open(temp, "wb") as f:
+            pickle.dump(data, LimitedFile(f, limit), pickle.HIGHEST_PROTOCOL)
+        os.rename(temp, path)
+    except CacheFull:
+        remove(temp)
+        return ["NOTICE: Dictionary is bigger than --cache-size, so it "
+                "was not cached."]
+    except (IOError, OSError) as e:
+        remove(temp)
+        return ["NOTICE: Could not cache dictionary: %s" % e]
+    trim(folder, limit)
+    return []
+
+
+def trim(folder, limit):
+    """Delete the least recently used cache files until under limit"""
+    entries = []
+    for fName in os.listdir(folder):
+        if not fName.endswith(".pickle"):
+            continue
+        path = os.path.join(folder, fName)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        remove(path)
+        total -= size
+
+
+def clear(cmd):
+    """Delete every cached dictionary"""
+    folder = get_cache_dir(cmd)
+    if not os.path.isdir(folder):
+        return
+    for fName in os.listdir(folder):
+        if (fName.endswith(".pickle") or fName.endswith(".tmp") or
+                fName == HASHES_NAME):
+            remove(os.path.join(folder, fName))
+
+
+def remove(path):
+    """Delete a file, ignoring it if it is already gone"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,38 @@
+#!usr/bin/python
+
+"""Random numbers drawn in batches with NumPy, for --numpy-random"""
+
+from __future__ import print_function
+
+# numbers drawn at once for each stream
+BATCH_SIZE = 4096
+# set to the numpy module the first time it is looked for
+numpy = None
+
+
+def available():
+    """Check if NumPy is installed, only importing it when first asked"""
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as module
+        except ImportError:
+            module = False
+        numpy = module
+    return bool(numpy)
+
+
+def percent_rolls(seed):
+    """Iterator that yields random whole numbers from 0 to 99, forever"""
+    state = numpy.random.RandomState(seed)
+    while True:
+        for roll in state.randint(0, 100, BATCH_SIZE).tolist():
+            yield roll
+
+
+def fractions(seed):
+    """Iterator that yields random numbers from 0 up to 1, forever"""
+    state = numpy.random.RandomState(seed)
+    while True:
+        for fraction in state.random_sample(BATCH_SIZE).tolist():
+            yield fraction
@@ -6,7 +6,9 @@ from __future__ import print_function
 
 import sys
 import os
+import glob
 import argparse
+import draws
 
 parser = argparse.ArgumentParser(description=
     "Takes a text file to re-write using the contents of itself, or "
@@ -65,12 +67,16 @@ parser.add_argument("-U", "--force-limited-usage", action="store_true",
 parser.add_argument("-b", "--block-shuffle", action="store_true",
                     help="replacement words will not be shuffled, "
                         "but only works with -u")
+parser.add_argument("--compact-buckets", action="store_true",
+                    help="stores each word once with a count of its "
+                        "occurences, instead of once per occurence, "
+                        "which saves memory on large sources")
 parser.add_argument("-g", "--get-different", action="store_true",
                     help="tries to get different words for replacement")
 parser.add_argument("-G", "--get-attempts", type=int, default=10,
-                    help="specify number of times to try to get different "
-                        "replacements, defaults to 10, and can "
-                        "exponentially increase computing time")
+                    help="no longer used, since -g and -M now always pick "
+                        "a different word when one exists, but kept so "
+                        "older commands still run")
 parser.add_argument("-H", "--halt-rearranger", action="store_true",
                     help="halts rearranger from running, so text can only "
                         "be manipulated by non-arrangement based ways, "
@@ -81,6 +87,10 @@ parser.add_argument("-j", "--jabberwocky-chance", type=int, default=25,
                     help="increase the chance of a word being jabberwockied")
 parser.add_argument("-R", "--random-seed", type=int, default=-1,
                     help="seeds random with given number")
+parser.add_argument("--numpy-random", action="store_true",
+                    help="draws random numbers for -k, -J, -r and -e in "
+                        "batches with NumPy, which is faster but gives "
+                        "different output for a given -R")
 
 # punctuation sorting and whitespace handling
 parser.add_argument("-p", "--preserve-punctuation", action="store_true",
@@ -123,6 +133,76 @@ parser.add_argument("-o", "--output", type=str, default=sys.stdout,
                         "standard output")
 parser.add_argument("-O", "--overwrite", action="store_true",
                     help="automatically overwrites the output file")
+parser.add_argument("--mmap", action="store_true",
+                    help="memory-map input, source and filter files when "
+                        "reading them, instead of using buffered reads")
+parser.add_argument("--mmap-source", action="store_true",
+                    help="memory-map the source file, and store where each "
+                        "word is in it instead of the word itself, which "
+                        "saves memory on very large sources, though modes "
+                        "that take chosen words out still store the words "
+                        "of each bucket they use")
+parser.add_argument("--memory-budget", type=int, default=None,
+                    help="define the most megabytes buckets and word counts "
+                        "can use, moving the rest into a temporary file on "
+                        "disk and reading them back as they are used, so "
+                        "sources bigger than memory can be used, and input "
+                        "kept to be used again as the source is held to it "
+                        "too, though -I still needs memory for every unique "
+                        "word")
+
+# batch mode
+parser.add_argument("--batch", type=str, default=None,
+                    help="define a manifest file where each line is an "
+                        "input file and the output file to write it to, "
+                        "split by a tab or space, and rearranges every "
+                        "input against one source")
+parser.add_argument("--batch-glob", type=str, default=None,
+                    help="define a pattern of input files to rearrange "
+                        "against one source, each written to a file of "
+                        "the same name in --batch-output")
+parser.add_argument("--batch-output", type=str, default=None,
+                    help="define the folder --batch-glob writes to")
+
+# daemon mode
+parser.add_argument("--serve", type=str, default=None,
+                    help="define a Unix socket path or localhost port to "
+                        "answer rearrange and inspect requests on, keeping "
+                        "every served source built between requests")
+parser.add_argument("--serve-source", type=str, action="append",
+                    default=None,
+                    help="define a source file for --serve to build, as "
+                        "NAME=FILE, and can be used many times, while -s "
+                        "is served as \"default\"")
+
+# parallel generation
+parser.add_argument("--workers", type=int, default=1,
+                    help="define a number of processes to build the "
+                        "dictionary and rearrange the input with, split at "
+                        "paragraphs, defaults to 1, and only works on "
+                        "platforms that can fork")
+parser.add_argument("--shard-size", type=int, default=1024,
+                    help="define the kilobytes of input or source given to "
+                        "a worker at a time, defaults to 1024, and output "
+                        "for a given -R depends on it")
+
+# dictionary cache
+parser.add_argument("--cache", action="store_true",
+                    help="load built dictionaries from a cache, and save them "
+                        "to it, so a source file is only parsed once for the "
+                        "same settings, and only sorted once for -I")
+parser.add_argument("--no-cache", action="store_true",
+                    help="never load or save cached dictionaries, even with "
+                        "--cache")
+parser.add_argument("--clear-cache", action="store_true",
+                    help="deletes every cached dictionary before running")
+parser.add_argument("--cache-dir", type=str, default=None,
+                    help="define the folder cached dictionaries are kept in, "
+                        "defaults to ~/.cache/text-rearranger")
+parser.add_argument("--cache-size", type=int, default=512,
+                    help="define the most megabytes cached dictionaries can "
+                        "use, removing the least recently used ones first, "
+                        "and defaults to 512")
 
 # inspection mode and output options
 parser.add_argument("-I", "--inspection-mode", action="store_true",
@@ -172,6 +252,14 @@ parser.add_argument("-Z", "--slow-output", action="store_true",
 parser.add_argument("-z", "--slow-speed", type=float, default=1.0,
                     help="change the wait interval for -z")
 
+# measurement
+parser.add_argument("--timings", action="store_true",
+                    help="reports the seconds, tokens and tokens/sec of each "
+                        "stage to standard error once done")
+parser.add_argument("--profile", type=str, default=None,
+                    help="define a file to write profiler stats of the run "
+                        "to, which pstats can read")
+
 
 def print_msgs(cmd, msgs):
     """
@@ -206,27 +294,52 @@ def open_file(fType, fName, comparison):
         return open(fName, 'r')
 
 
-def get_command():
-    """
-    Parse and updates CLI arguments and return a dict of them
-    Check input files and file settings
-    """
-
-    cmd = vars(parser.parse_args())
-
+def apply_defaults(cmd):
+    """Turn on every setting -d stands for"""
     defaults = ["compare_case", "first_letter", "case_sensitive",
                 "length_check", "limited_usage", "preserve_punctuation"]
     if cmd["default"]:
         for arg in defaults:
             cmd[arg] = True
 
+
+def get_settings(args=(), **settings):
+    """
+    Return a dict of settings for using the rearranger from other code
+    Takes CLI style arguments, settings by name like limited_usage=True,
+    or both, and checks them the same way as the CLI
+    Never reads sys.argv, opens files, or prints messages
+    """
+    cmd = vars(parser.parse_args(list(args)))
+    for name, value in settings.items():
+        if name not in cmd:
+            raise KeyError("unknown setting \"%s\"" % name)
+        cmd[name] = value
+    apply_defaults(cmd)
+    validate_command(cmd)
+    return cmd
+
+
+def get_command(args=None):
+    """
+    Parse and updates CLI arguments and return a dict of them
+    Check input files and file settings
+    """
+
+    cmd = vars(parser.parse_args(args))
+    apply_defaults(cmd)
+
     msgs = validate_command(cmd)
     print_msgs(cmd, msgs)
     msgs = validate_files(cmd)
     print_msgs(cmd, msgs)
 
+    # input doubling as the source is only opened once
+    sameSource = cmd["source"] == cmd["input"]
     for fType in ("input", "source", "filter", "word_map"):
-        if not isinstance(cmd[fType], file):
+        if fType == "source" and sameSource:
+            cmd["source"] = cmd["input"]
+        elif not isinstance(cmd[fType], file):
             cmd[fType] = open_file(fType, cmd[fType], cmd["output"])
 
     return cmd
@@ -240,7 +353,12 @@ def validate_files(cmd):
     """
     msgs = []
 
-    if not cmd["source"]:
+    if cmd["batch"] or cmd["batch_glob"]:
+        msgs += validate_batch(cmd)
+
+    if cmd["serve"]:
+        msgs += validate_serve(cmd)
+    elif not cmd["source"]:
         cmd["source"] = cmd["input"]
         msgs.append("NOTICE: source will be the same as input.")
 
@@ -251,8 +369,9 @@ def validate_files(cmd):
                         "a filter, -S or -D.")
         elif cmd["filter"] == cmd["input"]:
             sys.exit("ERROR: filter and input files are the same.")
-    # -S or -D (without -f "...")
-    elif not cmd["filter"] and (cmd["filter_same"] or cmd["filter_different"]):
+    # -S or -D (without -f "..."), where served sources filter themselves
+    elif ((cmd["filter_same"] or cmd["filter_different"]) and
+            not cmd["serve"]):
         if cmd["source"] != cmd["input"]:
             cmd["filter"] = cmd["source"]
             msgs.append("NOTICE: filter file will be the source file.")
@@ -282,8 +401,8 @@ def validate_files(cmd):
             elif not raw_input(query % cmd["output"]).startswith("Y"):
                 sys.exit("Terminating. Rename your file or output parameter.")
         cmd["output"] = open(cmd["output"], 'w')
-    # -O (without -o "...")
-    elif cmd["overwrite"]:
+    # -O (without -o "..." or batch mode)
+    elif cmd["overwrite"] and not (cmd["batch"] or cmd["batch_glob"]):
         msgs.append("NOTICE: -O does nothing without specifying an output "
                     "file with -o.")
 
@@ -350,14 +469,25 @@ def validate_command(cmd):
     # -b (without -u)
     if cmd["block_shuffle"] and not cmd["limited_usage"]:
         msgs.append("NOTICE: Using -b does nothing without -u.")
+    # -u -b --compact-buckets
+    elif cmd["block_shuffle"] and cmd["compact_buckets"]:
+        msgs.append("NOTICE: -b needs words kept in their original order, "
+                    "so --compact-buckets has been turned off.")
+        cmd["compact_buckets"] = False
+    # -a --compact-buckets
+    if cmd["alphabetical_sort"] and cmd["compact_buckets"]:
+        msgs.append("NOTICE: -a needs words that only differ by case kept "
+                    "in their original order, so --compact-buckets has "
+                    "been turned off.")
+        cmd["compact_buckets"] = False
 
     # -M -g
     if cmd["map_words"] and cmd["get_different"]:
         msgs.append("NOTICE: -g is implied by -M, but you used both.")
-    # -G (without -M or -g)
-    if (cmd["get_attempts"] != 10 and
-            not (cmd["map_words"] or cmd["get_different"])):
-        msgs.append("NOTICE: -G does nothing without -g or -M.")
+    # -G [x]
+    if cmd["get_attempts"] != 10:
+        msgs.append("NOTICE: -G does nothing, since -g and -M always pick "
+                    "a different word when one exists.")
     # -H
     if cmd["halt_rearranger"]:
         msgs.append("NOTICE: No text will be re-arranged since you called -H.")
@@ -398,6 +528,81 @@ def validate_command(cmd):
         msgs.append("WARNING: You are using a custom source with usage "
                     "limiting on, so the output might be truncated.")
 
+    if cmd["workers"] > 1:
+        # --workers [x] -Z
+        if cmd["slow_output"] and not cmd["inspection_mode"]:
+            msgs.append("NOTICE: -Z needs output in order, so --workers "
+                        "has been set to 1.")
+            cmd["workers"] = 1
+        # --workers [x] (on Windows)
+        elif not hasattr(os, "fork"):
+            msgs.append("NOTICE: --workers needs to fork worker processes, "
+                        "which this platform can't do, so it has been set "
+                        "to 1.")
+            cmd["workers"] = 1
+    # --workers [x] (where x < 1)
+    elif cmd["workers"] < 1:
+        msgs.append("NOTICE: --workers is less than 1, so it has been set "
+                    "to 1.")
+        cmd["workers"] = 1
+    # --shard-size [x] (where x < 1)
+    if cmd["shard_size"] < 1:
+        msgs.append("WARNING: --shard-size must be at least 1, so it has "
+                    "been set to 1.")
+        cmd["shard_size"] = 1
+
+    if cmd["mmap_source"]:
+        # --mmap-source -V
+        if cmd["void_inner"]:
+            msgs.append("NOTICE: -V changes words so they aren't in the "
+                        "source as they are, so --mmap-source has been "
+                        "turned off.")
+            cmd["mmap_source"] = False
+        # --mmap-source --compact-buckets, or -M/-g -u/-g -U without -a
+        elif (cmd["compact_buckets"] or
+                (cmd["map_words"] or cmd["get_different"] and
+                 (cmd["limited_usage"] or cmd["force_limited_usage"])) and
+                not cmd["alphabetical_sort"]):
+            msgs.append("NOTICE: --compact-buckets, -M, and -g with -u or -U "
+                        "already store each word once, so --mmap-source has "
+                        "been turned off.")
+            cmd["mmap_source"] = False
+
+    if cmd["memory_budget"] is not None:
+        # --memory-budget [x] (where x < 1)
+        if cmd["memory_budget"] < 1:
+            msgs.append("WARNING: --memory-budget must be at least 1, so it "
+                        "has been set to 1.")
+            cmd["memory_budget"] = 1
+        # --memory-budget [x] --serve "..."
+        if cmd["serve"]:
+            msgs.append("NOTICE: --serve keeps every source in memory, so "
+                        "--memory-budget has been turned off.")
+            cmd["memory_budget"] = None
+
+    # --numpy-random (without NumPy installed)
+    if cmd["numpy_random"] and not draws.available():
+        msgs.append("NOTICE: NumPy is not installed, so --numpy-random "
+                    "does nothing.")
+
+    # --profile "..." --workers [x]
+    if cmd["profile"] and cmd["workers"] > 1:
+        msgs.append("NOTICE: --profile only profiles the main process, and "
+                    "not --workers processes.")
+
+    # --cache --no-cache
+    if cmd["cache"] and cmd["no_cache"]:
+        msgs.append("NOTICE: --cache does nothing with --no-cache.")
+        cmd["cache"] = False
+    # --cache-dir "..." or --cache-size [x] (without --cache)
+    if not cmd["cache"] and (cmd["cache_dir"] or cmd["cache_size"] != 512):
+        msgs.append("NOTICE: --cache-dir and --cache-size do nothing "
+                    "without --cache.")
+    # --cache --cache-size [x] (where x < 1)
+    elif cmd["cache"] and cmd["cache_size"] < 1:
+        msgs.append("NOTICE: --cache-size is less than 1, so nothing will "
+                    "be cached.")
+
     # -B (without -I)
     if cmd["block_inspection_sort"] and not cmd["inspection_mode"]:
         msgs.append("NOTICE: -B does nothing without -I.")
@@ -468,9 +673,150 @@ def validate_command(cmd):
     if ((cmd["filter_same"] or cmd["filter_different"]) and
             not (cmd["inspection_mode"] or cmd["keep_mode"] or
             cmd["pure_mode"])):
-        print(cmd["keep_mode"])
         msgs.append("WARNING: You called a filter, -S or -D, but without "
                     "using a filter mode, -I, -K, or -S. Falling back on -K.")
         cmd["keep_mode"] = True
 
-    return msgs
\ No newline at end of file
+    return msgs
+
+
+def validate_batch(cmd):
+    """
+    Check cmd for invalid or conflicting batch mode settings
+    Return notices and warnings
+    Exit on fatally unmanageable input
+    """
+    msgs = []
+
+    # --batch "..." --batch-glob "..."
+    if cmd["batch"] and cmd["batch_glob"]:
+        sys.exit("ERROR: Use only one of --batch and --batch-glob.")
+    # --batch "..." (where the manifest is missing)
+    if cmd["batch"] and not os.path.isfile(cmd["batch"]):
+        sys.exit("ERROR: batch manifest \"%s\" does not exist." %
+                 cmd["batch"])
+    # --batch-glob "..." (without --batch-output "...")
+    if cmd["batch_glob"] and not cmd["batch_output"]:
+        sys.exit("ERROR: --batch-glob needs a folder to write to, given by "
+                 "--batch-output.")
+    # --batch-output "..." (where the folder is missing)
+    if cmd["batch_output"] and not os.path.isdir(cmd["batch_output"]):
+        sys.exit("ERROR: batch output folder \"%s\" does not exist." %
+                 cmd["batch_output"])
+    # --batch "..." (without -s "...")
+    if not cmd["source"]:
+        sys.exit("ERROR: Batch mode needs a source file, given by -s.")
+    # --batch "..." -I
+    if cmd["inspection_mode"]:
+        msgs.append("NOTICE: Batch mode does nothing with -I, which only "
+                    "inspects the source.")
+    # --batch "..." -i "..."
+    if cmd["input"] != sys.stdin:
+        msgs.append("NOTICE: -i does nothing in batch mode.")
+    # --batch "..." -o "..."
+    if cmd["output"] != sys.stdout:
+        msgs.append("NOTICE: -o does nothing in batch mode.")
+        cmd["output"] = sys.stdout
+
+    return msgs
+
+
+def validate_serve(cmd):
+    """
+    Check cmd for invalid or conflicting daemon mode settings
+    Replaces --serve-source with a list of source names and files
+    Return notices and warnings
+    Exit on fatally unmanageable input
+    """
+    msgs = []
+
+    sources = []
+    if cmd["source"]:
+        sources.append(("default", cmd["source"]))
+    for entry in cmd["serve_source"] or []:
+        name, _, fName = entry.partition("=")
+        # --serve-source "..." (without a name)
+        if not name or not fName:
+            sys.exit("ERROR: --serve-source \"%s\" should be NAME=FILE." %
+                     entry)
+        sources.append((name, fName))
+    # --serve "..." (without -s "..." or --serve-source "...")
+    if not sources:
+        sys.exit("ERROR: --serve needs a source file, given by -s or "
+                 "--serve-source.")
+    for name, fName in sources:
+        # --serve-source NAME=FILE (where the file is missing)
+        if not os.path.isfile(fName):
+            sys.exit("ERROR: served source file \"%s\" does not exist." %
+                     fName)
+        # --serve-source NAME=FILE --serve-source NAME=FILE
+        if [n for n, _ in sources].count(name) > 1:
+            sys.exit("ERROR: More than one served source is named \"%s\"."
+                     % name)
+    cmd["serve_source"] = sources
+
+    # --serve "..." --batch "..."
+    if cmd["batch"] or cmd["batch_glob"]:
+        sys.exit("ERROR: Use only one of --serve and batch mode.")
+    # --serve "..." --timings or --profile "..."
+    if cmd["timings"] or cmd["profile"]:
+        msgs.append("NOTICE: --timings and --profile do nothing with "
+                    "--serve, which reports its own stats.")
+        cmd["timings"] = False
+        cmd["profile"] = None
+    # --serve "..." -I
+    if cmd["inspection_mode"]:
+        msgs.append("NOTICE: -I does nothing with --serve, where clients "
+                    "ask for inspections instead.")
+        cmd["inspection_mode"] = False
+    # --serve "..." -i "..."
+    if cmd["input"] != sys.stdin:
+        msgs.append("NOTICE: -i does nothing with --serve.")
+    # --serve "..." -o "..."
+    if cmd["output"] != sys.stdout:
+        msgs.append("NOTICE: -o does nothing with --serve.")
+        cmd["output"] = sys.stdout
+
+    return msgs
+
+
+def get_batch(cmd):
+    """
+    Iterator that yields every input and output file pair in a batch
+    Skips pairs that can't be read or written, with a warning
+    """
+    if cmd["batch_glob"]:
+        pairs = ((fName, os.path.join(cmd["batch_output"],
+                                      os.path.basename(fName)))
+                 for fName in sorted(glob.glob(cmd["batch_glob"])))
+    else:
+        pairs = read_manifest(cmd["batch"])
+
+    for inName, outName in pairs:
+        if not os.path.isfile(inName):
+            print_msgs(cmd, ["WARNING: Skipping batch input \"%s\", as it "
+                             "does not exist." % inName])
+        elif os.path.abspath(inName) == os.path.abspath(outName):
+            print_msgs(cmd, ["WARNING: Skipping batch input \"%s\", as it "
+                             "is also its output." % inName])
+        elif os.path.isfile(outName) and not cmd["overwrite"]:
+            print_msgs(cmd, ["WARNING: Skipping batch output \"%s\", as it "
+                             "already exists and -O was not used." %
+                             outName])
+        else:
+            yield inName, outName
+
+
+def read_manifest(fName):
+    """Iterator that yields the input and output file pairs in a manifest"""
+    with open(fName, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split("\t") if "\t" in line else line.split()
+            if len(fields) != 2:
+                print("ISSUE: Wrong batch manifest syntax at line \"%s\"" %
+                      line)
+                continue
+            yield fields[0].strip(), fields[1].strip()
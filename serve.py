@@ -0,0 +1,269 @@
+#!usr/bin/python
+
+"""Answer rearrange and inspect requests against sources kept in memory"""
+
+from __future__ import print_function
+
+import os
+import sys
+import stat
+import json
+import argparse
+import time
+import signal
+import threading
+import collections
+import SocketServer
+import options
+import buckets
+# only on POSIX, so memory stats are left out elsewhere
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# number of recent latencies kept per command for the median
+LATENCY_WINDOW = 1000
+
+# settings a request can change, since they don't change bucketing
+REQUEST_SETTINGS = ["random_seed", "jabberwocky", "jabberwocky_chance",
+                    "kick_chance", "truncate_whitespace",
+                    "truncate_multiple_newlines", "block_inspection_sort",
+                    "frequency_count", "frequency_percent",
+                    "decimal_accuracy", "count_minimum", "count_maximum",
+                    "percent_minimum", "percent_maximum"]
+
+
+def get_changes(args):
+    """
+    Return the settings a request's CLI style arguments change
+    Raise ValueError for arguments that can't change per request
+    Every argument given counts, even one set to its default
+    """
+    # parse_args only fills in defaults the namespace doesn't have yet,
+    # so anything still unset afterwards wasn't given
+    unset = object()
+    namespace = argparse.Namespace(**dict.fromkeys(
+        vars(options.parser.parse_args([])), unset))
+    try:
+        requested = vars(options.parser.parse_args(list(args), namespace))
+    except SystemExit:
+        raise ValueError("could not parse options \"%s\"" % " ".join(args))
+    changes = {}
+    for name, value in requested.items():
+        if value is unset:
+            continue
+        if name not in REQUEST_SETTINGS:
+            raise ValueError("--%s can't be changed per request" %
+                             name.replace("_", "-"))
+        changes[name] = value
+    # forking worker pools from request threads isn't safe
+    changes["workers"] = 1
+    return changes
+
+
+def get_size(dictionary, occurences):
+    """
+    Return roughly how many bytes a built dictionary takes up
+    Buckets are sized as they are stored, so none are prepared to be sized
+    """
+    seen = set()
+    total = 0
+    for obj in [dictionary, occurences] + occurences.keys():
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+    if isinstance(dictionary, buckets.PreparedDictionary):
+        dictionary = dictionary.dictionary
+        total += sys.getsizeof(dictionary)
+    for key, wordList in dictionary.items():
+        parts = [key, wordList]
+        if not isinstance(wordList, list):
+            parts += vars(wordList).values()
+        for part in parts:
+            if id(part) in seen:
+                continue
+            seen.add(id(part))
+            total += sys.getsizeof(part)
+            if isinstance(part, list):
+                for word in part:
+                    if id(word) not in seen:
+                        seen.add(id(word))
+                        total += sys.getsizeof(word)
+    return total
+
+
+def get_address(address):
+    """Return a localhost address for a port, or a Unix socket path"""
+    if address.isdigit():
+        return ("127.0.0.1", int(address))
+    return address
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Answer requests sent one JSON object per line, until disconnected
+    Each request gets back one line of JSON
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            start = time.time()
+            command = None
+            try:
+                request = json.loads(line)
+                command = request.get("command")
+                reply = self.answer(command, request)
+                reply["ok"] = True
+            except Exception as e:
+                reply = {"ok": False, "error": str(e)}
+            reply["seconds"] = time.time() - start
+            self.server.record(command, reply["seconds"], reply["ok"])
+            self.wfile.write(json.dumps(reply) + "\n")
+            self.wfile.flush()
+
+    def answer(self, command, request):
+        """Return the reply to a request"""
+        server = self.server
+        if command == "stats":
+            return server.get_stats()
+        if command not in server.COMMANDS:
+            raise ValueError("unknown command \"%s\"" % command)
+
+        name = request.get("source", "default")
+        if name not in server.sources:
+            raise ValueError("unknown source \"%s\"" % name)
+        rearranger = server.sources[name]
+        changes = get_changes(request.get("options", []))
+        if command == "inspect":
+            text = rearranger.inspect(changes=changes)
+            return {"text": text.decode("utf-8", "replace")}
+        text = request.get("text")
+        if not isinstance(text, basestring):
+            raise ValueError("rearrange needs text to rearrange")
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        # seeded requests draw from their own generator, and every
+        # request uses up its own copies of buckets, so none need a lock
+        text = rearranger.rearrange(text, changes=changes)
+        return {"text": text.decode("utf-8", "replace")}
+
+
+class Server(object):
+    """Sources built once, with stats on the requests made against them"""
+
+    COMMANDS = ("rearrange", "inspect", "stats")
+
+    def __init__(self, sources):
+        self.sources = sources
+        self.statsLock = threading.Lock()
+        self.requests = {}
+        self.sizes = {}
+        for name, rearranger in sources.items():
+            self.sizes[name] = get_size(rearranger.dictionary,
+                                        rearranger.occurences)
+
+    def record(self, command, seconds, ok):
+        """Add a request's latency to the stats of its command"""
+        with self.statsLock:
+            command = command if command in self.COMMANDS else "invalid"
+            stats = self.requests.get(command)
+            if stats is None:
+                stats = self.requests[command] = {
+                    "count": 0, "errors": 0, "total": 0.0, "max": 0.0,
+                    "recent": collections.deque(maxlen=LATENCY_WINDOW)}
+            stats["count"] += 1
+            if not ok:
+                stats["errors"] += 1
+            stats["total"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            stats["recent"].append(seconds)
+
+    def get_stats(self):
+        """Return latency stats for every command, and memory stats"""
+        requests = {}
+        with self.statsLock:
+            for command, stats in self.requests.items():
+                recent = sorted(stats["recent"])
+                requests[command] = {
+                    "count": stats["count"], "errors": stats["errors"],
+                    "mean": stats["total"] / stats["count"],
+                    "median": recent[len(recent) // 2],
+                    "max": stats["max"]}
+        sources = {}
+        for name, rearranger in self.sources.items():
+            sources[name] = {"words": rearranger.wordCount,
+                             "unique_words": len(rearranger.occurences),
+                             "buckets": len(rearranger.dictionary),
+                             "bytes": self.sizes[name]}
+        peak = None
+        if resource:
+            # ru_maxrss is in kilobytes on Linux
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return {"requests": requests, "sources": sources,
+                "peak_memory": peak}
+
+
+# Unix sockets aren't available everywhere, such as on Windows
+UnixServer = None
+if hasattr(SocketServer, "ThreadingUnixStreamServer"):
+    class UnixServer(Server, SocketServer.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, address, sources):
+            Server.__init__(self, sources)
+            SocketServer.ThreadingUnixStreamServer.__init__(self, address,
+                                                            RequestHandler)
+
+
+class TCPServer(Server, SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, sources):
+        Server.__init__(self, sources)
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+                                                 RequestHandler)
+
+
+def build_sources(cmd, rearrangerClass):
+    """Return a rearranger built for every served source, by name"""
+    filterName = cmd["filter"].name if cmd["filter"] else None
+    wordMapName = cmd["word_map"].name if cmd["word_map"] else None
+    sources = {}
+    for name, fName in cmd["serve_source"]:
+        settings = dict(cmd)
+        sources[name] = rearrangerClass(settings).build(fName, filterName,
+                                                        wordMapName)
+    return sources
+
+
+def serve(cmd, rearrangerClass):
+    """Build every served source, then answer requests until interrupted"""
+    address = get_address(cmd["serve"])
+    if not isinstance(address, tuple) and UnixServer is None:
+        sys.exit("ERROR: Unix sockets aren't supported here, so --serve "
+                 "needs a port instead.")
+    sources = build_sources(cmd, rearrangerClass)
+    if isinstance(address, tuple):
+        server = TCPServer(address, sources)
+    else:
+        # a socket left behind by an earlier server is replaced
+        if (os.path.exists(address) and
+                stat.S_ISSOCK(os.stat(address).st_mode)):
+            os.remove(address)
+        server = UnixServer(address, sources)
+
+    # stopping the server the usual way still cleans up its socket
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    options.print_msgs(cmd, ["NOTICE: Serving %d sources on %s." %
+                             (len(sources), cmd["serve"])])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if not isinstance(address, tuple) and os.path.exists(address):
+            os.remove(address)
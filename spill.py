@@ -0,0 +1,637 @@
+#!usr/bin/python
+
+"""Keep buckets and word counts on disk, for --memory-budget"""
+
+from __future__ import print_function
+
+import os
+import atexit
+import copy
+import heapq
+import bisect
+import sqlite3
+import tempfile
+import itertools
+import cPickle as pickle
+from array import array
+import buckets
+
+# words read between checks of how much memory the buckets use
+CHECK_TOKENS = 64 * 1024
+# occurences stored together, and read together by buckets read in place
+CHUNK_SIZE = 1024
+# rough bytes each stored occurence or unique word costs in memory
+ENTRY_BYTES = 8
+UNIQUE_WORD_BYTES = 96
+# rough bytes a loaded chunk costs, as each has its own copy of its words
+CHUNK_BYTES = CHUNK_SIZE * 48
+# rough bytes each occurence being sorted costs, with its key
+SORT_ENTRY_BYTES = 128
+# fewest occurences read together from each sorted run while merging them
+RUN_CHUNK_SIZE = 64
+# words taken from a bucket are stored apart, until there are this many
+# rows of them, or they come to this share of the bucket, after which the
+# bucket is stored again as it is, so they never take long to take again
+TAKEN_ROWS = 8
+TAKEN_SHARE = 1 / 8.0
+
+
+def get_bucket_bytes(wordList):
+    """Return roughly how many bytes a bucket takes up"""
+    if isinstance(wordList, buckets.OffsetBucket):
+        return len(wordList) * (wordList.offsets.itemsize +
+                                wordList.lengths.itemsize)
+    if isinstance(wordList, buckets.CountedBucket):
+        return len(wordList.words) * UNIQUE_WORD_BYTES
+    if isinstance(wordList, buckets.IndexedBucket):
+        return len(wordList.words) * ENTRY_BYTES * 3
+    return len(wordList) * ENTRY_BYTES
+
+
+class SpillStore(object):
+    """
+    Temporary database of buckets and word counts that didn't fit in memory
+    Each spill adds a run of partial buckets, stored in chunks, which are
+    merged in the order they were spilled, so every bucket keeps its
+    source order
+    A bucket is stored again, prepared, the first time it is loaded, and
+    words taken from it after that are stored apart, until there are
+    enough of them to store the bucket again as it is
+    Buckets are read and written a chunk at a time where they can be, so
+    only one chunk is ever held pickled
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.path = None
+        self.db = None
+        self.pid = None
+        # the process that made the database, the only one that writes
+        self.owner = None
+        # bucket keys are numbered, since there are only a few of them
+        self.keyIds = {}
+        # chunks read in place, which can fill half the budget
+        self.chunks = {}
+        self.cachedChunks = max(1, budget // 2 // CHUNK_BYTES)
+        self.runs = 0
+        # runs stored while sorting buckets
+        self.sortRuns = 0
+        self.written = 0
+
+    def connect(self):
+        """Return the database, opened again in forked processes"""
+        if self.path is None:
+            fd, self.path = tempfile.mkstemp(prefix="text-rearranger-",
+                                             suffix=".sqlite")
+            os.close(fd)
+            self.owner = os.getpid()
+            atexit.register(self.close)
+        if self.pid != os.getpid():
+            self.db = sqlite3.connect(self.path)
+            self.pid = os.getpid()
+            # the file is thrown away afterwards, so it never needs syncing
+            self.db.execute("PRAGMA journal_mode = OFF")
+            self.db.execute("PRAGMA synchronous = OFF")
+            self.db.execute("CREATE TABLE IF NOT EXISTS buckets (key INTEGER, "
+                            "run INTEGER, chunk INTEGER, prepared INTEGER, "
+                            "count INTEGER, bucket BLOB)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS bucket_keys "
+                            "ON buckets (key, run, chunk)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS taken "
+                            "(key INTEGER, words BLOB)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS taken_keys "
+                            "ON taken (key)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS counts "
+                            "(word BLOB PRIMARY KEY, count INTEGER)")
+        return self.db
+
+    def close(self):
+        """Delete the database, only from the process that made it"""
+        if self.path is None or self.pid != os.getpid():
+            return
+        self.db.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self.path = None
+
+    def get_size(self, dictionary, occurences):
+        """Return roughly how many bytes buckets and word counts take up"""
+        return (sum(get_bucket_bytes(wordList) for wordList in
+                    dictionary.itervalues()) +
+                len(occurences) * UNIQUE_WORD_BYTES)
+
+    def check(self, dictionary, occurences):
+        """Spill buckets and word counts if they are over budget"""
+        if self.get_size(dictionary, occurences) > self.budget:
+            self.spill(dictionary, occurences)
+
+    def watch(self, items, dictionary, occurences, every=CHECK_TOKENS):
+        """
+        Iterator that yields items while a dictionary is filled from them,
+        spilling it after every so many items if it is over budget
+        """
+        items = iter(items)
+        while True:
+            chunk = list(itertools.islice(items, every))
+            if not chunk:
+                return
+            for item in chunk:
+                yield item
+            self.check(dictionary, occurences)
+
+    def spill(self, dictionary, occurences):
+        """Move every bucket and word count into the database"""
+        db = self.connect()
+        run = self.runs
+        self.runs += 1
+        for key in dictionary:
+            if key not in self.keyIds:
+                self.keyIds[key] = len(self.keyIds)
+        db.executemany("INSERT INTO buckets VALUES (?, ?, ?, 0, ?, ?)",
+                       ((self.keyIds[key], run, chunk, len(piece),
+                         self.dump(piece))
+                        for key, wordList in dictionary.iteritems()
+                        for chunk, piece in enumerate(
+                            buckets.split_bucket(wordList, CHUNK_SIZE))))
+        db.executemany("INSERT OR IGNORE INTO counts VALUES (?, 0)",
+                       ((buffer(word),) for word in occurences))
+        db.executemany("UPDATE counts SET count = count + ? WHERE word = ?",
+                       ((count, buffer(word))
+                        for word, count in occurences.iteritems()))
+        db.commit()
+        dictionary.clear()
+        occurences.clear()
+
+    def dump(self, wordList):
+        """Return a bucket pickled to be stored"""
+        data = pickle.dumps(wordList, pickle.HIGHEST_PROTOCOL)
+        self.written += len(data)
+        return buffer(data)
+
+    def load(self, key):
+        """
+        Return a bucket merged from every run it was spilled in, and
+        whether it was already prepared, or None if it was never spilled
+        """
+        if key not in self.keyIds:
+            return None, False
+        rows = self.get_chunks(key)
+        merged = None
+        prepared = False
+        # chunks are pickled apart, so each would have its own copy of
+        # every word otherwise
+        shared = {}
+        for rowId, _, prepared in rows:
+            wordList = self.read_chunk(rowId)
+            if isinstance(wordList, list):
+                wordList = [shared.setdefault(word, word) for word in wordList]
+            elif isinstance(wordList, (buckets.IndexedBucket,
+                                       buckets.GroupedBucket)):
+                wordList.words = [shared.setdefault(word, word)
+                                  for word in wordList.words]
+            # merged a chunk at a time, so only one is ever held apart
+            if merged is None:
+                merged = buckets.empty_bucket(wordList)
+            buckets.merge_bucket(merged, wordList)
+        return merged, bool(prepared)
+
+    def read_chunk(self, rowId):
+        """Return one stored chunk of a bucket, or a run being sorted"""
+        data, = self.connect().execute(
+            "SELECT bucket FROM buckets WHERE rowid = ?", (rowId,)).fetchone()
+        return pickle.loads(str(data))
+
+    def load_chunk(self, rowId):
+        """Return one stored chunk of a bucket, keeping recent ones loaded"""
+        wordList = self.chunks.get(rowId)
+        if wordList is None:
+            if len(self.chunks) >= self.cachedChunks:
+                self.chunks = {}
+            wordList = self.chunks[rowId] = self.read_chunk(rowId)
+        return wordList
+
+    def get_chunks(self, key):
+        """
+        Return the row of every chunk of a bucket, its occurences, and
+        whether it was prepared
+        """
+        return self.connect().execute(
+            "SELECT rowid, count, prepared FROM buckets WHERE key = ? "
+            "ORDER BY run, chunk", (self.keyIds[key],)).fetchall()
+
+    def replace(self, key, wordList):
+        """
+        Store a prepared bucket as it is now, in place of every run of it
+        and every word taken from it
+        """
+        # forked workers only ever read buckets
+        if self.owner != os.getpid():
+            return
+        db = self.connect()
+        keyId = self.keyIds[key]
+        self.clear(keyId)
+        db.executemany("INSERT INTO buckets VALUES (?, 0, ?, 1, ?, ?)",
+                       ((keyId, chunk, len(piece), self.dump(piece))
+                        for chunk, piece in enumerate(
+                            buckets.split_bucket(wordList, CHUNK_SIZE))))
+        db.commit()
+
+    def clear(self, keyId):
+        """Delete every run of a bucket, and every word taken from it"""
+        db = self.connect()
+        db.execute("DELETE FROM buckets WHERE key = ?", (keyId,))
+        db.execute("DELETE FROM taken WHERE key = ?", (keyId,))
+        # row ids can be used again once they are deleted
+        self.chunks = {}
+
+    def sort(self, key, sortKey, reverse=False):
+        """
+        Store a bucket of words sorted, in the same order sorted would give,
+        then reversed afterwards if asked, like list.reverse
+        Sorted a run that fills half the budget at a time, then merged back
+        together with every run read a small chunk at a time, in as few
+        passes as fit in the other half, so it is never loaded whole
+        """
+        # forked workers only ever read buckets
+        if self.owner != os.getpid():
+            return
+        db = self.connect()
+        keyId = self.keyIds[key]
+        rows = self.get_chunks(key)
+        runSize = max(CHUNK_SIZE, self.budget // 2 // SORT_ENTRY_BYTES)
+        runCount = -(-sum(count for _, count, _ in rows) // runSize)
+        # runs are read in chunks small enough to merge them all at once,
+        # where that doesn't make them too small to read quickly
+        runChunk = max(RUN_CHUNK_SIZE, runSize // max(runCount, 1))
+        merging = max(2, runSize // runChunk)
+        # runs are cut in order, so words with equal keys keep their order
+        # as long as runs are only ever merged with the ones beside them
+        runs = []
+        run = []
+        for rowId, _, _ in rows:
+            run.extend(self.read_chunk(rowId))
+            while len(run) >= runSize:
+                words = run[:runSize]
+                del run[:runSize]
+                words.sort(key=sortKey)
+                runs.append(self.add_run(words, runChunk))
+        run.sort(key=sortKey)
+        runs.append(self.add_run(run, runChunk))
+        while len(runs) > merging:
+            merged = []
+            for i in xrange(0, len(runs), merging):
+                merged.append(self.add_run(
+                    self.merge_runs(runs[i:i + merging], sortKey), runChunk))
+                for run in runs[i:i + merging]:
+                    self.clear(run)
+            runs = merged
+        self.clear(keyId)
+        words = self.merge_runs(runs, sortKey)
+        pieces = iter(lambda: list(itertools.islice(words, CHUNK_SIZE)), [])
+        if reverse:
+            # chunks are stored reversed, and numbered back from the end
+            pieces = ((-chunk, piece[::-1])
+                      for chunk, piece in enumerate(pieces))
+        else:
+            pieces = enumerate(pieces)
+        db.executemany("INSERT INTO buckets VALUES (?, 0, ?, 1, ?, ?)",
+                       ((keyId, chunk, len(piece), self.dump(piece))
+                        for chunk, piece in pieces))
+        for run in runs:
+            self.clear(run)
+        db.commit()
+
+    def add_run(self, words, size):
+        """
+        Store sorted words as a run, in chunks of a given size, under a
+        key of its own below any bucket's, and return that key
+        """
+        db = self.connect()
+        self.sortRuns += 1
+        run = -self.sortRuns
+        words = iter(words)
+        for chunk, piece in enumerate(iter(
+                lambda: list(itertools.islice(words, size)), [])):
+            db.execute("INSERT INTO buckets VALUES (?, 0, ?, 0, ?, ?)",
+                       (run, chunk, len(piece), self.dump(piece)))
+        return run
+
+    def read_run(self, run):
+        """Iterator that yields the words of a run, a chunk at a time"""
+        rowIds = self.connect().execute(
+            "SELECT rowid FROM buckets WHERE key = ? ORDER BY chunk",
+            (run,)).fetchall()
+        for rowId, in rowIds:
+            for word in self.read_chunk(rowId):
+                yield word
+
+    def merge_runs(self, runs, sortKey):
+        """
+        Return an iterator over the words of sorted runs merged together,
+        with words of equal keys taken from earlier runs first
+        """
+        return itertools.chain.from_iterable(self.merge_groups(runs,
+                                                               sortKey))
+
+    def merge_groups(self, runs, sortKey):
+        """
+        Iterator that yields the words of sorted runs merged together, in
+        lists of words with equal keys from one run at a time
+        """
+        # like heapq.merge, but only keys and run order are ever compared,
+        # and only once for every run of words sharing a key
+        heap = []
+        for order, run in enumerate(runs):
+            groups = itertools.groupby(self.read_run(run), sortKey)
+            for groupKey, words in groups:
+                heap.append([groupKey, order, list(words), groups])
+                break
+        heapq.heapify(heap)
+        while heap:
+            entry = heap[0]
+            yield entry[2]
+            for groupKey, words in entry[3]:
+                entry[0] = groupKey
+                entry[2] = list(words)
+                heapq.heapreplace(heap, entry)
+                break
+            else:
+                heapq.heappop(heap)
+
+    def add_taken(self, key, taken):
+        """Store words taken from a bucket since it was last stored"""
+        db = self.connect()
+        db.execute("INSERT INTO taken VALUES (?, ?)",
+                   (self.keyIds[key], self.dump(taken)))
+        db.commit()
+
+    def get_taken(self, key):
+        """Return every word taken from a bucket, in the order they were"""
+        taken = []
+        for data, in self.connect().execute(
+                "SELECT words FROM taken WHERE key = ? ORDER BY rowid",
+                (self.keyIds[key],)):
+            taken.extend(pickle.loads(str(data)))
+        return taken
+
+    def describe(self):
+        """Return a summary of how much was spilled to disk"""
+        return "spill: %d runs, %.1f MB written to disk" % (
+            self.runs, self.written / 1024.0 / 1024.0)
+
+
+class SpilledDictionary(object):
+    """
+    Dictionary of spilled buckets, each loaded the first time it is gotten
+    Loaded buckets are kept in two generations, like a token cache, and
+    the older one is dropped once the newer one fills half the budget
+    Words taken from buckets are written back when they are dropped, and
+    taken again when they are loaded, so they stay taken
+    Modes that only ever pick words, or pop them off the end, read
+    buckets in place instead, so only the chunks words come from are
+    loaded, once each bucket is prepared
+    Buckets that only need sorting are sorted on disk, whichever way
+    they are read afterwards
+    """
+
+    def __init__(self, store, text=None):
+        self.store = store
+        self.text = text
+        # set by prepare_dictionary
+        self.prepare = None
+        self.inPlace = False
+        # buckets of words that only need sorting, which prepare then
+        # does on disk, given them read in place
+        self.sortInPlace = False
+        self.views = {}
+        self.recent = {}
+        self.older = {}
+        self.recentBytes = 0
+        # length of each loaded bucket, to tell how many words were popped
+        self.lengths = {}
+        # rows and words taken from each bucket since it was last stored
+        self.taken = {}
+
+    def __len__(self):
+        return len(self.store.keyIds)
+
+    def __contains__(self, key):
+        return key in self.store.keyIds
+
+    def keys(self):
+        return self.store.keyIds.keys()
+
+    def get(self, key, default=None):
+        wordList = self.recent.get(key)
+        if wordList is not None:
+            return wordList
+        wordList = self.older.pop(key, None)
+        if wordList is None:
+            wordList = self.views.get(key)
+            if wordList is not None:
+                return wordList
+            if key not in self.store.keyIds:
+                return default
+            if self.inPlace:
+                wordList = self.view(key)
+            if wordList is not None:
+                self.views[key] = wordList
+                return wordList
+            wordList = self.load(key)
+        self.keep(key, wordList)
+        return wordList
+
+    def load(self, key):
+        """Return a bucket from the store, prepared as the mode needs"""
+        if self.sort_in_place(key):
+            self.prepare(key, SpilledBucket(self.store, key, self.text))
+        wordList, prepared = self.store.load(key)
+        if isinstance(wordList, buckets.OffsetBucket):
+            wordList.text = self.text
+        if not prepared:
+            if self.prepare is not None:
+                wordList = self.prepare(key, wordList)
+                if isinstance(wordList, buckets.OffsetBucket):
+                    wordList.text = self.text
+            # stored before any words are taken from it, so it is only
+            # merged and prepared once
+            self.store.replace(key, wordList)
+        take_again(wordList, self.store.get_taken(key))
+        if isinstance(wordList, (buckets.CountedBucket,
+                                 buckets.IndexedBucket)):
+            wordList.log = []
+        self.lengths[key] = len(wordList)
+        return wordList
+
+    def view(self, key):
+        """
+        Return a bucket read in place, prepared first if the mode needs,
+        or None if it still needs preparing and can't be stored again
+        """
+        if self.sort_in_place(key):
+            return self.prepare(key, SpilledBucket(self.store, key, self.text))
+        if self.prepare is not None and not self.store.get_chunks(key)[0][2]:
+            # forked workers only ever read buckets
+            if self.store.owner != os.getpid():
+                return None
+            wordList, _ = self.store.load(key)
+            if isinstance(wordList, buckets.OffsetBucket):
+                wordList.text = self.text
+            self.store.replace(key, self.prepare(key, wordList))
+        return SpilledBucket(self.store, key, self.text)
+
+    def sort_in_place(self, key):
+        """Return whether a bucket still needs sorting, and can be on disk"""
+        return (self.sortInPlace and self.store.owner == os.getpid() and
+                not self.store.get_chunks(key)[0][2])
+
+    def get_taken(self, key, wordList):
+        """Return the words taken from a loaded bucket since last asked"""
+        if isinstance(wordList, (buckets.CountedBucket,
+                                 buckets.IndexedBucket)):
+            taken = wordList.log
+            wordList.log = []
+        else:
+            # lists and offset buckets only ever have words popped
+            taken = [None] * (self.lengths[key] - len(wordList))
+        self.lengths[key] = len(wordList)
+        return taken
+
+    def keep(self, key, wordList):
+        """Keep a loaded bucket, dropping the older ones if over budget"""
+        size = get_bucket_bytes(wordList)
+        # a bucket bigger than the budget still gets a generation to itself
+        if self.recent and (self.recentBytes + size) * 2 > self.store.budget:
+            for oldKey, oldList in self.older.iteritems():
+                taken = self.get_taken(oldKey, oldList)
+                # forked workers only ever read buckets
+                if taken and self.store.owner == os.getpid():
+                    self.put_back(oldKey, oldList, taken)
+            self.older = self.recent
+            self.recent = {}
+            self.recentBytes = 0
+        self.recent[key] = wordList
+        self.recentBytes += size
+
+    def put_back(self, key, wordList, taken):
+        """
+        Store the words taken from a dropped bucket, or the bucket as it
+        is now once taking them all again would take too long
+        """
+        rows, words = self.taken.get(key, (0, 0))
+        rows += 1
+        words += len(taken)
+        if rows > TAKEN_ROWS or words > len(wordList) * TAKEN_SHARE:
+            self.store.replace(key, wordList)
+            self.taken.pop(key, None)
+        else:
+            self.store.add_taken(key, taken)
+            self.taken[key] = (rows, words)
+
+
+def take_again(wordList, taken):
+    """Take words out of a bucket again, as logged by buckets"""
+    for word in taken:
+        if word is None:
+            wordList.pop()
+        elif isinstance(word, int):
+            wordList.take(word)
+        else:
+            wordList.remove(word)
+
+
+class SpilledBucket(object):
+    """
+    Bucket read a chunk at a time straight from the store
+    Only supports what picking a random occurence, or popping the last
+    one, needs, and popped words are only left out of this bucket
+    """
+
+    def __init__(self, store, key, text=None):
+        self.store = store
+        self.key = key
+        self.text = text
+        rows = store.get_chunks(key)
+        self.rowIds = array("l", [row[0] for row in rows])
+        # the first occurence in each chunk
+        self.starts = array("l")
+        self.total = 0
+        for _, count, _ in rows:
+            self.starts.append(self.total)
+            self.total += count
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, occurence):
+        if occurence < 0:
+            occurence += self.total
+        if occurence < 0 or occurence >= self.total:
+            raise IndexError("bucket index out of range")
+        chunk = bisect.bisect_right(self.starts, occurence) - 1
+        wordList = self.store.load_chunk(self.rowIds[chunk])
+        if isinstance(wordList, buckets.OffsetBucket):
+            wordList.text = self.text
+        return wordList[occurence - self.starts[chunk]]
+
+    def __iter__(self):
+        for occurence in xrange(self.total):
+            yield self[occurence]
+
+    def pop(self):
+        """Remove and return the last occurence, like list.pop"""
+        if not self.total:
+            raise IndexError("pop from empty bucket")
+        word = self[-1]
+        self.total -= 1
+        return word
+
+    def copy(self):
+        """Return a copy that can be popped from without changing this one"""
+        # chunks are never changed, so they can be shared
+        return copy.copy(self)
+
+    def sort(self, key, reverse=False):
+        """Sort in place, on disk, the same way list.sort would"""
+        self.store.sort(self.key, key, reverse)
+        self.__init__(self.store, self.key, self.text)
+
+
+class SpilledCounts(object):
+    """
+    Word counts kept in the store, read like the dict they replace
+    Inspecting them still loads every unique word, so -I needs memory for
+    the whole vocabulary even under a budget
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.connect().execute(
+            "SELECT COUNT(*) FROM counts").fetchone()[0]
+
+    def get(self, word, default=None):
+        row = self.store.connect().execute(
+            "SELECT count FROM counts WHERE word = ?",
+            (buffer(word),)).fetchone()
+        return default if row is None else row[0]
+
+    def keys(self):
+        return [str(word) for word, in self.store.connect().execute(
+            "SELECT word FROM counts ORDER BY rowid")]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def itervalues(self):
+        for count, in self.store.connect().execute(
+                "SELECT count FROM counts ORDER BY rowid"):
+            yield count
+
+    def items(self):
+        return [(str(word), count) for word, count in
+                self.store.connect().execute(
+                    "SELECT word, count FROM counts ORDER BY rowid")]
@@ -0,0 +1,169 @@
+#!usr/bin/python
+
+"""Check buckets act like the lists of words they replace"""
+
+from __future__ import print_function
+
+import os
+import sys
+import random
+import unittest
+import collections
+import cPickle as pickle
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import buckets
+
+
+def counted(words):
+    """Return a counted bucket of words"""
+    bucket = buckets.CountedBucket()
+    for word in words:
+        bucket.append(word)
+    return bucket
+
+
+def grouped(words, order):
+    """Return words as a list, grouped by word in a given order"""
+    counts = collections.Counter(words)
+    return [word for word in order for _ in range(counts[word])]
+
+
+class CountedBucketTest(unittest.TestCase):
+
+    WORDS = ["the"] * 50 + ["cat"] * 30 + ["sat"] * 15 + ["mat"] * 5
+
+    def setUp(self):
+        self.words = list(self.WORDS)
+        random.Random(1).shuffle(self.words)
+
+    def test_occurences_index_like_a_grouped_list(self):
+        bucket = counted(self.words)
+        expected = grouped(self.words, bucket.words)
+        self.assertEqual(len(bucket), len(expected))
+        self.assertEqual([bucket[i] for i in range(len(bucket))], expected)
+        self.assertEqual(list(bucket), expected)
+        self.assertEqual(bucket[-1], expected[-1])
+        with self.assertRaises(IndexError):
+            bucket[len(expected)]
+
+    def test_draws_follow_counts(self):
+        bucket = counted(self.words)
+        rng = random.Random(2)
+        draws = collections.Counter(bucket[rng.randint(0, len(bucket) - 1)]
+                                    for _ in range(20000))
+        for word, count in collections.Counter(self.words).items():
+            self.assertAlmostEqual(draws[word] / 20000.0,
+                                   count / float(len(self.words)),
+                                   delta=0.015)
+
+    def test_removals_match_a_list(self):
+        bucket = counted(self.words)
+        # built before removing, so every removal has to update it
+        bucket[0]
+        left = list(self.words)
+        rng = random.Random(3)
+        while left:
+            step = rng.randint(0, 2)
+            if step == 0:
+                word = rng.choice(left)
+                bucket.remove(word)
+            elif step == 1:
+                word = bucket.pop()
+            else:
+                word = buckets.take_random(bucket, rng)
+            left.remove(word)
+            self.assertEqual(len(bucket), len(left))
+            self.assertEqual([bucket[i] for i in range(len(bucket))],
+                             grouped(left, bucket.words))
+        with self.assertRaises(IndexError):
+            bucket.pop()
+        with self.assertRaises(ValueError):
+            bucket.remove("the")
+
+    def test_random_other_skips_the_word(self):
+        bucket = counted(self.words)
+        rng = random.Random(4)
+        draws = collections.Counter(bucket.random_other("the", rng)
+                                    for _ in range(10000))
+        self.assertNotIn("the", draws)
+        others = len(self.words) - self.words.count("the")
+        for word in ("cat", "sat", "mat"):
+            self.assertAlmostEqual(draws[word] / 10000.0,
+                                   self.words.count(word) / float(others),
+                                   delta=0.02)
+        self.assertEqual(counted(["the", "the"]).random_other("the"), "the")
+
+    def test_copies_are_used_up_apart(self):
+        bucket = counted(self.words)
+        bucket[0]
+        copy = bucket.copy()
+        while copy:
+            copy.pop()
+        self.assertEqual(len(bucket), len(self.words))
+        self.assertEqual(list(bucket), grouped(self.words, bucket.words))
+
+
+def offsets(text):
+    """Return an offset bucket of every word in text, and the words"""
+    bucket = buckets.OffsetBucket(text)
+    words = []
+    position = 0
+    for word in text.split(" "):
+        bucket.add(position, len(word))
+        words.append(word)
+        position += len(word) + 1
+    return bucket, words
+
+
+class OffsetBucketTest(unittest.TestCase):
+
+    TEXT = " ".join(CountedBucketTest.WORDS + ["The", "CAT", "x" * 300])
+
+    def test_occurences_index_like_a_list(self):
+        bucket, words = offsets(self.TEXT)
+        self.assertEqual(len(bucket), len(words))
+        self.assertEqual(list(bucket), words)
+        self.assertEqual([bucket[i] for i in range(len(bucket))], words)
+        self.assertEqual(bucket[-1], words[-1])
+        # too long for a byte, so lengths were widened
+        self.assertEqual(bucket.lengths.typecode, "L")
+        self.assertEqual(bucket.pop(), words.pop())
+        self.assertEqual(list(bucket), words)
+
+    def test_sort_and_shuffle_match_a_list(self):
+        bucket, words = offsets(self.TEXT)
+        bucket.shuffle(random.Random(5))
+        random.Random(5).shuffle(words)
+        self.assertEqual(list(bucket), words)
+        bucket.sort(str.lower, reverse=True)
+        words = sorted(words, key=str.lower)
+        words.reverse()
+        self.assertEqual(list(bucket), words)
+
+    def test_copies_and_pieces_are_used_up_apart(self):
+        bucket, words = offsets(self.TEXT)
+        copy = bucket.copy()
+        while copy:
+            copy.pop()
+        self.assertEqual(list(bucket), words)
+        pieces = list(buckets.split_bucket(bucket, 7))
+        self.assertTrue(len(pieces) > 1)
+        merged = buckets.empty_bucket(bucket)
+        for piece in pieces:
+            buckets.merge_bucket(merged, piece)
+        self.assertEqual(list(merged), words)
+
+    def test_pickles_without_the_source(self):
+        bucket, words = offsets(self.TEXT)
+        loaded = pickle.loads(pickle.dumps(bucket, pickle.HIGHEST_PROTOCOL))
+        self.assertIsNone(loaded.text)
+        buckets.attach_source({"key": loaded}, self.TEXT)
+        self.assertEqual(list(loaded), words)
+        shared = loaded.shared_words()
+        self.assertEqual(shared, words)
+        self.assertIs(shared[0], shared[shared.index("the", 1)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+#!usr/bin/python
+
+"""Check how built dictionaries are keyed and loaded from the cache"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import cPickle as pickle
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import options
+import cache
+import textrearranger
+
+
+class Stale(object):
+    """Stands in for a class a cached dictionary used to be made of"""
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.source = self.write("source.txt", "the quick brown fox\n")
+        self.filter = self.write("filter.txt", "fox\n")
+
+    def write(self, name, text):
+        """Write a file in the test folder, and return its path"""
+        path = os.path.join(self.folder, name)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def key(self, **settings):
+        """Return the cache key for settings and the test files"""
+        cmd = options.get_settings(cache_dir=self.folder, **settings)
+        cmd["source"] = open(self.source, "r")
+        cmd["filter"] = open(self.filter, "r")
+        try:
+            return cache.get_cache_key(cmd)
+        finally:
+            cmd["source"].close()
+            cmd["filter"].close()
+
+    def test_same_build_same_key(self):
+        self.assertEqual(self.key(), self.key())
+        self.assertEqual(self.key(filter_same=True),
+                         self.key(filter_same=True))
+
+    def test_bucket_settings_change_key(self):
+        key = self.key()
+        for setting in cache.BUCKET_SETTINGS:
+            self.assertNotEqual(self.key(**{setting: True}), key, setting)
+
+    def test_usage_limits_change_key_with_get_different(self):
+        self.assertEqual(self.key(limited_usage=True), self.key())
+        key = self.key(get_different=True)
+        self.assertNotEqual(self.key(get_different=True, limited_usage=True),
+                            key)
+        self.assertNotEqual(
+            self.key(get_different=True, force_limited_usage=True), key)
+
+    def test_files_change_key(self):
+        key = self.key()
+        filterKey = self.key(filter_same=True)
+        self.write("source.txt", "the quick brown dog\n")
+        self.assertNotEqual(self.key(), key)
+        key = self.key()
+        self.write("filter.txt", "dog\n")
+        self.assertNotEqual(self.key(filter_same=True), filterKey)
+        # the filter only matters when it is used
+        self.assertEqual(self.key(), key)
+
+    def test_unchanged_files_are_not_hashed_again(self):
+        # files changed only just now are always hashed
+        key = self.key()
+        self.assertNotIn(os.path.realpath(self.source),
+                         cache.load_hashes(options.get_settings(
+                             cache_dir=self.folder)))
+        past = time.time() - 60
+        os.utime(self.source, (past, past))
+        self.assertEqual(self.key(), key)
+        hashFile = cache.hash_file
+        try:
+            cache.hash_file = None
+            self.assertEqual(self.key(), key)
+        finally:
+            cache.hash_file = hashFile
+        # the same size, but changed later
+        self.write("source.txt", "the quick brown dog\n")
+        os.utime(self.source, (past + 1, past + 1))
+        self.assertNotEqual(self.key(), key)
+
+    def test_cache_is_only_used_when_asked(self):
+        for args, cached in (([], False), (["--cache"], True),
+                             (["--cache", "--no-cache"], False)):
+            folder = os.path.join(self.folder, "cache")
+            cmd = options.get_settings(args, cache_dir=folder)
+            cmd["source"] = open(self.source, "r")
+            try:
+                textrearranger.Rearranger(cmd).build()
+            finally:
+                cmd["source"].close()
+            self.assertEqual(os.path.isdir(folder) and
+                             any(fName.endswith(".pickle")
+                                 for fName in os.listdir(folder)),
+                             cached, args)
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def test_inspection_index_is_only_sorted_once(self):
+        folder = os.path.join(self.folder, "cache")
+        reports = []
+        for cached in (False, True):
+            cmd = options.get_settings(["-I", "-q", "--cache", "-L"],
+                                       cache_dir=folder)
+            rearranger = textrearranger.Rearranger(cmd).build(self.source)
+            if cached:
+                self.addCleanup(setattr, textrearranger, "get_metadata_key",
+                                textrearranger.get_metadata_key)
+                textrearranger.get_metadata_key = None
+            reports.append(rearranger.inspect())
+        self.assertEqual(reports[1], reports[0])
+        self.assertIn("quick {count: 1}", reports[0])
+        self.assertTrue(any(fName.endswith(cache.INDEX_SUFFIX + ".pickle")
+                            for fName in os.listdir(folder)))
+
+    def test_standard_input_is_not_cached(self):
+        cmd = options.get_settings()
+        cmd["source"] = sys.stdin
+        self.assertIsNone(cache.get_cache_key(cmd))
+
+    def test_stored_data_loads(self):
+        cmd = options.get_settings(cache_dir=self.folder)
+        data = (set(["fox"]), {("", "", ""): ["fox"]}, {"fox": 1}, 1)
+        self.assertEqual(cache.store(cmd, "key", data), [])
+        self.assertEqual(cache.load(cmd, "key"), data)
+
+    def test_unreadable_data_is_thrown_away(self):
+        cmd = options.get_settings(cache_dir=self.folder)
+        data = pickle.dumps(({}, {}, {}, 0), pickle.HIGHEST_PROTOCOL)
+        stale = pickle.dumps(Stale(), pickle.HIGHEST_PROTOCOL).replace(
+            "Stale", "Gone!")
+        for name, contents in (("corrupt", "not a pickle"),
+                               ("truncated", data[:len(data) // 2]),
+                               ("stale", stale)):
+            path = self.write(name + ".pickle", contents)
+            self.assertIsNone(cache.load(cmd, name), name)
+            self.assertFalse(os.path.exists(path), name)
+
+
+if __name__ == "__main__":
+    unittest.main()
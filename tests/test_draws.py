@@ -0,0 +1,101 @@
+#!usr/bin/python
+
+"""Check random numbers drawn in batches for --numpy-random"""
+
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+import itertools
+import collections
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import options
+import draws
+import textrearranger
+
+SOURCE = ("the quick brown fox jumps over the lazy dog while a bird sings "
+          "and every other animal in the wood goes about its day\n") * 20
+ARGS = [["-U"], ["-e"], ["-J", "-j", "30"], ["-k", "25"],
+        ["-U", "-J", "-j", "50", "-k", "10"]]
+
+
+def rearrange(args, text=SOURCE):
+    """Return text rearranged against SOURCE with CLI style arguments"""
+    settings = options.get_settings(args, no_cache=True)
+    return textrearranger.Rearranger(settings).build(
+        StringIO(SOURCE)).rearrange(text)
+
+
+class FallbackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, draws, "numpy", draws.numpy)
+        draws.numpy = False
+
+    def test_missing_numpy_gives_notice(self):
+        cmd = vars(options.parser.parse_args(["--numpy-random"]))
+        self.assertTrue(any("--numpy-random" in msg
+                            for msg in options.validate_command(cmd)))
+        cmd = vars(options.parser.parse_args([]))
+        self.assertFalse(any("--numpy-random" in msg
+                             for msg in options.validate_command(cmd)))
+
+    def test_missing_numpy_matches_plain_random(self):
+        for args in ARGS:
+            args = args + ["-R", "3"]
+            self.assertEqual(rearrange(args + ["--numpy-random"]),
+                             rearrange(args), args)
+
+
+@unittest.skipUnless(draws.available(), "NumPy is not installed")
+class NumpyRandomTest(unittest.TestCase):
+
+    def test_streams_follow_their_seed(self):
+        count = draws.BATCH_SIZE + 100
+        rolls = list(itertools.islice(draws.percent_rolls(1), count))
+        self.assertEqual(list(itertools.islice(draws.percent_rolls(1),
+                                               count)), rolls)
+        self.assertNotEqual(list(itertools.islice(draws.percent_rolls(2),
+                                                  count)), rolls)
+        self.assertEqual(min(rolls), 0)
+        self.assertEqual(max(rolls), 99)
+        fractions = list(itertools.islice(draws.fractions(1), count))
+        self.assertTrue(all(0 <= fraction < 1 for fraction in fractions))
+
+    def test_seeded_output_repeats(self):
+        for args in ARGS:
+            args = args + ["-R", "3", "--numpy-random"]
+            self.assertEqual(rearrange(args), rearrange(args), args)
+
+    def test_words_and_lines_match_plain_random(self):
+        for args in ARGS:
+            args = args + ["-R", "3"]
+            plain = rearrange(args)
+            batched = rearrange(args + ["--numpy-random"])
+            self.assertEqual(len(batched.split()), len(plain.split()), args)
+        self.assertEqual(rearrange(["-u", "-T", "-R", "3",
+                                    "--numpy-random"]),
+                         rearrange(["-u", "-T", "-R", "3"]))
+        kicked = rearrange(["-H", "-k", "100", "--numpy-random"])
+        self.assertEqual(kicked, rearrange(["-H", "-k", "100"]))
+        self.assertEqual(kicked.split(), SOURCE.split())
+        self.assertEqual(kicked.count("\n"),
+                         len(SOURCE.split()) + SOURCE.count("\n"))
+
+    def test_relative_picks_match_plain_random(self):
+        text = "the " * 20000
+        plain = collections.Counter(rearrange(["-U", "-R", "3"],
+                                              text).split())
+        batched = collections.Counter(
+            rearrange(["-U", "-R", "3", "--numpy-random"], text).split())
+        self.assertEqual(set(batched), set(plain))
+        for word, count in plain.items():
+            self.assertAlmostEqual(batched[word] / 20000.0, count / 20000.0,
+                                   delta=0.015)
+
+
+if __name__ == "__main__":
+    unittest.main()
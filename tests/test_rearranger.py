@@ -0,0 +1,935 @@
+#!usr/bin/python
+
+"""Check rearranging through the Rearranger API"""
+
+from __future__ import print_function
+
+import os
+import sys
+import random
+import pstats
+import shutil
+import tempfile
+import subprocess
+import threading
+import collections
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import options
+import buckets
+import textrearranger
+
+SOURCE = ("the quick brown fox jumps over the lazy dog while a bird sings "
+          "and every other animal in the wood goes about its day\n") * 20
+
+
+class RearrangeTest(unittest.TestCase):
+
+    def build(self, args):
+        """Return a rearranger built from SOURCE with CLI style arguments"""
+        settings = options.get_settings(args, no_cache=True)
+        return textrearranger.Rearranger(settings).build(StringIO(SOURCE))
+
+    def test_limited_usage_follows_call_seed(self):
+        rearranger = self.build(["-u"])
+        first = rearranger.rearrange(SOURCE, changes={"random_seed": 1})
+        second = rearranger.rearrange(SOURCE, changes={"random_seed": 2})
+        again = rearranger.rearrange(SOURCE, changes={"random_seed": 1})
+        self.assertNotEqual(first, second)
+        self.assertEqual(first, again)
+
+    def test_seeded_build_leaves_random_alone(self):
+        random.seed(5)
+        expected = [random.random() for _ in range(3)]
+        random.seed(5)
+        rearranger = self.build(["-u", "-R", "1"])
+        first = rearranger.rearrange(SOURCE)
+        self.assertEqual([random.random() for _ in range(3)], expected)
+        self.assertEqual(self.build(["-u", "-R", "1"]).rearrange(SOURCE),
+                         first)
+
+    def test_limited_usage_calls_differ_without_seed(self):
+        rearranger = self.build(["-u"])
+        self.assertNotEqual(rearranger.rearrange(SOURCE),
+                            rearranger.rearrange(SOURCE))
+
+    def test_seeded_calls_at_once_match_calls_in_turn(self):
+        rearranger = self.build(["-u", "-k", "10", "-J", "-j", "20"])
+        seeds = range(1, 9)
+        expected = [rearranger.rearrange(SOURCE * 10,
+                                         changes={"random_seed": seed})
+                    for seed in seeds]
+        results = {}
+
+        def call(seed):
+            results[seed] = rearranger.rearrange(
+                SOURCE * 10, changes={"random_seed": seed})
+
+        threads = [threading.Thread(target=call, args=(seed,))
+                   for seed in seeds]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([results[seed] for seed in seeds], expected)
+
+    def test_force_limited_usage_keeps_word_count_with_workers(self):
+        for args in (["-e", "-U", "-l"], ["-r", "-U", "-l"],
+                     ["-a", "-U", "-l"]):
+            rearranger = self.build(args)
+            serial = rearranger.rearrange(SOURCE * 10,
+                                          changes={"random_seed": 1})
+            parallel = rearranger.rearrange(
+                SOURCE * 10, changes={"random_seed": 1, "workers": 4,
+                                      "shard_size": 1})
+            self.assertEqual(len(parallel.split()), len(serial.split()),
+                             args)
+
+    def test_limited_usage_keeps_word_count_with_workers(self):
+        # buckets run down to their last word, which is then used forever
+        text = "one two three four five six seven\n\n" * 400
+        for source, args in (("cat dog cow\n", ["-u"]),
+                             ("cat dog cow\n", ["-g", "-u"]),
+                             ("cat dog cow\n", ["-u", "-b"]),
+                             ("cat dog cow\n", ["-u", "--compact-buckets"]),
+                             ("cat dog cow\n", ["-a"]),
+                             (SOURCE, ["-u"]), (SOURCE, ["-d"]),
+                             (SOURCE, ["-g", "-u", "-a"])):
+            settings = options.get_settings(args, no_cache=True)
+            rearranger = textrearranger.Rearranger(settings).build(
+                StringIO(source))
+            serial = rearranger.rearrange(text, changes={"random_seed": 1})
+            parallel = rearranger.rearrange(
+                text, changes={"random_seed": 1, "workers": 4,
+                               "shard_size": 1})
+            self.assertEqual(len(parallel.split()), len(serial.split()),
+                             (source, args))
+
+    def test_truncated_newlines_carry_across_shards(self):
+        text = SOURCE.replace("\n", "\n\n") * 10
+        rearranger = self.build(["-H", "-N"])
+        self.assertEqual(
+            rearranger.rearrange(text, changes={"workers": 4,
+                                                "shard_size": 1}),
+            rearranger.rearrange(text))
+
+    def test_workers_match_serial_output(self):
+        # lines ending in spaces are held over the blank lines after them,
+        # which shards have to carry into the next shard, and -t and -T
+        # lines run long enough to be written in parts
+        text = ("the quick brown fox \n\nover the  lazy dog   \n\n\n"
+                "  a bird sings\n \nand every other animal \n") * (
+                    textrearranger.LINE_PART_SIZE // 50)
+        for args in (["-H"], ["-H", "-N"], ["-H", "-T"], ["-H", "-T", "-N"],
+                     ["-H", "-t"], ["-H", "-t", "-N"], ["-H", "-p", "-N"]):
+            rearranger = self.build(args)
+            self.assertEqual(
+                rearranger.rearrange(text, changes={"workers": 4,
+                                                    "shard_size": 1}),
+                rearranger.rearrange(text), args)
+
+    def test_workers_match_serial_output_for_dropped_words(self):
+        # -P puts nothing in the line for words it drops, so whether they
+        # end the line or add a space depends on the shard before
+        text = ("the quick brown fox \n\nover the  lazy dog   \n\n\n"
+                "  a bird sings\n \nand every other animal \n") * 40
+        for args in (["-P", "-S"], ["-P", "-S", "-N"], ["-P", "-S", "-T"]):
+            settings = options.get_settings(args, no_cache=True)
+            rearranger = textrearranger.Rearranger(settings).build(
+                StringIO(SOURCE), StringIO("fox dog bird\n"))
+            self.assertEqual(
+                rearranger.rearrange(text, changes={"workers": 4,
+                                                    "shard_size": 1}),
+                rearranger.rearrange(text), args)
+
+    def test_extreme_percent_limits(self):
+        full = self.build(["-I", "-Q"]).inspect()
+        self.assertTrue(full)
+        for args, expected in ((["-X", "inf"], ""), (["-X", "1e300"], ""),
+                               (["-Y", "inf"], full),
+                               (["-Y", "1e300"], full)):
+            self.assertEqual(self.build(["-I", "-Q"] + args).inspect(),
+                             expected, args)
+
+    def test_count_range_matches_percent_checks(self):
+        wordCount = 37
+        for minimum, maximum in ((0, 1e300), (2.7, 50), (100, 100),
+                                 (50, 13.5), (1e-300, 99.99)):
+            cmd = options.get_settings(
+                ["-I", "-X", str(minimum), "-Y", str(maximum)],
+                no_cache=True)
+            lowest, highest = textrearranger.get_count_range(cmd, wordCount)
+            self.assertEqual(
+                [count for count in range(1, wordCount + 1)
+                 if lowest <= count <= highest],
+                [count for count in range(1, wordCount + 1)
+                 if minimum <= count * 1.0 / wordCount * 100 <= maximum],
+                (minimum, maximum))
+
+    def test_truncated_newlines_stream_output(self):
+
+        class Output(object):
+            """Output that keeps each write apart"""
+            def __init__(self):
+                self.writes = []
+
+            def write(self, text):
+                self.writes.append(text)
+
+            def flush(self):
+                pass
+
+        text = SOURCE * 100
+        rearranger = self.build(["-H", "-T"])
+        output = Output()
+        rearranger.rearrange(text, output)
+        self.assertEqual("".join(output.writes), rearranger.rearrange(text))
+        self.assertTrue(max(map(len, output.writes)) < len(text) / 2)
+
+    def test_alphabetical_force_limited_removes_first_occurence(self):
+        text = "the The the THE the The zed the\n"
+        settings = options.get_settings(["-a", "-U"], no_cache=True)
+        rearranger = textrearranger.Rearranger(settings).build(
+            StringIO(text))
+        # the output the original list based buckets gave
+        self.assertEqual(rearranger.rearrange(text).split(),
+                         "the The the THE zed".split())
+
+    def test_prepared_dictionary_prepares_every_read(self):
+        prepare = lambda key, wordList: sorted(wordList)
+        for read in (lambda d: d["a"], lambda d: dict(d.items())["a"],
+                     lambda d: d.values()[0], lambda d: [d[key] for key in
+                                                         d][0]):
+            dictionary = buckets.PreparedDictionary({"a": ["y", "x"]},
+                                                    prepare)
+            self.assertEqual(read(dictionary), ["x", "y"])
+        with self.assertRaises(KeyError):
+            dictionary["b"]
+
+    def test_grouped_bucket_picks_other_words(self):
+        bucket = buckets.GroupedBucket(["a", "b", "a", "c", "a", "b"])
+        self.assertEqual(sorted(bucket), ["a", "a", "a", "b", "b", "c"])
+        rng = random.Random(1)
+        for word in ("a", "b", "c"):
+            picks = set(bucket.random_other(word, rng) for _ in range(200))
+            self.assertEqual(picks, set("abc") - set(word))
+        self.assertEqual(buckets.GroupedBucket(["a", "a"]).random_other("a"),
+                         "a")
+        self.assertIsInstance(self.build(["-g"]).dictionary.values()[0],
+                              buckets.GroupedBucket)
+
+    def test_compact_buckets_match_word_lists(self):
+        # using up the source against itself gives back every word of it
+        for args in (["-u"], ["-u", "-l", "-c"], ["-u", "-b"]):
+            expected = sorted(SOURCE.split())
+            for extra in ([], ["--compact-buckets"]):
+                output = self.build(args + extra + ["-R", "1"]).rearrange(
+                    SOURCE)
+                self.assertEqual(sorted(output.split()), expected,
+                                 args + extra)
+        # and runs out of words at the same point
+        for args in (["-U"], ["-e", "-U", "-l"]):
+            lengths = [len(self.build(args + extra + ["-R", "1"]).rearrange(
+                SOURCE).split()) for extra in ([], ["--compact-buckets"])]
+            self.assertEqual(lengths[0], lengths[1], args)
+        # words are drawn as often as they occur either way
+        text = SOURCE * 20
+        counts = []
+        for extra in ([], ["--compact-buckets"]):
+            compact = self.build(["-R", "1"] + extra)
+            self.assertEqual(
+                isinstance(compact.dictionary.values()[0],
+                           buckets.CountedBucket), bool(extra))
+            output = compact.rearrange(text).split()
+            counts.append(dict((word, output.count(word) /
+                                float(len(output)))
+                               for word in set(SOURCE.split())))
+        for word, share in counts[0].items():
+            self.assertAlmostEqual(counts[1][word], share, delta=0.01)
+
+    def test_batch_shuffles_every_input(self):
+        folder = tempfile.mkdtemp()
+        try:
+            for name in ("input", "output"):
+                os.mkdir(os.path.join(folder, name))
+            for name in ("a.txt", "b.txt"):
+                with open(os.path.join(folder, "input", name), "w") as f:
+                    f.write(SOURCE)
+            rearranger = self.build(
+                ["-u", "--batch-glob", os.path.join(folder, "input", "*"),
+                 "--batch-output", os.path.join(folder, "output")])
+            textrearranger.generate_batch(rearranger)
+            outputs = []
+            for name in ("a.txt", "b.txt"):
+                with open(os.path.join(folder, "output", name), "r") as f:
+                    outputs.append(f.read())
+            self.assertNotEqual(outputs[0], outputs[1])
+        finally:
+            shutil.rmtree(folder)
+
+
+class FillDictionaryTest(unittest.TestCase):
+
+    def setUp(self):
+        words = ["The", "quick", "brown,", "fox", "jumps", "over", "a",
+                 "lazy", "dog.", "FOX", "(dog)"]
+        rng = random.Random(1)
+        self.text = "".join(
+            " ".join(rng.choice(words) for _ in range(rng.randint(0, 60))) +
+            "\n" for _ in range(400))
+        f = tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False)
+        self.addCleanup(os.remove, f.name)
+        with f:
+            f.write(self.text)
+        self.source = f.name
+
+    def fill(self, args, parallel):
+        """
+        Return the buckets, as lists, word counts and total word count
+        filled from the source, in byte ranges or in one go
+        """
+        cmd = options.get_settings(
+            args + ["--workers", "4", "--shard-size", "1"],
+            no_cache=True)
+        cmd["source"] = open(self.source, "r")
+        cmd["filter"] = StringIO("the fox dog\n")
+        filterList = textrearranger.get_filter_list(cmd)
+        text = None
+        if cmd["mmap_source"]:
+            text = textrearranger.map_source(cmd)
+        dictionary = {}
+        try:
+            if parallel:
+                occurences, wordCount = (
+                    textrearranger.fill_dictionary_parallel(
+                        cmd, dictionary, filterList, text))
+            elif text is not None:
+                occurences, wordCount = textrearranger.fill_dictionary_mapped(
+                    cmd, dictionary, filterList, text, 0, text)
+            else:
+                occurences, wordCount = textrearranger.fill_dictionary(
+                    cmd, dictionary, filterList)
+        finally:
+            cmd["source"].close()
+        return (dict((key, list(wordList))
+                     for key, wordList in dictionary.items()),
+                occurences, wordCount)
+
+    def test_ranges_split_mid_word(self):
+        size = len(self.text)
+        count = min(size // 1024, 16)
+        # where ranges would start if they weren't moved to line ends
+        starts = [part * size // count for part in range(1, count)]
+        self.assertTrue(any(self.text[start - 1] not in " \n"
+                            for start in starts))
+        ranges = textrearranger.split_file(self.source, count)
+        self.assertTrue(len(ranges) > 1)
+        for start, end in ranges:
+            self.assertEqual(self.text[end - 1], "\n")
+
+    def test_parallel_fill_matches_serial(self):
+        for args in ([], ["-L"], ["-S", "-F"], ["-D", "-F"],
+                     ["-S", "-F", "-L"], ["-S", "-F", "-p"], ["-c", "-n", "-l"],
+                     ["--compact-buckets"], ["--mmap-source"],
+                     ["--mmap-source", "-S", "-F", "-L"]):
+            filled = self.fill(args, True)
+            # check_filter only ever passes words with -S on its own
+            self.assertEqual(bool(filled[2]), "-D" not in args, args)
+            self.assertEqual(filled, self.fill(args, False), args)
+
+
+class MmapSourceTest(unittest.TestCase):
+
+    TEXT = ("The quick  brown fox, jumps over the \"lazy\" dog.\n\n"
+            "A bird sings while every Other animal in the WOOD goes about "
+            "its day!\n") * 40
+    ARGS = [[], ["-u"], ["-U"], ["-e"], ["-a"], ["-a", "-U", "-F"],
+            ["-k", "30", "-J", "-j", "20"], ["-C", "-l", "-L"], ["-u", "-p"],
+            ["-u", "-x", "2", "-X", "1"], ["-u", "--memory-budget", "1"],
+            ["-u", "--workers", "2", "--shard-size", "1"]]
+
+    def setUp(self):
+        f = tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False)
+        self.addCleanup(os.remove, f.name)
+        with f:
+            f.write(self.TEXT)
+        self.source = f.name
+
+    def build(self, args):
+        """Return a rearranger built from the source file"""
+        settings = options.get_settings(args + ["-R", "4"], no_cache=True)
+        return textrearranger.Rearranger(settings).build(self.source)
+
+    def test_offsets_match_words_in_memory(self):
+        for args in self.ARGS:
+            rearranger = self.build(args + ["--mmap-source"])
+            self.assertTrue(rearranger.cmd["mmap_source"], args)
+            self.assertEqual(rearranger.rearrange(self.TEXT),
+                             self.build(args).rearrange(self.TEXT), args)
+
+    def test_offsets_are_shared_between_calls(self):
+        rearranger = self.build(["-u", "--mmap-source"])
+        self.assertTrue(all(isinstance(wordList, buckets.OffsetBucket)
+                            for wordList in rearranger.dictionary.values()))
+        expected = self.build(["-u"])
+        for seed in (1, 2):
+            changes = {"random_seed": seed}
+            self.assertEqual(rearranger.rearrange(self.TEXT, changes=changes),
+                             expected.rearrange(self.TEXT, changes=changes))
+
+
+class TokenCacheTest(unittest.TestCase):
+
+    TOKENS = ("fox", "Fox", "(fox),", "\"FOX\"\n", "", "\n", "don't",
+              "...", "a.b.c", "fox\n", "over-the", "\tDog!\n", "fox")
+
+    def test_cached_parses_match_uncached(self):
+        rng = random.Random(1)
+        tokens = [rng.choice(self.TOKENS) for _ in range(500)]
+        for args in ([], ["-p"], ["-p", "-v"], ["-p", "-V"], ["-V"], ["-T"],
+                     ["-t", "-p"], ["-L", "-l", "-n"], ["-C", "-c"]):
+            cmd = options.get_settings(args, no_cache=True)
+            split = textrearranger.get_punctuation_parser(cmd)
+            get_metadata = textrearranger.get_metadata_key(cmd)
+            # small enough that generations swap many times over
+            tokenCache = textrearranger.TokenCache(cmd, 4)
+            for token in tokens:
+                puncBefore, word, puncAfter = split(token)
+                key = get_metadata(word) if word else None
+                self.assertEqual(tokenCache.parse(token),
+                                 (puncBefore, word, puncAfter, key),
+                                 (args, token))
+            self.assertTrue(tokenCache.hits and tokenCache.misses, args)
+            self.assertTrue(len(tokenCache.recent) <= 4, args)
+
+    def test_generations_swap_mid_run(self):
+        text = " ".join(self.TOKENS * 20) + "\n"
+        for args in (["-H", "-p"], ["-u", "-R", "1"], ["-P", "-S", "-L"]):
+            outputs = []
+            for size in (textrearranger.TOKEN_CACHE_SIZE, 3):
+                settings = options.get_settings(args, no_cache=True)
+                rearranger = textrearranger.Rearranger(settings)
+                tokenCache = rearranger.cmd["token_cache"] = (
+                    textrearranger.TokenCache(rearranger.cmd, size))
+                rearranger.build(StringIO(text), StringIO("fox dog\n"))
+                outputs.append(rearranger.rearrange(text))
+            # dropped tokens were parsed again
+            self.assertTrue(tokenCache.misses > len(set(self.TOKENS)), args)
+            self.assertEqual(outputs[1], outputs[0], args)
+
+
+def nested_metadata(cmd, word):
+    """Return the case, letter and length of a word, one setting at a time"""
+    if cmd["compare_lower"]:
+        word = word.lower()
+    case = ""
+    if cmd["compare_case"]:
+        for case, check in (("title", word.istitle), ("lower", word.islower),
+                            ("upper", word.isupper), ("mixed", None)):
+            if check is None or check():
+                break
+    letter = ""
+    if cmd["first_letter"] and word:
+        letter = word[0] if cmd["case_sensitive"] else word[0].lower()
+    return case, letter, len(word) if cmd["length_check"] else 0
+
+
+class MetadataKeyTest(unittest.TestCase):
+
+    TEXT = ("The Quick brown FOX jumps over the LAZY dog while McDonald "
+            "eats a big Mac and x\n") * 3
+    FLAGS = ["-C", "-l", "-c", "-n", "-L"]
+
+    def flag_sets(self):
+        """Iterator that yields every combination of metadata flags"""
+        for mask in range(2 ** len(self.FLAGS)):
+            yield [flag for i, flag in enumerate(self.FLAGS) if mask >> i & 1]
+
+    def test_compiled_key_matches_each_setting(self):
+        for flags in self.flag_sets():
+            cmd = options.get_settings(flags, no_cache=True)
+            get_metadata = textrearranger.get_metadata_key(cmd)
+            self.assertIs(textrearranger.get_metadata_key(cmd), get_metadata)
+            for word in self.TEXT.split() + [""]:
+                self.assertEqual(get_metadata(word),
+                                 nested_metadata(cmd, word), (flags, word))
+
+    def test_buckets_are_keyed_flat(self):
+        for flags in self.flag_sets():
+            cmd = options.get_settings(flags, no_cache=True)
+            rearranger = textrearranger.Rearranger(cmd).build(
+                StringIO(self.TEXT))
+            expected = {}
+            for word in self.TEXT.split():
+                expected.setdefault(nested_metadata(cmd, word),
+                                    []).append(word)
+            self.assertEqual(dict(rearranger.dictionary), expected, flags)
+
+    def test_inspection_nests_flat_keys(self):
+        for flags in self.flag_sets():
+            cmd = options.get_settings(["-I"] + flags, no_cache=True)
+            rearranger = textrearranger.Rearranger(cmd).build(
+                StringIO(self.TEXT))
+            index = textrearranger.FrequencyIndex(
+                cmd, rearranger.occurences, rearranger.wordCount)
+            nested = textrearranger.limit_dictionary(cmd, index)
+            expected = {}
+            for word in set(self.TEXT.split()):
+                case, letter, length = nested_metadata(cmd, word)
+                expected.setdefault(case, {}).setdefault(
+                    letter, {}).setdefault(length, set()).add(word)
+            found = dict((case, dict((letter, dict(
+                (length, set(index.words[wordId] for wordId in wordIds))
+                for length, wordIds in lengths.items()))
+                for letter, lengths in letters.items()))
+                for case, letters in nested.items())
+            self.assertEqual(found, expected, flags)
+
+
+def reference_inspection(cmd, text):
+    """Return the -I report for text, the way it was written before streaming"""
+    words = text.split()
+    counts = collections.Counter(words)
+    # percent values need to be float
+    total = len(words) * 1.0
+    nested = {}
+    for word, count in counts.items():
+        percent = count / total * 100
+        if (cmd["count_minimum"] <= count <= cmd["count_maximum"] and
+                cmd["percent_minimum"] <= percent <= cmd["percent_maximum"]):
+            case, letter, length = nested_metadata(cmd, word)
+            nested.setdefault(case, {}).setdefault(letter, {}).setdefault(
+                length, []).append(word)
+
+    def describe(word):
+        info = []
+        if cmd["frequency_count"]:
+            info.append("count: %d" % counts[word])
+        if cmd["frequency_percent"]:
+            info.append(("frequency: {:.%d%%}" % cmd["decimal_accuracy"])
+                        .format(counts[word] / total))
+        return " {%s}" % ", ".join(info) if info else ""
+
+    def search(dictionary, level, indent, order=None):
+        newIndent = indent
+        for section in order or sorted(dictionary):
+            if section not in dictionary:
+                continue
+            if section:
+                yield "%s%s %s" % (" " * indent, level[0], section)
+                newIndent = indent + 2
+            if isinstance(dictionary[section], dict):
+                for line in search(dictionary[section], level[1:],
+                                   newIndent):
+                    yield line
+            else:
+                # used to tie in set order, now uppercase first
+                for word in sorted(dictionary[section],
+                                   key=lambda word: (word.lower(), word)):
+                    yield " " * newIndent + word + describe(word)
+
+    return "".join(line + "\n" for line in search(
+        nested, ["Case", "Letter", "Length"], 0,
+        ["upper", "title", "lower", "mixed", ""]))
+
+
+class CountedWrites(object):
+    """Output file that keeps every write apart"""
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, text):
+        self.writes.append(text)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return "".join(self.writes)
+
+
+class InspectionTest(unittest.TestCase):
+
+    TEXT = SOURCE + ("The Quick FOX and McDonald went over THE old Wood, "
+                     "while the fox sat\n") * 3
+    ARGS = [[], ["-q"], ["-Q", "-A", "4"], ["-q", "-Q", "-C", "-l"],
+            ["-c", "-n", "-L", "-q"], ["-x", "4", "-y", "20", "-q"],
+            ["-X", "2", "-Y", "10", "-Q", "-C"], ["-x", "1000"]]
+
+    def inspect(self, args, text=None):
+        """Return the -I report of text, or TEXT, with CLI style arguments"""
+        cmd = options.get_settings(["-I"] + args, no_cache=True)
+        rearranger = textrearranger.Rearranger(cmd).build(
+            StringIO(text or self.TEXT))
+        return cmd, rearranger.inspect()
+
+    def test_report_matches_unstreamed_report(self):
+        for args in self.ARGS:
+            cmd, report = self.inspect(args)
+            self.assertEqual(report, reference_inspection(cmd, self.TEXT),
+                             args)
+
+    def test_workers_and_budget_match_serial_report(self):
+        for args in self.ARGS[:4]:
+            _, expected = self.inspect(args)
+            for more in (["--workers", "2"], ["--memory-budget", "1"]):
+                self.assertEqual(self.inspect(args + more)[1], expected,
+                                 args + more)
+
+    def test_long_reports_are_written_as_they_go(self):
+        text = " ".join("w%05d" % i for i in range(20000)) + "\n"
+        cmd = options.get_settings(["-I", "-q"], no_cache=True)
+        rearranger = textrearranger.Rearranger(cmd).build(StringIO(text))
+        output = CountedWrites()
+        rearranger.inspect(output)
+        self.assertEqual(output.getvalue(), reference_inspection(cmd, text))
+        self.assertTrue(len(output.writes) > 1)
+        self.assertTrue(max(len(piece) for piece in output.writes) <
+                        2 * textrearranger.OUTPUT_BUFFER_SIZE)
+
+
+def reference_word_info(cmd, count, wordCount):
+    """Return a word's info string, the way it was built for every word"""
+    wordCount *= 1.0
+    info = "{"
+    if cmd["frequency_count"]:
+        info += "count: %d" % count
+        if cmd["frequency_percent"]:
+            info += ", "
+    if cmd["frequency_percent"]:
+        percent = "frequency: {:." + str(cmd["decimal_accuracy"]) + "%}"
+        info += percent.format(count / wordCount)
+    info += "}"
+    return "" if info == "{}" else info
+
+
+class WordInfoTest(unittest.TestCase):
+
+    TEXT = InspectionTest.TEXT
+
+    def index(self, args):
+        """Return settings, and the frequency index of TEXT"""
+        cmd = options.get_settings(["-I"] + args, no_cache=True)
+        rearranger = textrearranger.Rearranger(cmd).build(StringIO(self.TEXT))
+        return cmd, textrearranger.FrequencyIndex(
+            cmd, rearranger.occurences, rearranger.wordCount)
+
+    def test_arrays_hold_every_word_count(self):
+        _, index = self.index([])
+        counts = collections.Counter(self.TEXT.split())
+        self.assertEqual(index.wordCount, len(self.TEXT.split()))
+        self.assertEqual(dict(zip(index.words, index.counts)), counts)
+        for key, (keyCounts, wordIds) in index.buckets.items():
+            self.assertEqual(list(keyCounts),
+                             [index.counts[i] for i in wordIds])
+            self.assertEqual(list(keyCounts), sorted(keyCounts))
+
+    def test_info_matches_info_built_for_every_word(self):
+        for args in ([], ["-q"], ["-Q"], ["-q", "-Q"], ["-Q", "-A", "0"],
+                     ["-q", "-Q", "-A", "5"]):
+            cmd, index = self.index(args)
+            describe = textrearranger.compile_word_info(cmd, index)
+            for wordId, count in enumerate(index.counts):
+                self.assertEqual(describe(wordId), reference_word_info(
+                    cmd, count, index.wordCount), args)
+
+    def test_only_shown_words_are_described(self):
+        compileWordInfo = textrearranger.compile_word_info
+        described = []
+
+        def compile_word_info(cmd, index):
+            describe = compileWordInfo(cmd, index)
+
+            def counted(wordId):
+                described.append(index.words[wordId])
+                return describe(wordId)
+            return counted
+
+        self.addCleanup(setattr, textrearranger, "compile_word_info",
+                        compileWordInfo)
+        textrearranger.compile_word_info = compile_word_info
+        cmd = options.get_settings(["-I", "-q", "-x", "20"], no_cache=True)
+        report = textrearranger.Rearranger(cmd).build(
+            StringIO(self.TEXT)).inspect()
+        shown = [line.split()[0] for line in report.splitlines()
+                 if "{" in line]
+        self.assertEqual(described, shown)
+        self.assertTrue(len(shown) < len(set(self.TEXT.split())))
+
+
+class PipelineTest(unittest.TestCase):
+
+    INPUT = ("The Fox, a Bird and every Dog went over the old wood.\n"
+             "Its day goes about!\n")
+    # written by the program from before the pipeline was compiled
+    EXPECTED = {
+        "": "in its lazy dog lazy in a the and the jumps other\n"
+            "every brown brown bird\n",
+        "-k 30": "in\nits\nlazy dog lazy\nin\na\nthe and the\n"
+                 "jumps other\nevery\nbrown brown\nbird\n\n",
+        "-J -j 40": "ihe brx, dog a aad and Doe sings ever a oir lazy\n"
+                    "jumps day day brown\n",
+        "-e": "fox bird over the about goes its sings while dog wood "
+              "about\nquick every goes lazy\n",
+        "-C -l -L": "the fox and brown and every dog while other the over "
+                    "wood\nits dog goes and\n",
+        "-p -v": "in its lazy dog lazy in a the and the jumps other\n"
+                 "every brown brown bird\n",
+        "-t": "in its lazy dog lazy in a the and the jumps other every "
+              "brown brown bird \n",
+        "-k 20 -J -j 20 -l": "The Foxf and brown and every Dog wood oter "
+                             "the\nove while\nin day goes\na\n\n",
+    }
+
+    def build(self, args):
+        """Return a rearranger built from SOURCE with CLI style arguments"""
+        settings = options.get_settings(args, no_cache=True)
+        return textrearranger.Rearranger(settings).build(StringIO(SOURCE))
+
+    def test_output_matches_uncompiled_pipeline(self):
+        for args, expected in self.EXPECTED.items():
+            rearranger = self.build(args.split() + ["-R", "4"])
+            self.assertEqual(rearranger.rearrange(self.INPUT), expected, args)
+
+    def test_disabled_stages_are_left_out(self):
+        cmd = options.get_settings(no_cache=True)
+        dictionary = self.build([]).dictionary
+        get_new_word = textrearranger.compile_rearranger(cmd, dictionary,
+                                                         set(), {})
+        # no jabberwocky, filter or word map around the replacement
+        self.assertEqual(get_new_word.__name__, "find_replacement")
+        cmd = options.get_settings(["-J"], no_cache=True)
+        self.assertEqual(textrearranger.compile_rearranger(
+            cmd, dictionary, set(), {}).__name__, "rearrange")
+        for args in (["-T"], ["-H"], ["-H", "-k", "0"]):
+            cmd = options.get_settings(args, no_cache=True)
+            self.assertIsNone(textrearranger.compile_kick(cmd), args)
+        self.assertIsNotNone(textrearranger.compile_kick(
+            options.get_settings(["-H", "-k", "5"], no_cache=True)))
+
+    def test_kept_words_draw_no_random_numbers(self):
+        rearranger = self.build(["-H", "-R", "1"])
+        state = rearranger.cmd["random"].getstate()
+        self.assertEqual(rearranger.rearrange(self.INPUT), self.INPUT)
+        self.assertEqual(rearranger.cmd["random"].getstate(), state)
+
+
+class FakeClock(object):
+    """Stands in for the time module, with a clock moved by hand"""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def time(self):
+        return self.now
+
+
+class TimingsTest(unittest.TestCase):
+
+    def test_report_lists_every_stage(self):
+        timings = textrearranger.Timings()
+        timings.add("fill", 2.0, 500)
+        timings.add("sort", 0.5)
+        timings.add("fill", 2.0, 300)
+        timings.notes.append("token cache: 50.0% hit rate")
+        f = StringIO()
+        timings.report(f)
+        lines = [line.split() for line in f.getvalue().splitlines()]
+        self.assertEqual(lines, [["stage", "seconds", "tokens", "tokens/sec"],
+                                 ["fill", "4.0000", "800", "200"],
+                                 ["sort", "0.5000"],
+                                 ["total", "4.5000"],
+                                 ["token", "cache:", "50.0%", "hit", "rate"]])
+
+    def test_nested_stages_are_not_counted_twice(self):
+        clock = FakeClock()
+        self.addCleanup(setattr, textrearranger, "time", textrearranger.time)
+        textrearranger.time = clock
+        timings = textrearranger.Timings()
+        with timings.stage("generate"):
+            clock.now += 1
+            with timings.stage("sort"):
+                clock.now += 2
+            clock.now += 3
+            with timings.stage("generate"):
+                clock.now += 4
+        self.assertEqual(timings.seconds, {"generate": 8.0, "sort": 2.0})
+        self.assertEqual(timings.running, [])
+        cmd = options.get_settings(no_cache=True)
+        self.assertIs(textrearranger.time_stage(cmd, "sort"),
+                      textrearranger.UNTIMED_STAGE)
+
+    def test_timed_run_counts_tokens_and_matches_untimed(self):
+        settings = options.get_settings(["-R", "4"], no_cache=True)
+        expected = textrearranger.Rearranger(settings).build(
+            StringIO(SOURCE)).rearrange(SOURCE)
+        settings["timings"] = True
+        rearranger = textrearranger.Rearranger(settings).build(
+            StringIO(SOURCE))
+        self.assertEqual(rearranger.rearrange(SOURCE), expected)
+        timings = rearranger.cmd["timings"]
+        self.assertEqual(timings.tokens["fill"], len(SOURCE.split()))
+        self.assertEqual(timings.tokens["generate"], len(SOURCE.split()))
+        self.assertIn("generate", timings.seconds)
+
+    def test_profile_and_timings_from_the_command_line(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        paths = dict((name, os.path.join(folder, name))
+                     for name in ("source", "plain", "timed", "stats"))
+        with open(paths["source"], "w") as f:
+            f.write(SOURCE)
+        script = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), "textrearranger.py")
+
+        def call(output, *args):
+            process = subprocess.Popen(
+                [sys.executable, script, "-s", paths["source"],
+                 "-i", paths["source"], "-o", paths[output], "-O", "-R", "4",
+                 "-e"] + list(args),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = process.communicate()
+            self.assertEqual(process.returncode, 0, err)
+            with open(paths[output]) as f:
+                return f.read(), err
+
+        plain, _ = call("plain")
+        timed, err = call("timed", "--timings", "--profile", paths["stats"])
+        self.assertEqual(timed, plain)
+        stages = [line.split()[0] for line in err.splitlines()]
+        self.assertEqual(stages[0], "stage")
+        for stage in ("options", "fill", "generate", "total", "token"):
+            self.assertIn(stage, stages)
+        functions = set(name for _, _, name in
+                        pstats.Stats(paths["stats"]).stats)
+        self.assertIn("run", functions)
+        self.assertIn("build_dictionary", functions)
+
+
+class GetNewWordTest(unittest.TestCase):
+
+    def compile(self, args, wordMap, filterWords="fox dog\n"):
+        """Return a rearranger for SOURCE, and a word rearranging function"""
+        settings = options.get_settings(args + ["-R", "1"], no_cache=True)
+        rearranger = textrearranger.Rearranger(settings).build(
+            StringIO(SOURCE), StringIO(filterWords))
+        cmd = rearranger.call_settings(None, None)
+        return textrearranger.compile_rearranger(
+            cmd, rearranger.dictionary, rearranger.filterList, wordMap)
+
+    def test_decided_words_match_undecided(self):
+        for args in (["-H", "-S"], ["-H", "-S", "-L"]):
+            wordMap = {"dog": "cat", "lazy": "idle", "bird": ""}
+            rearrange = self.compile(args, wordMap)
+            lower = "-L" in args
+            for word in ("fox", "Fox", "dog", "lazy", "bird", "wood") * 3:
+                if (word.lower() if lower else word) in ("fox", "dog"):
+                    # the filter comes before the word map
+                    expected = word
+                elif wordMap.get(word):
+                    expected = wordMap[word]
+                else:
+                    expected = word
+                self.assertEqual(rearrange(word), expected, (args, word))
+
+    def test_replacements_are_only_kept_with_map_words(self):
+        rearrange = self.compile(["-S"], {"lazy": "idle"})
+        self.assertEqual(set(rearrange("fox") for _ in range(50)),
+                         set(["fox"]))
+        self.assertEqual(set(rearrange("lazy") for _ in range(50)),
+                         set(["idle"]))
+        self.assertTrue(len(set(rearrange("quick") for _ in range(50))) > 1)
+        wordMap = {}
+        rearrange = self.compile(["-M"], wordMap)
+        self.assertEqual(set(rearrange("quick") for _ in range(50)),
+                         set([wordMap["quick"]]))
+
+    def test_jabberwocky_is_rolled_every_time(self):
+        wordMap = {}
+        rearrange = self.compile(["-M", "-J", "-j", "50"], wordMap)
+        outputs = set(rearrange("quick") for _ in range(200))
+        mapped = wordMap["quick"]
+        self.assertEqual(outputs, set(
+            [mapped, textrearranger.jabberwocky("quick", mapped)]))
+
+    def test_kicks_are_rolled_every_time(self):
+        text = "fox " * 200 + "fox\n"
+        for args in (["-H", "-k", "50"], ["-M", "-k", "50"]):
+            settings = options.get_settings(args + ["-R", "1"],
+                                            no_cache=True)
+            rearranger = textrearranger.Rearranger(settings).build(
+                StringIO(SOURCE))
+            lines = rearranger.rearrange(text).splitlines()
+            self.assertTrue(10 < len(lines) < 190, args)
+            self.assertEqual(len(set(" ".join(lines).split())), 1, args)
+
+
+def read_lines(text):
+    """Return the words of some text split one line at a time"""
+    return [word for line in StringIO(text) for word in line.split(" ")]
+
+
+class TokenizerTest(unittest.TestCase):
+
+    TEXTS = ("the quick brown fox\njumps over the dog\n",
+             "averyveryverylongword spans\nseveral blocks\n",
+             "carriage returns\r\nend lines\r\n\r\n",
+             "no final newline",
+             "\n\n\nblank lines  before\n\n\n\nand after\n\n\n",
+             "  spaces  around \n \n",
+             "\n",
+             "")
+
+    def tokens(self, text, blockSize, useMmap=False):
+        """Return the words the tokenizer reads from a file of text"""
+        with tempfile.TemporaryFile("w+") as f:
+            f.write(text)
+            f.seek(0)
+            return [word for batch in textrearranger.token_batches(
+                f, blockSize, useMmap) for word in batch]
+
+    def test_blocks_split_like_lines(self):
+        for text in self.TEXTS:
+            expected = read_lines(text)
+            for blockSize in (1, 2, 3, 5, 8, 64):
+                for useMmap in (False, True):
+                    self.assertEqual(self.tokens(text, blockSize, useMmap),
+                                     expected, (text, blockSize, useMmap))
+
+    def test_spool_replays_the_same_words(self):
+        # long enough to be read in several blocks
+        longText = "".join(self.TEXTS) * (
+            textrearranger.TOKENIZER_BLOCK_SIZE // 100)
+        for text in self.TEXTS + (longText,):
+            # a limit of one byte spills everything after the first block
+            for memoryLimit in (1, textrearranger.SPOOL_MEMORY_LIMIT):
+                spool = textrearranger.TokenSpool(StringIO(text),
+                                                  memoryLimit=memoryLimit)
+                self.assertEqual(list(spool), read_lines(text), text)
+                self.assertEqual(list(spool), read_lines(text), text)
+                spool.close()
+
+    def test_spool_stays_within_memory_budget(self):
+        self.assertEqual(
+            textrearranger.get_spool_limit(options.get_settings()),
+            textrearranger.SPOOL_MEMORY_LIMIT)
+        cmd = options.get_settings(["--memory-budget", "2"])
+        self.assertEqual(textrearranger.get_spool_limit(cmd), 2 * 1024 * 1024)
+        text = "".join(self.TEXTS) * (
+            textrearranger.TOKENIZER_BLOCK_SIZE // 10)
+        spool = textrearranger.TokenSpool(StringIO(text),
+                                          memoryLimit=2 * 1024 * 1024)
+        self.assertEqual(list(spool), read_lines(text))
+        # spilled to disk once the budget is filled, by the next block
+        self.assertLessEqual(spool.stored, 2 * 1024 * 1024 +
+                             textrearranger.TOKENIZER_BLOCK_SIZE)
+        self.assertIsNotNone(spool.spill)
+        self.assertEqual(list(spool), read_lines(text))
+        spool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
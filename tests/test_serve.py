@@ -0,0 +1,45 @@
+#!usr/bin/python
+
+"""Check how served requests change settings"""
+
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import buckets
+import serve
+
+
+class ChangesTest(unittest.TestCase):
+
+    def test_defaults_given_are_changes(self):
+        self.assertEqual(serve.get_changes(["-k", "0", "-R", "-1", "-x", "0"]),
+                         {"kick_chance": 0, "random_seed": -1,
+                          "count_minimum": 0, "workers": 1})
+
+    def test_bucketing_settings_are_refused(self):
+        for args in (["-u"], ["-l", "-k", "5"]):
+            with self.assertRaises(ValueError):
+                serve.get_changes(args)
+
+
+class SizeTest(unittest.TestCase):
+
+    def test_buckets_are_not_prepared_to_be_sized(self):
+        raw = {("a",): ["cat", "cow", "cat"], ("b",): ["dog"]}
+        occurences = {"cat": 2, "cow": 1, "dog": 1}
+
+        def prepare(key, wordList):
+            self.fail("%r was prepared to be sized" % (key,))
+        dictionary = buckets.PreparedDictionary(raw, prepare)
+        self.assertEqual(serve.get_size(dictionary, occurences),
+                         serve.get_size(raw, occurences) +
+                         sys.getsizeof(dictionary))
+        self.assertEqual(dictionary.prepared, set())
+
+
+if __name__ == "__main__":
+    unittest.main()
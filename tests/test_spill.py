@@ -0,0 +1,134 @@
+#!usr/bin/python
+
+"""Check buckets spilled to disk under a memory budget"""
+
+from __future__ import print_function
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import buckets
+import spill
+
+
+class SpilledDictionaryTest(unittest.TestCase):
+
+    def spilled(self, dictionary, budget=1):
+        """Return a dictionary spilled into a store with a tiny budget"""
+        store = spill.SpillStore(budget)
+        self.addCleanup(store.close)
+        store.spill(dictionary, {})
+        return spill.SpilledDictionary(store)
+
+    def drop(self, spilled):
+        """Load every other bucket, so the older ones are dropped"""
+        for key in spilled.keys():
+            if key != "a":
+                spilled.get(key)
+
+    def test_popped_words_stay_taken(self):
+        spilled = self.spilled({"a": ["x", "y", "z"], "b": ["w"],
+                                "c": ["v"]})
+        self.assertEqual(spilled.get("a").pop(), "z")
+        self.drop(spilled)
+        self.drop(spilled)
+        self.assertEqual(list(spilled.get("a")), ["x", "y"])
+
+    def test_removed_words_stay_taken(self):
+        spilled = self.spilled({"a": ["x", "y", "x", "z"], "b": ["w"],
+                                "c": ["v"]})
+        spilled.prepare = lambda key, wordList: buckets.IndexedBucket(
+            wordList)
+        wordList = spilled.get("a")
+        wordList.remove("x")
+        buckets.take_random(wordList)
+        left = sorted(wordList)
+        self.drop(spilled)
+        self.drop(spilled)
+        self.assertEqual(sorted(spilled.get("a")), left)
+
+    def test_replaced_buckets_are_stored_in_chunks(self):
+        rng = random.Random(1)
+        words = [rng.choice("abcdefghij") * rng.randint(1, 3)
+                 for _ in range(spill.CHUNK_SIZE * 5 + 3)]
+        unordered = buckets.IndexedBucket(words)
+        for _ in range(100):
+            buckets.take_random(unordered, rng)
+        unordered.remove("a")
+        ordered = buckets.IndexedBucket(words, True)
+        ordered.remove("b")
+        ordered.pop()
+        counted = buckets.CountedBucket()
+        for position in range(spill.CHUNK_SIZE * 3):
+            counted.append("w%d" % position, position % 4 + 1)
+        counted.remove("w2")
+        counted.randomPop = True
+        for wordList in (list(words), unordered, ordered, counted,
+                         buckets.GroupedBucket(words)):
+            store = spill.SpillStore(1)
+            self.addCleanup(store.close)
+            store.spill({"a": ["x"]}, {})
+            store.replace("a", wordList)
+            rows = store.get_chunks("a")
+            self.assertGreater(len(rows), 1)
+            for rowId, _, _ in rows:
+                chunk = store.read_chunk(rowId)
+                if isinstance(chunk, buckets.CountedBucket):
+                    self.assertLessEqual(len(chunk.words), spill.CHUNK_SIZE)
+                else:
+                    self.assertLessEqual(len(chunk), spill.CHUNK_SIZE)
+            loaded, prepared = store.load("a")
+            self.assertTrue(prepared)
+            self.assertIs(type(loaded), type(wordList))
+            self.assertEqual(list(loaded), list(wordList))
+            if isinstance(wordList, buckets.GroupedBucket):
+                self.assertEqual(loaded.spans, wordList.spans)
+                continue
+            # the same words are taken out next, as if never stored
+            for _ in range(50):
+                self.assertEqual(buckets.take_random(loaded, random.Random(2)),
+                                 buckets.take_random(wordList,
+                                                     random.Random(2)))
+            self.assertEqual(list(loaded), list(wordList))
+
+    def test_sorted_buckets_are_never_loaded_whole(self):
+        rng = random.Random(1)
+        words = [rng.choice(["the", "The", "cat", "Cat", "CAT", "a", "dog"])
+                 for _ in range(spill.CHUNK_SIZE * 20 + 5)]
+        store = spill.SpillStore(64 * 1024)
+        self.addCleanup(store.close)
+        store.spill({"a": list(words), "b": ["x"]}, {})
+
+        def load(key):
+            self.fail("%r was loaded whole to be sorted" % key)
+        store.load = load
+        read = store.read_chunk
+        largest = []
+
+        def read_chunk(rowId):
+            chunk = read(rowId)
+            largest.append(len(chunk))
+            return chunk
+        store.read_chunk = read_chunk
+        spilled = spill.SpilledDictionary(store)
+
+        def prepare(key, wordList):
+            wordList.sort(str.lower, reverse=True)
+            return wordList
+        spilled.prepare = prepare
+        spilled.inPlace = True
+        spilled.sortInPlace = True
+        expected = sorted(words, key=str.lower)
+        expected.reverse()
+        self.assertEqual(list(spilled.get("a")), expected)
+        self.assertLessEqual(max(largest), spill.CHUNK_SIZE)
+        # every run it was sorted in is gone afterwards
+        self.assertEqual(store.connect().execute(
+            "SELECT count(*) FROM buckets WHERE key < 0").fetchone(), (0,))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,18 +4,181 @@
 
 from __future__ import print_function#, unicode_literals
 
+import sys
 import random
+import itertools
+import functools
+import mmap
+import tempfile
+import hashlib
+import os
+import collections
+import multiprocessing
+import bisect
+from array import array
+from cStringIO import StringIO
 import options
-import copy
+import buckets
+import cache
+import draws
+import spill
 import time
 import cProfile
 
+# bytes of finished output held before being written out
+OUTPUT_BUFFER_SIZE = 64 * 1024
+# bytes of an unfinished line held before part of it is written out
+LINE_PART_SIZE = 64 * 1024
+# bytes of text read at once when tokenizing a file
+TOKENIZER_BLOCK_SIZE = 1024 * 1024
+# bytes of text kept in memory when input is re-used as the source
+SPOOL_MEMORY_LIMIT = 64 * 1024 * 1024
+# raw tokens kept in each generation of a token cache
+TOKEN_CACHE_SIZE = 64 * 1024
+# every character that isn't a letter or number, to strip and delete
+NON_WORD = "".join(chr(c) for c in range(256) if not chr(c).isalnum())
+# state shared read-only with forked worker processes, which is why
+# --workers is turned off on platforms that can't fork
+WORKER_STATE = {}
+
+
+def read_blocks(f, blockSize=TOKENIZER_BLOCK_SIZE, useMmap=False):
+    """
+    Iterator that yields large blocks of text from a given open file
+    Every block but the last ends on a newline, so no line is ever split
+    """
+    mapped = None
+    if useMmap:
+        try:
+            start = f.tell()
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, IOError, OSError, ValueError):
+            # pipes, terminals and empty files can't be mapped
+            mapped = None
+
+    if mapped is not None:
+        read = mapped.read
+        mapped.seek(start)
+    else:
+        read = f.read
+
+    leftover = ""
+    while True:
+        block = read(blockSize)
+        if not block:
+            break
+        cut = block.rfind("\n") + 1
+        if not cut:
+            leftover += block
+            continue
+        yield leftover + block[:cut]
+        leftover = block[cut:]
+    if leftover:
+        yield leftover
+
+    if mapped is not None:
+        f.seek(mapped.tell())
+        mapped.close()
+
+
+def split_block(block):
+    """Split a block of text into words, as if split one line at a time"""
+    # a space after each newline lets one split handle every line
+    tokens = block.replace("\n", "\n ").split(" ")
+    if block[-1] == "\n":
+        # the split leaves an empty word after the final newline
+        tokens.pop()
+    return tokens
+
+
+def token_batches(f, blockSize=TOKENIZER_BLOCK_SIZE, useMmap=False):
+    """
+    Iterator that yields lists of words from a given open file
+    Words are identical to splitting every line on single spaces
+    """
+    for block in read_blocks(f, blockSize, useMmap):
+        yield split_block(block)
+
 
-def tokenizer(f):
+def tokenizer(f, useMmap=False):
     """Iterator that yields every word from a given open file"""
-    for line in f:
-        for word in line.split(" "):
-            yield word
+    if isinstance(f, TokenSpool):
+        return iter(f)
+    return itertools.chain.from_iterable(token_batches(f, useMmap=useMmap))
+
+
+class TokenSpool(object):
+    """
+    Read a file once, and replay its words as many times as needed
+    Keeps blocks of text in memory up to a limit, then spills text to disk,
+    and splits blocks into words again each time they are replayed
+    Lets one stream, such as stdin, be both the input and the source
+    """
+
+    def __init__(self, f, useMmap=False, memoryLimit=SPOOL_MEMORY_LIMIT):
+        self.name = getattr(f, "name", None)
+        self.reader = read_blocks(f, useMmap=useMmap)
+        self.memoryLimit = memoryLimit
+        self.blocks = []
+        self.stored = 0
+        self.spill = None
+        self.finished = False
+
+    def __iter__(self):
+        """Yield every word, reading the file only the first time"""
+        if self.finished:
+            return self.replay()
+        return itertools.chain.from_iterable(
+            split_block(block) for block in self.read())
+
+    def read(self):
+        """Yield blocks of text from the file, storing them as it goes"""
+        for block in self.reader:
+            if self.stored < self.memoryLimit:
+                self.stored += len(block)
+                self.blocks.append(block)
+            else:
+                if not self.spill:
+                    self.spill = tempfile.TemporaryFile("w+")
+                self.spill.write(block)
+            yield block
+        self.finished = True
+
+    def replay(self):
+        """Yield every stored word, and then every spilled word"""
+        for block in self.blocks:
+            for word in split_block(block):
+                yield word
+        if self.spill:
+            self.spill.flush()
+            self.spill.seek(0)
+            for batch in token_batches(self.spill):
+                for word in batch:
+                    yield word
+
+    def text_blocks(self):
+        """Yield the text again in blocks, reading any not read yet"""
+        if not self.finished and not self.blocks:
+            for block in self.reader:
+                yield block
+            return
+        if not self.finished:
+            for _ in self.read():
+                pass
+        for block in self.blocks:
+            yield block
+        if self.spill:
+            self.spill.flush()
+            self.spill.seek(0)
+            for block in read_blocks(self.spill):
+                yield block
+
+    def close(self):
+        """Drop stored text and delete any spilled text"""
+        self.blocks = []
+        if self.spill:
+            self.spill.close()
+            self.spill = None
 
 
 def check_speed(cmd):
@@ -24,6 +187,95 @@ def check_speed(cmd):
         time.sleep(cmd["slow_speed"])
 
 
+class Timings(object):
+    """
+    Wall time and tokens of each stage of a run, for --timings
+    Stages can be nested, and only count time not spent in inner stages
+    """
+
+    def __init__(self):
+        self.seconds = collections.OrderedDict()
+        self.tokens = {}
+        self.running = []
+        self.notes = []
+
+    def add(self, name, seconds=0.0, tokens=0):
+        """Add time and tokens to a stage"""
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.tokens[name] = self.tokens.get(name, 0) + tokens
+
+    def stage(self, name):
+        """Return a context that times a stage while it runs"""
+        return TimedStage(self, name)
+
+    def count(self, name, tokens):
+        """Iterator that passes tokens through, counting them for a stage"""
+        count = 0
+        for count, token in enumerate(tokens, 1):
+            yield token
+        self.add(name, tokens=count)
+
+    def report(self, f):
+        """Write every stage's time, tokens and throughput to a file"""
+        f.write("%-12s %10s %12s %14s\n" % ("stage", "seconds", "tokens",
+                                            "tokens/sec"))
+        for name, seconds in self.seconds.items():
+            tokens = self.tokens[name]
+            rate = "%14.0f" % (tokens / seconds) if tokens and seconds else ""
+            f.write("%-12s %10.4f %12s %s\n" % (name, seconds,
+                                                 tokens or "", rate))
+        f.write("%-12s %10.4f\n" % ("total", sum(self.seconds.values())))
+        for note in self.notes:
+            f.write(note + "\n")
+
+
+class TimedStage(object):
+    """Context that adds the time it runs for to a stage"""
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        now = time.time()
+        running = self.timings.running
+        # pauses the outer stage until this one is done
+        if running:
+            outer = running[-1]
+            self.timings.add(outer.name, now - outer.start)
+        self.start = now
+        running.append(self)
+        return self
+
+    def __exit__(self, *args):
+        now = time.time()
+        running = self.timings.running
+        running.pop()
+        self.timings.add(self.name, now - self.start)
+        if running:
+            running[-1].start = now
+        return False
+
+
+class UntimedStage(object):
+    """Context that does nothing, for when --timings is off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+UNTIMED_STAGE = UntimedStage()
+
+
+def time_stage(cmd, name):
+    """Return a context that times a stage, if --timings is on"""
+    if cmd["timings"]:
+        return cmd["timings"].stage(name)
+    return UNTIMED_STAGE
+
+
 def jabberwocky(first, second):
     """Jabberwocky two given words together"""
     if first == second:
@@ -55,123 +307,455 @@ def fill_word_map(cmd, wordMap):
             print("ISSUE: Wrong word map file syntax at line \"%s\"" % line)
 
 
-def get_metadata(cmd, word):
-    """Parse out metadata for a word, based on command settings"""
-
-    if cmd["compare_lower"]:
-        word = word.lower()
+def compile_metadata(cmd):
+    """
+    Return a function that gives the bucket key of a word
+    Checks command settings once, instead of once per word
+    """
+    compareLower = cmd["compare_lower"]
+    compareCase = cmd["compare_case"]
+    firstLetter = cmd["first_letter"]
+    caseSensitive = cmd["case_sensitive"]
+    lengthCheck = cmd["length_check"]
+
+    def get_metadata(word):
+        """Parse out the case, letter and length metadata for a word"""
+        if compareLower:
+            word = word.lower()
 
-    if not cmd["compare_case"]:
-        case = ""
-    elif word.istitle():
-        case = "title"
-    elif word.islower():
-        case = "lower"
-    elif word.isupper():
-        case = "upper"
-    else:
-        case = "mixed"
+        if not compareCase:
+            case = ""
+        elif word.istitle():
+            case = "title"
+        elif word.islower():
+            case = "lower"
+        elif word.isupper():
+            case = "upper"
+        else:
+            case = "mixed"
 
-    if cmd["first_letter"] and len(word) >= 1:
-        letter = word[0]
-        if not cmd["case_sensitive"]:
-            letter = letter.lower()
-    else:
-        letter = ""
+        if firstLetter and word:
+            letter = word[0] if caseSensitive else word[0].lower()
+        else:
+            letter = ""
 
-    if cmd["length_check"]:
-        length = len(word)
-    else:
-        length = 0
+        return case, letter, len(word) if lengthCheck else 0
 
-    return case, letter, length
+    return get_metadata
 
 
-def get_punctuation_point(word, start, step):
-    """Return the point at which non-word punctuation ends"""
-    letter = start
-    while (letter < len(word) and letter >= 0 and not word[letter].isalnum()):
-        letter += step
-    return letter
+def get_metadata_key(cmd):
+    """Return the compiled metadata key function for cmd"""
+    key = cmd.get("metadata_key")
+    if key is None:
+        key = cmd["metadata_key"] = compile_metadata(cmd)
+    return key
 
 
-def parse_punctuation(cmd, word):
+def compile_punctuation(cmd):
     """
-    Return the punctuation before the word, the stripped down word,
-    and the punctuation after the word
+    Return a function that splits punctuation off a word
+    Only includes the steps cmd turns on
     """
-    puncBefore = ""
-    puncAfter = ""
+    voidOuter = cmd["void_outer"]
+
+    def split_punctuation(word):
+        """Split all non-word punctuation from either end of a word"""
+        stripped = word.lstrip(NON_WORD)
+        puncBefore = "" if voidOuter else word[:len(word) - len(stripped)]
+        word = stripped
+        stripped = word.rstrip(NON_WORD)
+        puncAfter = word[len(stripped):]
+        if voidOuter:
+            puncAfter = "\n" if puncAfter.endswith("\n") else ""
+        return puncBefore, stripped, puncAfter
+
+    def split_newline(word):
+        """Split a newline from the end of a word"""
+        if word and word[-1] == "\n":
+            return "", word[:-1], "\n"
+        return "", word, ""
 
-    if cmd["soft_truncate_newlines"] or cmd["hard_truncate_newlines"]:
-        word = word.strip()
     if cmd["preserve_punctuation"]:
-        cutoff = get_punctuation_point(word, 0, 1)
-        if not cmd["void_outer"]:
-            puncBefore = word[:cutoff]
-        word = word[cutoff:]
-
-        cutoff = get_punctuation_point(word, len(word) - 1, -1)
-        # the last letter is the default target
-        cutoff += 1
-        if not cmd["void_outer"]:
-            puncAfter = word[cutoff:]
-        elif word and word[-1] == "\n":
-            puncAfter += word[-1]
-        word = word[:cutoff]
-    # split newlines from word
-    elif word:
-        if word[-1] == "\n":
-            word = word[:-1]
-            puncAfter = "\n"
+        parse = split_punctuation
+    else:
+        parse = split_newline
 
     if cmd["void_inner"]:
-        temp = ""
-        for c in word:
-            if c.isalnum():
-                temp += c
-        word = temp
+        split = parse
+
+        def parse(word):
+            """Delete punctuation inside a word once it is split"""
+            puncBefore, word, puncAfter = split(word)
+            return puncBefore, word.translate(None, NON_WORD), puncAfter
+
+    if cmd["soft_truncate_newlines"] or cmd["hard_truncate_newlines"]:
+        unstripped = parse
+
+        def parse(word):
+            """Strip whitespace from a word before it is split"""
+            return unstripped(word.strip())
+
+    return parse
+
+
+def get_punctuation_parser(cmd):
+    """Return the compiled punctuation parser for cmd"""
+    parse = cmd.get("punctuation_parser")
+    if parse is None:
+        parse = cmd["punctuation_parser"] = compile_punctuation(cmd)
+    return parse
 
-    return puncBefore, word, puncAfter
 
+class TokenCache(object):
+    """
+    Bounded cache of how raw tokens split into punctuation, a stripped
+    word, and the word's bucket key, so each distinct token is parsed once
+    Recently used tokens are kept in two generations of plain dicts, so
+    the oldest generation is dropped whenever the newest one fills up
+    """
 
-def fill_dictionary(cmd, dictionary, filterList, source="source"):
+    def __init__(self, cmd, size=TOKEN_CACHE_SIZE):
+        self.split = get_punctuation_parser(cmd)
+        self.get_metadata = get_metadata_key(cmd)
+        self.size = size
+        self.recent = {}
+        self.older = {}
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, token):
+        """
+        Return the punctuation before a token's word, the stripped down
+        word, the punctuation after it, and the word's bucket key
+        """
+        parsed = self.recent.get(token)
+        if parsed is not None:
+            self.hits += 1
+            return parsed
+        parsed = self.older.get(token)
+        if parsed is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            puncBefore, word, puncAfter = self.split(token)
+            key = self.get_metadata(word) if word else None
+            parsed = (puncBefore, word, puncAfter, key)
+        if len(self.recent) >= self.size:
+            self.older = self.recent
+            self.recent = {}
+        self.recent[token] = parsed
+        return parsed
+
+    def describe(self):
+        """Return a summary of how often tokens were found in the cache"""
+        lookups = self.hits + self.misses
+        rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return "token cache: %.1f%% hit rate, %d hits, %d misses" % (
+            rate, self.hits, self.misses)
+
+
+def get_token_parser(cmd):
+    """Return the cached token parser for cmd, making the cache if needed"""
+    tokenCache = cmd.get("token_cache")
+    if tokenCache is None:
+        tokenCache = cmd["token_cache"] = TokenCache(cmd)
+    return tokenCache.parse
+
+
+def new_bucket(cmd):
+    """Return an empty bucket to hold words sharing the same metadata"""
+    # words taken apart from the original need counts to skip it, while
+    # -g alone leaves buckets as lists, grouped once they are prepared
+    different = ((cmd["map_words"] or cmd["get_different"] and
+                  (cmd["limited_usage"] or cmd["force_limited_usage"])) and
+                 not cmd["alphabetical_sort"])
+    if cmd["compact_buckets"] or different:
+        return buckets.CountedBucket()
+    return []
+
+
+def fill_dictionary(cmd, dictionary, filterList, source="source",
+                    store=None):
     """
-    Fill a dictionary sorted by case, leading letter, and length
+    Fill a dictionary of buckets keyed by case, leading letter, and length
     Each word is filtered by its' metadata, which depends on cmd arguments
     Will optionally filter the dictionary as it builds it
     Also returns the count of each word, and total word count
+    With -I, only the counts are kept, as inspection never reads buckets
+    Given a spill store, buckets and counts over budget are moved into it
     """
 
+    parse = get_token_parser(cmd)
+    countOnly = cmd["inspection_mode"]
     occurences = {}
     wordCount = 0
-    for word in tokenizer(cmd[source]):
+    words = tokenizer(cmd[source], cmd["mmap"])
+    if store:
+        words = store.watch(words, dictionary, occurences)
+    for word in words:
 
-        _, word, _ = parse_punctuation(cmd, word)
+        _, word, _, key = parse(word)
         # source file should not be filtered except by request
         if (not word or cmd["filter_source"] and
                 not check_filter(cmd, filterList, word)):
             continue
-        case, letter, length = get_metadata(cmd, word)
-
-        if not dictionary.get(case):
-            dictionary[case] = {}
-        if not dictionary[case].get(letter):
-            dictionary[case][letter] = {}
-        if not dictionary[case][letter].get(length):
-            dictionary[case][letter][length] = []
-
-        dictionary[case][letter][length].append(word)
-        if not occurences.get(word):
-            occurences[word] = 0
-        occurences[word] += 1
+
+        if not countOnly:
+            wordList = dictionary.get(key)
+            if wordList is None:
+                wordList = dictionary[key] = new_bucket(cmd)
+            wordList.append(word)
+        occurences[word] = occurences.get(word, 0) + 1
         wordCount += 1
 
     return occurences, wordCount
 
 
-def sort_dictionary(cmd, dictionary):
-    """Sorts a given dictionary based on commands"""
+def fill_dictionary_mapped(cmd, dictionary, filterList, f, start=0,
+                           text=None, store=None):
+    """
+    Fill a dictionary the same way as fill_dictionary, for --mmap-source
+    Reads the source from f, which starts start bytes into the source,
+    and stores where each word is in it instead of the word itself
+    """
+    parse = get_token_parser(cmd)
+    filterSource = cmd["filter_source"]
+    countOnly = cmd["inspection_mode"]
+    occurences = {}
+    wordCount = 0
+    position = start
+    blocks = read_blocks(f)
+    if store:
+        blocks = store.watch(blocks, dictionary, occurences, 1)
+    for block in blocks:
+        for token in split_block(block):
+            offset = position
+            # the space split on, unless the token ends its line
+            position += len(token) + (token[-1:] != "\n")
+
+            _, word, _, key = parse(token)
+            if (not word or filterSource and
+                    not check_filter(cmd, filterList, word)):
+                continue
+
+            if not countOnly:
+                wordList = dictionary.get(key)
+                if wordList is None:
+                    wordList = dictionary[key] = buckets.OffsetBucket(text)
+                wordList.add(offset + token.find(word), len(word))
+            occurences[word] = occurences.get(word, 0) + 1
+            wordCount += 1
+
+    return occurences, wordCount
+
+
+def map_source(cmd):
+    """
+    Return the source file memory-mapped, for --mmap-source
+    Return None if it isn't a file that can be mapped
+    """
+    fName = cache.get_file_name(cmd["source"])
+    if not fName:
+        return None
+    try:
+        with open(fName, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        # empty files can't be mapped
+        return None
+
+
+class FileRange(object):
+    """Read-only view of one range of bytes in a file"""
+
+    def __init__(self, fName, start, end):
+        self.f = open(fName, "r")
+        self.f.seek(start)
+        self.left = end - start
+
+    def read(self, size=-1):
+        """Read up to size bytes, stopping at the end of the range"""
+        if size < 0 or size > self.left:
+            size = self.left
+        data = self.f.read(size)
+        self.left -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def split_file(fName, count):
+    """Return about count byte ranges of a file, each ending on a newline"""
+    size = os.path.getsize(fName)
+    bounds = [0]
+    with open(fName, "r") as f:
+        for part in range(1, count):
+            if part * size // count <= bounds[-1]:
+                continue
+            f.seek(part * size // count)
+            f.readline()
+            if f.tell() >= size:
+                break
+            if f.tell() > bounds[-1]:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def fill_range(task):
+    """Fill a partial dictionary from one range of a file, in a worker"""
+    fName, start, end = task
+    cmd = dict(WORKER_STATE["cmd"])
+    cmd["source"] = FileRange(fName, start, end)
+    cmd["mmap"] = False
+    dictionary = {}
+    try:
+        if cmd["mmap_source"]:
+            # offsets are sent back, and the source attached once merged
+            occurences, wordCount = fill_dictionary_mapped(
+                cmd, dictionary, WORKER_STATE["filterList"], cmd["source"],
+                start)
+        else:
+            occurences, wordCount = fill_dictionary(
+                cmd, dictionary, WORKER_STATE["filterList"])
+    finally:
+        cmd["source"].close()
+    return dictionary, occurences, wordCount
+
+
+def merge_dictionary(dictionary, occurences, partial):
+    """
+    Merge a partial dictionary and its word counts into full ones
+    Partials merged in file order keep every bucket in file order
+    """
+    partialDictionary, partialOccurences, wordCount = partial
+    for key, wordList in partialDictionary.items():
+        merged = dictionary.get(key)
+        if merged is None:
+            dictionary[key] = wordList
+        else:
+            buckets.merge_bucket(merged, wordList)
+    for word, count in partialOccurences.items():
+        occurences[word] = occurences.get(word, 0) + count
+    return wordCount
+
+
+def fill_dictionary_parallel(cmd, dictionary, filterList, text=None,
+                             store=None):
+    """
+    Fill a dictionary from byte ranges of the source, one per worker task
+    Falls back on fill_dictionary if the source isn't a large enough file
+    Given the mapped source, buckets store offsets into it instead
+    """
+    fName = cache.get_file_name(cmd["source"])
+    count = 0
+    if fName:
+        size = os.path.getsize(fName)
+        count = min(size // (cmd["shard_size"] * 1024), cmd["workers"] * 4)
+        # every worker's range has to fit in its share of the budget
+        if count >= 2 and store:
+            count = max(count, size * 2 * cmd["workers"] // store.budget + 1)
+    if count < 2 and text is not None:
+        return fill_dictionary_mapped(cmd, dictionary, filterList, text, 0,
+                                      text, store)
+    if count < 2:
+        return fill_dictionary(cmd, dictionary, filterList, store=store)
+
+    WORKER_STATE.update(cmd=cmd, filterList=filterList)
+    tasks = [(fName, start, end) for start, end in split_file(fName, count)]
+    occurences = {}
+    wordCount = 0
+    pool = multiprocessing.Pool(cmd["workers"])
+    try:
+        for partial in pool.imap(fill_range, tasks):
+            wordCount += merge_dictionary(dictionary, occurences, partial)
+            if store:
+                store.check(dictionary, occurences)
+    finally:
+        pool.close()
+        pool.join()
+    if text is not None:
+        buckets.attach_source(dictionary, text)
+    return occurences, wordCount
+
+
+def build_dictionary(cmd):
+    """
+    Return the filter list, dictionary, word counts, and total word count
+    Loads them from the cache if the same source was built before
+    With --memory-budget, buckets and counts that don't fit are spilled
+    to disk, and read back from there as they are used
+    """
+    store = None
+    if cmd["memory_budget"]:
+        store = spill.SpillStore(cmd["memory_budget"] * 1024 * 1024)
+    text = None
+    if cmd["mmap_source"]:
+        text = map_source(cmd)
+        if text is None:
+            options.print_msgs(cmd, ["NOTICE: The source can't be "
+                                     "memory-mapped, so --mmap-source has "
+                                     "been turned off."])
+            cmd["mmap_source"] = False
+    key = None
+    if cmd["cache"]:
+        key = cache.get_cache_key(cmd)
+    # kept for caching the frequency index -I sorts later
+    cmd["cache_key"] = key
+    if key:
+        with time_stage(cmd, "cache"):
+            data = cache.load(cmd, key, store and store.budget)
+        if data:
+            if text is not None:
+                buckets.attach_source(data[1], text)
+            return data
+
+    with time_stage(cmd, "filter"):
+        filterList = get_filter_list(cmd)
+    dictionary = {}
+    with time_stage(cmd, "fill"):
+        if cmd["workers"] > 1:
+            occurences, wordCount = fill_dictionary_parallel(
+                cmd, dictionary, filterList, text, store)
+        elif text is not None:
+            occurences, wordCount = fill_dictionary_mapped(
+                cmd, dictionary, filterList, text, 0, text, store)
+        else:
+            occurences, wordCount = fill_dictionary(cmd, dictionary,
+                                                    filterList, store=store)
+        if store and store.runs:
+            # the rest joins what was spilled, so it is all read one way
+            store.spill(dictionary, occurences)
+            dictionary = spill.SpilledDictionary(store, text)
+            occurences = spill.SpilledCounts(store)
+            cmd["spill_store"] = store
+    if cmd["timings"]:
+        cmd["timings"].add("filter", tokens=len(filterList))
+        cmd["timings"].add("fill", tokens=wordCount)
+    if store and store.runs:
+        # spilled dictionaries are too big to cache
+        return filterList, dictionary, occurences, wordCount
+    if key:
+        data = (filterList, dictionary, occurences, wordCount)
+        with time_stage(cmd, "cache"):
+            msgs = cache.store(cmd, key, data)
+        options.print_msgs(cmd, msgs)
+    return filterList, dictionary, occurences, wordCount
+
+
+def bucket_seed(baseSeed, key):
+    """Return the seed for a bucket, derived from a base seed and its key"""
+    digest = hashlib.sha1("%d:%r" % (baseSeed, key)).hexdigest()
+    return int(digest[:15], 16)
+
+
+def get_bucket_arrangement(cmd):
+    """
+    Return whether buckets are de-duplicated, shuffled, sorted, made
+    removable, and grouped before they are first used
+    """
 
     uniqueOnly = False
     shuffle = False
@@ -183,20 +767,127 @@ def sort_dictionary(cmd, dictionary):
         uniqueOnly = True
     if cmd["limited_usage"] and not cmd["block_shuffle"]:
         shuffle = True
+    # modes that take chosen words back out of their buckets
+    removable = (cmd["map_words"] or cmd["force_limited_usage"] or
+                 cmd["get_different"] and cmd["limited_usage"])
+    # -g picks apart from the original from buckets that are never used up
+    group = cmd["get_different"] and not (removable or alphabetical)
+    return uniqueOnly, shuffle, alphabetical, removable, group
+
+
+def compile_prepare_bucket(cmd):
+    """
+    Return a function that arranges a bucket before it is first used
+    Return None if buckets are used the way they are stored
+    """
+
+    arrangement = get_bucket_arrangement(cmd)
+    uniqueOnly, shuffle, alphabetical, removable, group = arrangement
+    if not any(arrangement):
+        return None
+    # each bucket is shuffled with its own seed, so the order buckets are
+    # first used in doesn't change how they are arranged
+    baseSeed = get_draw_seed(get_random(cmd)) if shuffle else 0
+    timings = cmd["timings"]
+
+    def prepare(key, wordList):
+        """De-duplicate, shuffle and sort a bucket as the mode needs"""
+        with time_stage(cmd, "sort"):
+            if timings:
+                timings.add("sort", tokens=len(wordList))
+            rng = random
+            if shuffle:
+                rng = random.Random(bucket_seed(baseSeed, key))
+            if isinstance(wordList, buckets.CountedBucket):
+                wordList.arrange(uniqueOnly, shuffle, alphabetical, rng)
+                return wordList
+            # spilled buckets are only given here when they just need sorting
+            if isinstance(wordList, spill.SpilledBucket):
+                wordList.sort(str.lower, reverse=True)
+                return wordList
+            if uniqueOnly:
+                wordList = list(set(wordList))
+            # randomizes words pulled later
+            if isinstance(wordList, buckets.OffsetBucket) and shuffle:
+                wordList.shuffle(rng)
+            elif shuffle:
+                rng.shuffle(wordList)
+            # offset buckets stay offsets until words have to be stored
+            if isinstance(wordList, buckets.OffsetBucket) and alphabetical:
+                wordList.sort(str.lower, reverse=True)
+            elif alphabetical:
+                wordList = sorted(wordList, key=str.lower)
+                wordList.reverse()
+            if isinstance(wordList, buckets.OffsetBucket) and removable:
+                wordList = wordList.shared_words()
+            if removable:
+                wordList = buckets.IndexedBucket(wordList, alphabetical)
+            elif group:
+                wordList = buckets.GroupedBucket(wordList)
+            return wordList
 
-    for case in dictionary:
-        for letter in dictionary[case]:
-            for length in dictionary[case][letter]:
-                wordList = dictionary[case][letter][length]
-                if uniqueOnly:
-                    wordList = list(set(wordList))
-                # randomizes words pulled later
-                if shuffle:
-                    random.shuffle(wordList)
-                if alphabetical:
-                    wordList = sorted(wordList, key=str.lower)
-                    wordList.reverse()
-                dictionary[case][letter][length] = wordList
+    return prepare
+
+
+def compile_reshuffle_bucket(cmd):
+    """
+    Return a function that shuffles a copy of a prepared bucket again,
+    so every call using up fresh copies gets its own order
+    Return None if buckets are never shuffled
+    """
+    if (not cmd["limited_usage"] or cmd["block_shuffle"] or
+            cmd["alphabetical_sort"]):
+        return None
+    # drawn for each call, so it follows the call's own seed
+    baseSeed = get_draw_seed(get_random(cmd))
+
+    def reshuffle(key, wordList):
+        """Shuffle a copied bucket with its own seed for this call"""
+        rng = random.Random(bucket_seed(baseSeed, key))
+        if isinstance(wordList, buckets.OffsetBucket):
+            wordList.shuffle(rng)
+        elif isinstance(wordList, buckets.IndexedBucket):
+            words = list(wordList)
+            rng.shuffle(words)
+            wordList = buckets.IndexedBucket(words)
+        elif isinstance(wordList, list):
+            rng.shuffle(wordList)
+        elif isinstance(wordList, spill.SpilledBucket):
+            # read whole, as shuffling moves words between its chunks
+            wordList = list(wordList)
+            rng.shuffle(wordList)
+        # counted buckets already pop a random occurence every time
+        return wordList
+
+    return reshuffle
+
+
+def prepare_dictionary(cmd, dictionary):
+    """
+    Return a dictionary that arranges each bucket the first time it is
+    used, so buckets the input never uses cost nothing
+    """
+    prepare = compile_prepare_bucket(cmd)
+    if isinstance(dictionary, spill.SpilledDictionary):
+        # spilled buckets are prepared as they are loaded, or read in
+        # place when words are only ever picked from them at random, or
+        # popped off the end, which every mode but these does
+        dictionary.prepare = prepare
+        dictionary.inPlace = not (cmd["force_limited_usage"] or
+                                  cmd["map_words"] or cmd["get_different"] or
+                                  cmd["compact_buckets"])
+        # buckets of words, not counts or offsets, that only need sorting
+        # are sorted on disk, so they are never loaded whole to be sorted
+        uniqueOnly, shuffle, alphabetical, removable, group = (
+            get_bucket_arrangement(cmd))
+        dictionary.sortInPlace = (alphabetical and not
+                                  (uniqueOnly or shuffle or removable or
+                                   cmd["compact_buckets"] or
+                                   cmd["mmap_source"]))
+        return dictionary
+    if prepare is None:
+        return dictionary
+    return buckets.PreparedDictionary(dictionary, prepare)
 
 
 def check_filter(cmd, filterList, word):
@@ -221,18 +912,93 @@ def get_filter_list(cmd):
     filterList = set([])
     if not (cmd["filter_same"] or cmd["filter_different"]):
         return filterList
-    for word in tokenizer(cmd["filter"]):
-        _, word, _ = parse_punctuation(cmd, word)
+    parse = get_token_parser(cmd)
+    for word in tokenizer(cmd["filter"], cmd["mmap"]):
+        _, word, _, _ = parse(word)
         if cmd["compare_lower"]:
             word = word.lower()
         filterList.add(word)
     return filterList
 
 
-def search_dictionary(dictionary, level, sort, wordData, indent=0, order=None):
-    """Recursively enter each level of a dictionary to find all contents"""
+class FrequencyIndex(object):
+    """
+    Unique words of every bucket, sorted by how often they occur
+    Found from the word counts instead of the buckets themselves, and
+    answers count ranges by skipping buckets outside of them entirely,
+    then bisecting the rest
+    Words are numbered, with their counts kept in a parallel array
+    Every unique word is kept, even when the counts were spilled to disk
+    """
+
+    def __init__(self, cmd, occurences, wordCount, state=None):
+        self.wordCount = wordCount
+        if state is not None:
+            # sorted by an earlier run, and loaded from the cache
+            self.words, self.counts, self.buckets = state
+            return
+        self.words = occurences.keys()
+        self.counts = array("l", occurences.itervalues())
+        get_metadata = get_metadata_key(cmd)
+        grouped = {}
+        for wordId, word in enumerate(self.words):
+            key = get_metadata(word)
+            wordIds = grouped.get(key)
+            if wordIds is None:
+                wordIds = grouped[key] = []
+            wordIds.append(wordId)
+        # each bucket's counts and word numbers, sorted by count
+        self.buckets = {}
+        counts = self.counts
+        words = self.words
+        for key, wordIds in grouped.items():
+            wordIds.sort(key=lambda wordId: (counts[wordId], words[wordId]))
+            self.buckets[key] = (array("l", [counts[i] for i in wordIds]),
+                                 array("l", wordIds))
+
+    def get_state(self):
+        """Return the sorted words and counts, to be cached"""
+        return self.words, self.counts, self.buckets
+
+    def find(self, lowest, highest):
+        """Iterator that yields bucket keys, and their word numbers in range"""
+        for key, (counts, wordIds) in self.buckets.items():
+            if counts[0] > highest or counts[-1] < lowest:
+                continue
+            start = bisect.bisect_left(counts, lowest)
+            end = bisect.bisect_right(counts, highest)
+            if start < end:
+                yield key, wordIds[start:end]
+
+
+def load_frequency_index(cmd, occurences, wordCount):
+    """
+    Return the frequency index of word counts, loaded from the cache if
+    --cache saved it for the same source and settings before, so the
+    vocabulary is only sorted once
+    """
+    key = cmd.get("cache_key")
+    if key:
+        with time_stage(cmd, "cache"):
+            state = cache.load(cmd, key + cache.INDEX_SUFFIX)
+        if state:
+            return FrequencyIndex(cmd, occurences, wordCount, state)
+    index = FrequencyIndex(cmd, occurences, wordCount)
+    if key:
+        with time_stage(cmd, "cache"):
+            msgs = cache.store(cmd, key + cache.INDEX_SUFFIX,
+                               index.get_state())
+        options.print_msgs(cmd, msgs)
+    return index
+
+
+def search_dictionary(dictionary, level, sort, words, describe, indent=0,
+                      order=None):
+    """
+    Iterator that recursively enters each level of a dictionary of word
+    numbers, yielding a line for each section and word as it is reached
+    """
 
-    output = []
     newIndent = indent
 
     if not order:
@@ -243,250 +1009,1152 @@ def search_dictionary(dictionary, level, sort, wordData, indent=0, order=None):
         if section not in dictionary:
             continue
         if section:
-            output.append("%s%s %s" % (
-                " " * indent, level[0], section))
+            yield "%s%s %s" % (" " * indent, level[0], section)
             newIndent = indent + 2
         if isinstance(dictionary[section], dict):
-            output += search_dictionary(dictionary[section], level[1:], 
-                                        sort, wordData, newIndent)
+            for line in search_dictionary(dictionary[section], level[1:],
+                                          sort, words, describe, newIndent):
+                yield line
         else:
-            wordList = dictionary[section]
-            wordList = list(set(wordList))
+            wordIds = dictionary[section]
             if sort:
-                wordList = sorted(wordList, key=str.lower)
-            for word in wordList:
-                line = "%s%s" % (" " * newIndent, word)
-                data = wordData.get(word)
-                if data["str"]:
-                    line += " %s" % data["str"]
-                output.append(line)
-
-    return output
-
-
-def create_word_data(cmd, occurences, wordCount):
+                # words only differing by case are listed uppercase first
+                wordIds = sorted(wordIds, key=lambda wordId: (
+                    words[wordId].lower(), words[wordId]))
+            for wordId in wordIds:
+                line = "%s%s" % (" " * newIndent, words[wordId])
+                info = describe(wordId)
+                if info:
+                    line += " %s" % info
+                yield line
+
+
+def compile_word_info(cmd, index):
     """
-    Return wordData, amalgamating word statistics and info strings
+    Return a function that gives the info string of a numbered word
+    Only words that are shown have their info formatted
     """
-
-    wordData = {}
+    counts = index.counts
+    # percent values need to be float
+    wordCount = index.wordCount * 1.0
+    showCount = cmd["frequency_count"]
+    percent = None
+    if cmd["frequency_percent"]:
+        percent = ("frequency: {:.%d%%}" % cmd["decimal_accuracy"]).format
+
+    if not (showCount or percent):
+        return lambda wordId: ""
+    if not percent:
+        return lambda wordId: "{count: %d}" % counts[wordId]
+    if not showCount:
+        return lambda wordId: "{%s}" % percent(counts[wordId] / wordCount)
+    return lambda wordId: "{count: %d, %s}" % (
+        counts[wordId], percent(counts[wordId] / wordCount))
+
+
+def get_count_range(cmd, wordCount):
+    """Return the lowest and highest word counts -x, -y, -X and -Y allow"""
+    lowest = cmd["count_minimum"]
+    highest = cmd["count_maximum"]
+    if not wordCount:
+        return lowest, highest
     # percent values need to be float
-    wordCount *= 1.0
-
-    for word, count in occurences.items():
-
-        data = {"str": "{"}
-        data["count"] = count
-        data["percent"] = count / wordCount * 100
-        if cmd["frequency_count"]:
-            data["str"] += "count: %d" % count
-            if cmd["frequency_percent"]:
-                data["str"] += ", "
-        if cmd["frequency_percent"]:
-            percent = "frequency: {:." + str(cmd["decimal_accuracy"]) + "%}"
-            data["str"] += percent.format(count / wordCount)
-        data["str"] += "}"
-        # ie if nothing was added
-        if data["str"] == "{}":
-            data["str"] = ""
-        wordData[word] = data
-
-    return wordData
-
-
-def limit_dictionary(cmd, dictionary, wordData):
-    """Limit a dictionary based on wanted word counts"""
-
-    for case in dictionary:
-        for letter in dictionary[case]:
-            for length in dictionary[case][letter]:
-                wordList = dictionary[case][letter][length]
-                newWordList = []
-                for word in wordList:
-                    count = wordData[word]["count"]
-                    percent = wordData[word]["percent"]
-                    if (count >= cmd["count_minimum"] and
-                            count <= cmd["count_maximum"] and
-                            percent >= cmd["percent_minimum"] and
-                            percent <= cmd["percent_maximum"]):
-                        newWordList.append(word)
-                    dictionary[case][letter][length] = newWordList
-
-    temp = copy.deepcopy(dictionary)
-    for case in temp:
-        for letter in temp[case]:
-            for length in temp[case][letter]:
-                if len(dictionary[case][letter][length]) == 0:
-                    dictionary[case][letter].pop(length)
-            if len(dictionary[case][letter]) == 0:
-                dictionary[case].pop(letter)
-        if len(dictionary[case]) == 0:
-            dictionary.pop(case)
-
-
-def generate_analysis(cmd, dictionary, occurences, wordCount):
+    total = wordCount * 1.0
+    percent = lambda count: count / total * 100
+
+    # no word is over 100%, or compares true with nan
+    minimum = cmd["percent_minimum"]
+    maximum = cmd["percent_maximum"]
+    if not (minimum <= 100 and maximum >= 0):
+        return lowest, -1
+
+    # starts from an estimate, then checks it the same way words are,
+    # never past the most any word can occur
+    if minimum > 0:
+        count = min(int(minimum * total / 100), wordCount)
+        while count > 0 and percent(count - 1) >= minimum:
+            count -= 1
+        while count <= wordCount and percent(count) < minimum:
+            count += 1
+        lowest = max(lowest, count)
+    # every word is within a maximum of 100% or more
+    if maximum < 100:
+        count = min(int(maximum * total / 100), wordCount)
+        while count < wordCount and percent(count + 1) <= maximum:
+            count += 1
+        while count >= 0 and percent(count) > maximum:
+            count -= 1
+        highest = min(highest, count)
+    return lowest, highest
+
+
+def limit_dictionary(cmd, index):
+    """
+    Return the numbers of words with wanted word counts, nested by case,
+    letter, and length, leaving out any section with no words left
+    """
+    lowest, highest = get_count_range(cmd, index.wordCount)
+    dictionary = {}
+    for (case, letter, length), wordIds in index.find(lowest, highest):
+        dictionary.setdefault(case, {}).setdefault(letter, {})[length] = \
+            wordIds
+    return dictionary
+
+
+def generate_analysis(cmd, index):
     """Generates an analysis of statistics for dictionary findings"""
 
-    output = []
-    wordData = create_word_data(cmd, occurences, wordCount)
-    limit_dictionary(cmd, dictionary, wordData)
+    describe = compile_word_info(cmd, index)
+    dictionary = limit_dictionary(cmd, index)
 
     order = ["upper", "title", "lower", "mixed", ""]
     level = ["Case", "Letter", "Length"]
     sort = not cmd["block_inspection_sort"]
-    output = search_dictionary(dictionary, level, sort, wordData, order=order)
-    for line in output:
-        check_speed(cmd)
-        cmd["output"].write(line + "\n")
+    writer = OutputWriter(cmd)
+    for line in search_dictionary(dictionary, level, sort, index.words,
+                                  describe, order=order):
+        writer.write(line + "\n")
+    writer.flush()
 
 
-def get_word_list(cmd, dictionary, word):
-    """Sort through a dictionary to find a matching wordList, if any"""
-    wordList = dictionary
-    for layer in get_metadata(cmd, word):
-        wordList = wordList.get(layer)
-        if not wordList:
-            return []
-    return wordList
+def get_random_word(wordList, rng=random):
+    """Get a random word from a given wordList"""
+    return wordList[rng.randint(0, len(wordList) - 1)]
 
 
-def get_random_word(wordList):
-    """Get a random word from a given wordList"""
-    return wordList[random.randint(0, len(wordList) - 1)]
+def use_numpy_random(cmd):
+    """Check if random numbers should be drawn in batches with NumPy"""
+    return cmd["numpy_random"] and draws.available()
 
 
-def find_replacement(cmd, dictionary, wordMap, word):
+def get_random(cmd):
     """
-    Try to get a suitable replacement word
-    Return an empty string if no replacement can be found
-    Update wordMap along the way as needed
+    Return the random number generator for cmd, which is random itself
+    unless it was given its own, by -R or a seeded call
     """
+    return cmd.get("random") or random
 
-    wordList = get_word_list(cmd, dictionary, word)
-    if not wordList:
-        newWord = ""
+
+def get_draw_seed(rng=random):
+    """
+    Return a seed for a separate stream of random numbers
+    Taken from rng, so it follows -R and the seed of each shard
+    """
+    return rng.getrandbits(32)
+
+
+def compile_find_replacement(cmd, dictionary, wordMap):
+    """
+    Return a function that tries to get a suitable replacement word
+    The function returns an empty string if no replacement can be found,
+    and updates wordMap along the way as needed
+    """
+    get_metadata = get_metadata_key(cmd)
+    takeChosen = cmd["limited_usage"] or cmd["map_words"]
+    rng = get_random(cmd)
+
+    if cmd.get("planned_words"):
+        def pick(wordList, word):
+            """Take the next word picked for this shard while planning it"""
+            return wordList.pop()
     elif cmd["alphabetical_sort"]:
-        newWord = wordList.pop()
-    elif len(wordList) == 1:
-        newWord = wordList[0]
+        def pick(wordList, word):
+            """Take the next word in alphabetical order"""
+            return wordList.pop()
     elif cmd["map_words"] or cmd["get_different"]:
-        newWord = word
-        attempts = 0
-        while newWord == word and attempts < cmd["get_attempts"]:
-            newWord = get_random_word(wordList)
-            attempts += 1
-        if cmd["limited_usage"] or cmd["map_words"]:
-            wordList.remove(newWord)
+        def pick(wordList, word):
+            """Pick a random word that differs from the original"""
+            if len(wordList) == 1:
+                return wordList[0]
+            newWord = wordList.random_other(word, rng)
+            if takeChosen:
+                wordList.remove(newWord)
+            return newWord
+    elif ((cmd["equal_weighting"] or cmd["relative_usage"]) and
+            use_numpy_random(cmd)):
+        fraction = draws.fractions(get_draw_seed(rng)).next
+
+        def pick(wordList, word):
+            """Pick any random word, from a batch of random numbers"""
+            if len(wordList) == 1:
+                return wordList[0]
+            return wordList[int(fraction() * len(wordList))]
     elif cmd["equal_weighting"] or cmd["relative_usage"]:
-        newWord = get_random_word(wordList)
+        def pick(wordList, word):
+            """Pick any random word"""
+            if len(wordList) == 1:
+                return wordList[0]
+            return get_random_word(wordList, rng)
     # falls back on limited usage
     else:
-        # popping from the end means less memory usage
-        newWord = wordList.pop()
+        def pick(wordList, word):
+            """Take the next word, as buckets are shuffled in advance"""
+            if len(wordList) == 1:
+                return wordList[0]
+            # counted buckets pop a random occurence instead
+            if isinstance(wordList, buckets.CountedBucket):
+                return wordList.pop(rng)
+            # popping from the end means less memory usage
+            return wordList.pop()
+
+    def find_replacement(word):
+        """Try to get a suitable replacement word"""
+        wordList = dictionary.get(get_metadata(word))
+        if not wordList:
+            return ""
+        return pick(wordList, word)
 
     if cmd["map_words"]:
-        # print(wordList)
-        wordMap[word] = newWord
-    elif (cmd["force_limited_usage"] and not cmd["limited_usage"] and
-            word in wordList):
-        wordList.remove(word)
+        def map_replacement(word):
+            """Replace a word, and map it to its replacement"""
+            newWord = wordMap[word] = find_replacement(word)
+            return newWord
+        return map_replacement
+
+    if cmd["force_limited_usage"] and not cmd["limited_usage"]:
+        def limited_replacement(word):
+            """Replace a word, and use up the original word"""
+            newWord = find_replacement(word)
+            wordList = dictionary.get(get_metadata(word))
+            if wordList and word in wordList:
+                wordList.remove(word)
+            return newWord
+        return limited_replacement
+
+    return find_replacement
+
+
+def compile_get_new_word(cmd, dictionary, filterList, wordMap):
+    """
+    Return a function that gets a new word from any possible method
+    Filter and word map checks are only included when they can matter
+    Words whose output can never change are remembered for the run
+    """
+    # filters only ever pass words with -S on its own
+    useFilter = cmd["filter_same"] and not cmd["filter_different"]
+    compareLower = cmd["compare_lower"]
+    # output of words that pass the filter or are mapped, or every word
+    # with -H, which bucket state can't change
+    decided = {}
+    get_decided = decided.get
+
+    if cmd["pure_mode"]:
+        if not useFilter:
+            def get_new_word(word):
+                """Drop every word"""
+                return ""
+            return get_new_word
+
+        def get_new_word(word):
+            """Keep words passing the filter, and drop all others"""
+            result = get_decided(word)
+            if result is None:
+                result = decided[word] = (
+                    word if (word.lower() if compareLower else word) in
+                    filterList else "")
+            return result
+        return get_new_word
+
+    if cmd["halt_rearranger"]:
+        def get_new_word(word):
+            """Keep every word as it is"""
+            return word
+    else:
+        get_new_word = compile_find_replacement(cmd, dictionary, wordMap)
+
+    if not (wordMap or cmd["map_words"] or useFilter):
+        return get_new_word
+    # with -M the first replacement is used from then on
+    keepResults = cmd["map_words"] or cmd["halt_rearranger"]
+
+    # the filter comes before the word map
+    for word, result in wordMap.items():
+        if result and not (useFilter and (
+                word.lower() if compareLower else word) in filterList):
+            decided[word] = result
+    undecided = get_new_word
+
+    def get_new_word(word):
+        """
+        Use a word's output straight away once it is decided, otherwise
+        keep words passing the filter, then replace the rest
+        """
+        result = get_decided(word)
+        if result is not None:
+            return result
+        if useFilter:
+            if (word.lower() if compareLower else word) in filterList:
+                decided[word] = word
+                return word
+        result = undecided(word)
+        if keepResults and result:
+            decided[word] = result
+        return result
+
+    return get_new_word
+
+
+def compile_rearranger(cmd, dictionary, filterList, wordMap):
+    """Return a function that gives the output for a stripped word"""
+    get_new_word = compile_get_new_word(cmd, dictionary, filterList, wordMap)
+    if not cmd["jabberwocky"]:
+        return get_new_word
+
+    chance = cmd["jabberwocky_chance"]
+    rng = get_random(cmd)
+    if use_numpy_random(cmd):
+        roll = draws.percent_rolls(get_draw_seed(rng)).next
+    else:
+        roll = functools.partial(rng.randint, 0, 99)
 
-    return newWord
+    def rearrange(word):
+        """Get a new word, and sometimes jabberwocky it with the original"""
+        newWord = get_new_word(word)
+        if roll() < chance:
+            newWord = jabberwocky(word, newWord)
+        return newWord
 
+    return rearrange
 
-def get_new_word(cmd, dictionary, filterList, wordMap, word):
-    """Get a new word from any possible method"""
-    passedFilter = check_filter(cmd, filterList, word)
-    result = wordMap.get(word)
-    if cmd["pure_mode"] and not passedFilter:
-        newWord = ""
-        # print("pure filter failure: %s" % word)
-    elif passedFilter:
-        newWord = word
-        # print("filter success: %s" % word)
-    elif result:
-        newWord = result
-        # print("word map success: %s from %s" % (result, word))
-    elif cmd["halt_rearranger"]:
-        newWord = word
-        # print("rearranger halted: %s" % word)
-    else:
-        newWord = find_replacement(cmd, dictionary, wordMap, word)
-        # print("replaced: %s with %s" % (word, newWord))
-    return newWord
 
+def compile_kick(cmd):
+    """
+    Return a function that decides if a word gets a newline after it
+    Return None if words can never be kicked
+    """
+    if cmd["hard_truncate_newlines"]:
+        return None
+    # with no chance the roll only matters for keeping random numbers in
+    # step, which nothing else needs when the rest is deterministic
+    drawsRandom = (cmd["jabberwocky"] or not (cmd["halt_rearranger"] or
+                   cmd["pure_mode"] or cmd["alphabetical_sort"]))
+    if cmd["kick_chance"] <= 0 and not drawsRandom:
+        return None
+
+    chance = cmd["kick_chance"]
+    rng = get_random(cmd)
+    if use_numpy_random(cmd):
+        # each stream has its own seed, so nothing else needs keeping in
+        # step with the kick rolls
+        if chance <= 0:
+            return None
+        roll = draws.percent_rolls(get_draw_seed(rng)).next
+
+        def kick():
+            """Roll for a newline, from a batch of rolls"""
+            return roll() < chance
+
+        return kick
+
+    randint = rng.randint
+
+    def kick():
+        """Roll for a newline"""
+        return randint(0, 99) < chance
+
+    return kick
+
+
+class OutputWriter(object):
+    """
+    Bounded buffer that streams finished lines to an output file
+    Remembers the most recent lines so newline truncation still works
+    Also builds the line carried across shards from the words put in it,
+    the same way generate_text builds lines
+    """
+
+    def __init__(self, cmd, bufferSize=OUTPUT_BUFFER_SIZE):
+        self.cmd = cmd
+        self.out = cmd["output"]
+        self.bufferSize = bufferSize
+        self.buffer = []
+        self.buffered = 0
+        self.recent = ["", ""]
+        self.keepMultiple = not cmd["truncate_multiple_newlines"]
+        self.keepNewlines = not cmd["hard_truncate_newlines"]
+        self.keepWhitespace = not cmd["truncate_whitespace"]
+        # pieces of the current line, their length, and the last character
+        # put in it
+        self.line = []
+        self.lineSize = 0
+        self.last = ""
+
+    def add_space(self):
+        """Put a space from the input in the line"""
+        self.line.append(" ")
+        self.lineSize += 1
+        self.last = " "
+
+    def add_word(self, text, kicked=False):
+        """
+        Put a word and its punctuation in the line, followed by a space,
+        or a newline if it was kicked, or end the line if it ends in one
+        """
+        if text:
+            self.line.append(text)
+            self.lineSize += len(text)
+            self.last = text[-1]
+        if kicked:
+            self.line.append("\n")
+            self.last = "\n"
+        elif self.last and self.last != "\n" and self.keepWhitespace:
+            # written before the space, so it can still be removed if a
+            # newline follows, and straight away with -T, as lines never
+            # end then
+            if not self.keepNewlines or self.lineSize >= LINE_PART_SIZE:
+                self.write_partial("".join(self.line))
+                self.line = []
+                self.lineSize = 0
+            self.line.append(" ")
+            self.lineSize += 1
+            self.last = " "
+        else:
+            # remove trailing spaces
+            self.write("".join(self.line).replace(" \n", "\n"))
+            self.line = []
+            self.lineSize = 0
+            self.last = ""
+
+    def write(self, line):
+        """Queue a finished line, flushing when the buffer is full"""
+        self.recent = [self.recent[1], line]
+        if self.cmd["slow_output"]:
+            check_speed(self.cmd)
+            self.out.write(line)
+            self.out.flush()
+            return
+        self.queue(line)
+
+    def write_partial(self, text):
+        """Queue part of a line, which isn't counted as a line written"""
+        if self.cmd["slow_output"]:
+            self.out.write(text)
+            self.out.flush()
+            return
+        self.queue(text)
+
+    def queue(self, text):
+        """Add text to the buffer, flushing when the buffer is full"""
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.bufferSize:
+            self.flush()
+
+    def ends_in_newlines(self):
+        """Check if the last two lines written both ended in a newline"""
+        return (self.recent[0].endswith("\n") and
+                self.recent[1].endswith("\n"))
+
+    def newline(self):
+        """Write a newline from the input, unless -N truncates it"""
+        if self.keepMultiple or not self.ends_in_newlines():
+            self.write("\n")
+
+    def finish(self):
+        """Write out the unfinished line, and everything queued so far"""
+        # an empty line would count as written, which -N would notice
+        if self.line:
+            self.write("".join(self.line))
+        self.flush()
+        # ensures one newline at the end of the output
+        if self.keepNewlines and self.last and self.last != "\n":
+            self.out.write("\n")
+
+    def flush(self):
+        """Write out everything queued so far"""
+        with time_stage(self.cmd, "output"):
+            if self.buffer:
+                self.out.write("".join(self.buffer))
+                self.buffer = []
+                self.buffered = 0
+            self.out.flush()
+
+
+class ShardWriter(OutputWriter):
+    """
+    Writer that keeps the output of one shard, to be passed through the
+    main writer in order
+    Lines written before the two last lines are known, and the newlines
+    that depend on them, are kept one by one for the main writer to
+    decide with what came before the shard, and the rest are joined
+    The line left unfinished before the shard isn't known either, so
+    spaces and words are kept for the main writer to put in that line,
+    until one ends it, after which generate_text builds the shard's lines
+    """
+
+    def __init__(self, cmd):
+        OutputWriter.__init__(self, cmd)
+        # lines from before the shard aren't known yet
+        self.recent = [None, None]
+        # lines, None for each newline left for the main writer, and
+        # ("space",), ("word", text, kicked) and ("partial", text) for
+        # what the main writer puts in its line
+        self.pieces = []
+        # parts of a line kept with it, until the two last lines are known
+        self.parts = []
+        # whether the line from before the shard is still unfinished
+        self.carried = True
+        # the last character put in the line, which stays None while it
+        # could still be anything from before the shard
+        self.last = None
+
+    def keep(self, piece):
+        """Keep a piece after everything written before it"""
+        if self.buffer:
+            self.pieces.append("".join(self.buffer))
+            self.buffer = []
+        self.pieces.append(piece)
+
+    def add_space(self):
+        self.keep(("space",))
+        self.last = " "
+
+    def add_word(self, text, kicked=False):
+        self.keep(("word", text, kicked))
+        if text:
+            self.last = text[-1]
+        if kicked:
+            self.last = "\n"
+        elif self.last and self.last != "\n" and self.keepWhitespace:
+            # parts of the line the main writer writes aren't lines
+            self.last = " "
+        elif self.last is not None or not self.keepWhitespace:
+            # the main writer ends its line here, so the rest is known,
+            # and so is how it ends, unless the line before could be
+            # anything
+            ending = None
+            if self.last is not None:
+                ending = "\n" if self.last == "\n" else ""
+            self.recent = [self.recent[1], ending]
+            self.carried = False
+            self.last = ""
+        else:
+            # whether it ended the line from before is left unknown too
+            self.recent = [self.recent[1], None]
+
+    def write(self, line):
+        if self.parts:
+            line = "".join(self.parts) + line
+            self.parts = []
+        if None in self.recent:
+            self.pieces.append(line)
+        else:
+            self.buffer.append(line)
+        self.recent = [self.recent[1], line]
+
+    def newline(self):
+        if None in self.recent and not self.keepMultiple:
+            self.pieces.append(None)
+            # whether it was written is left unknown too
+            self.recent = [self.recent[1], None]
+        else:
+            OutputWriter.newline(self)
 
-def generate_text(cmd, dictionary, filterList, wordMap):
-    """Rearrange or filter the input text to create a new output"""
+    def write_partial(self, text):
+        if None in self.recent:
+            self.parts.append(text)
+        else:
+            self.buffer.append(text)
+
+    def finish(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def get_output(self):
+        """
+        Return the kept pieces, the last two lines written, and the line
+        left unfinished with the last character put in it, or None for
+        both if the main writer's line was never finished
+        """
+        if self.parts:
+            self.keep(("partial", "".join(self.parts)))
+            self.parts = []
+        if self.buffer:
+            self.pieces.append("".join(self.buffer))
+            self.buffer = []
+        if self.carried:
+            return self.pieces, self.recent, None, None
+        return self.pieces, self.recent, "".join(self.line), self.last
+
+    @staticmethod
+    def replay(writer, pieces, recent, line, last):
+        """
+        Pass the output of a shard through the main writer, putting what
+        the shard left to it in the line left unfinished before the shard
+        """
+        for piece in pieces:
+            if piece is None:
+                writer.newline()
+            elif isinstance(piece, str):
+                writer.write(piece)
+            elif piece[0] == "space":
+                writer.add_space()
+            elif piece[0] == "word":
+                writer.add_word(piece[1], piece[2])
+            else:
+                writer.write_partial(piece[1])
+        # lines joined together still count as they were written
+        if None not in recent:
+            writer.recent = list(recent)
+        if line is not None:
+            writer.line = [line] if line else []
+            writer.lineSize = len(line)
+            writer.last = last
+
+
+def generate_text(cmd, dictionary, filterList, wordMap, writer=None):
+    """
+    Rearrange or filter the input text to create a new output
+    Writes through writer if given, or a new one otherwise
+    """
 
-    output = []
-    line = ""
-    for word in tokenizer(cmd["input"]):
+    parse = get_token_parser(cmd)
+    rearrange = compile_rearranger(cmd, dictionary, filterList, wordMap)
+    kick = compile_kick(cmd)
+    keepNewlines = not cmd["hard_truncate_newlines"]
+    keepWhitespace = not cmd["truncate_whitespace"]
+
+    if writer is None:
+        writer = OutputWriter(cmd)
+    # words go through a shard's writer until they end the line carried
+    # from the shard before, and are put in the line here after that, the
+    # same way OutputWriter.add_word would
+    carried = isinstance(writer, ShardWriter)
+    # pieces of the current line, their length, and the last character
+    # put in it
+    line = []
+    lineSize = 0
+    last = ""
+    words = tokenizer(cmd["input"], cmd["mmap"])
+    if cmd["timings"]:
+        words = cmd["timings"].count("generate", words)
+    for word in words:
 
         if word == "\n":
-            if (not cmd["hard_truncate_newlines"] and
-                    not (cmd["truncate_multiple_newlines"] and
-                        len(output) >= 2 and
-                        output[-1][-1] == "\n" and
-                        output[-2][-1] == "\n")):
-                output.append("\n")
+            if keepNewlines:
+                writer.newline()
             continue
         if word == "":
-            if not cmd["truncate_whitespace"]:
-                line += " "
+            if carried and keepWhitespace:
+                writer.add_space()
+            elif keepWhitespace:
+                line.append(" ")
+                lineSize += 1
+                last = " "
             continue
 
-        puncBefore, word, puncAfter = parse_punctuation(cmd, word)
-        line += puncBefore
-        if word:
-            newWord = get_new_word(cmd, dictionary, filterList, wordMap, word)
-            if (cmd["jabberwocky"] and 
-                    random.randint(0, 99) < cmd["jabberwocky_chance"]):
-                newWord = jabberwocky(word, newWord)
-                # print("jabbered! %s" % newWord)
-            line += newWord
-        line += puncAfter
-        if (not cmd["hard_truncate_newlines"] and 
-                random.randint(0, 99) < cmd["kick_chance"]):
-            line += "\n"
-        elif line and line[-1] != "\n" and not cmd["truncate_whitespace"]:
-            line += " "
+        puncBefore, word, puncAfter, _ = parse(word)
+        newWord = rearrange(word) if word else ""
+        if carried:
+            writer.add_word(puncBefore + newWord + puncAfter,
+                            kick is not None and kick())
+            carried = writer.carried
+            continue
+        for piece in (puncBefore, newWord, puncAfter):
+            if piece:
+                line.append(piece)
+                lineSize += len(piece)
+                last = piece[-1]
+        if kick and kick():
+            line.append("\n")
+            last = "\n"
+        elif last and last != "\n" and keepWhitespace:
+            # written before the space, so it can still be removed if a
+            # newline follows, and straight away with -T, as lines never
+            # end then
+            if not keepNewlines or lineSize >= LINE_PART_SIZE:
+                writer.write_partial("".join(line))
+                line = []
+                lineSize = 0
+            line.append(" ")
+            lineSize += 1
+            last = " "
         else:
             # remove trailing spaces
-            output.append(line.replace(" \n", "\n"))
-            line = ""
+            writer.write("".join(line).replace(" \n", "\n"))
+            line = []
+            lineSize = 0
+            last = ""
 
-    output.append(line)
-    for line in output:
-        check_speed(cmd)
-        cmd["output"].write(line)
-    # ensures one newline at the end of the output
-    if not cmd["hard_truncate_newlines"] and (line and line[-1] != "\n"):
-        cmd["output"].write("\n")
+    if not carried:
+        writer.line = line
+        writer.lineSize = lineSize
+        writer.last = last
+    writer.finish()
 
 
-def main():
-    """Run the program"""
+def split_shard(text, shardSize, final=False):
+    """
+    Return where to cut the first shard off some text
+    Cuts after blank lines where possible, or else after any line
+    Return 0 if more text is needed first
+    """
+    if len(text) < shardSize:
+        return len(text) if final else 0
+    start = text.find("\n\n", shardSize - 1)
+    if start != -1:
+        end = start + 2
+        while end < len(text) and text[end] == "\n":
+            end += 1
+        # only cut once the next paragraph is known to have started
+        if end < len(text) or final:
+            return end
+    if final or len(text) >= 2 * shardSize:
+        return text.rfind("\n") + 1 or len(text)
+    return 0
+
+
+def read_shards(blocks, shardSize):
+    """Iterator that yields shards of text from blocks of text"""
+    text = ""
+    for block in blocks:
+        text += block
+        cut = split_shard(text, shardSize)
+        while cut:
+            yield text[:cut]
+            text = text[cut:]
+            cut = split_shard(text, shardSize)
+    while text:
+        cut = split_shard(text, shardSize, True)
+        yield text[:cut]
+        text = text[cut:]
+
+
+def shard_seed(baseSeed, index):
+    """Return the seed for a shard, derived from a base seed and its index"""
+    digest = hashlib.sha1("%d:%d" % (baseSeed, index)).hexdigest()
+    return int(digest[:15], 16)
+
+
+def keeps_picked_words(cmd):
+    """
+    Check if words are picked at random and left in their buckets, the
+    way compile_find_replacement picks them
+    """
+    if cmd["alphabetical_sort"] or cmd["map_words"]:
+        return False
+    if cmd["get_different"]:
+        return not cmd["limited_usage"]
+    return cmd["equal_weighting"] or cmd["relative_usage"]
+
+
+def make_quota(wordList, words):
+    """Return words taken from a bucket as a new bucket of the same kind"""
+    if isinstance(wordList, buckets.CountedBucket):
+        quota = buckets.CountedBucket()
+        for word in words:
+            quota.append(word)
+        quota.randomPop = wordList.randomPop
+        return quota
+    if isinstance(wordList, buckets.IndexedBucket):
+        return buckets.IndexedBucket(words, wordList.ordered)
+    if isinstance(wordList, buckets.GroupedBucket):
+        return buckets.GroupedBucket(words)
+    return words
+
+
+def take_words(wordList, count, sample=False, rng=random, keepLast=True):
+    """
+    Take up to count words off the end of a bucket, or at random from
+    anywhere in it for modes that pick words at random
+    With keepLast, the last word is never taken, as picks return it
+    forever once it is all that is left, so the quota is filled up with
+    it instead
+    Return them as a new bucket of the same kind
+    """
+    taken = []
+    while len(wordList) > keepLast and len(taken) < count:
+        if sample:
+            taken.append(buckets.take_random(wordList, rng))
+        elif isinstance(wordList, buckets.CountedBucket):
+            taken.append(wordList.pop(rng))
+        else:
+            taken.append(wordList.pop())
+    if keepLast and wordList and len(taken) < count:
+        taken += [wordList[0]] * (count - len(taken))
+    taken.reverse()
+    return make_quota(wordList, taken)
 
-    cmd = options.get_command()
+
+def draw_words(wordList, count, rng=random):
+    """
+    Return count random occurences of a bucket as a new bucket of the
+    same kind, leaving the bucket as it was
+    """
+    last = len(wordList) - 1
+    return make_quota(wordList, [wordList[rng.randint(0, last)]
+                                 for _ in xrange(count)])
+
+
+def plan_shard(cmd, dictionary, filterList, wordMap, text, mapWords):
+    """
+    Work out the words a shard needs that workers can't share
+    With usage limiting, return the shard's quota of every bucket it uses
+    Modes that pick at random and leave picked words be get a random draw
+    of each bucket instead, as quotas taken off the end of each bucket
+    would only hold the end of the source
+    With -U, pick every word here in input order, each using up its
+    original word, and return the picked words of each bucket in order
+    With -M, map every new word in the shard, and return its word map
+    """
+    parse = get_token_parser(cmd)
+    useFilter = cmd["filter_same"] and not cmd["filter_different"]
+    compareLower = cmd["compare_lower"]
+    keepPicked = keeps_picked_words(cmd)
+    rng = get_random(cmd)
+    # -U also uses up the original word
+    useOriginal = cmd["force_limited_usage"] and not cmd["limited_usage"]
+    # -g -u picks at random, from buckets -b may have left unshuffled
+    sample = cmd["get_different"] and not cmd["alphabetical_sort"]
+    # -a takes every word in order, even the last one
+    keepLast = not cmd["alphabetical_sort"]
+    if mapWords or useOriginal:
+        find_replacement = compile_find_replacement(cmd, dictionary, wordMap)
+    shardMap = {}
+    demand = {}
+    picked = {}
+
+    for word in split_block(text):
+        if word == "\n" or word == "":
+            continue
+        _, word, _, key = parse(word)
+        if (not word or useFilter and
+                (word.lower() if compareLower else word) in filterList):
+            continue
+        result = wordMap.get(word)
+        if mapWords:
+            if not result:
+                result = find_replacement(word)
+            shardMap[word] = result
+        elif not result and useOriginal:
+            picked.setdefault(key, []).append(find_replacement(word))
+        elif not result:
+            demand[key] = demand.get(key, 0) + 1
+
+    if mapWords:
+        return None, shardMap
+    if useOriginal:
+        # workers take the picked words off the end
+        for words in picked.itervalues():
+            words.reverse()
+        return picked, None
+    quotas = {}
+    for key, count in demand.items():
+        wordList = dictionary.get(key)
+        if wordList and keepPicked:
+            quotas[key] = draw_words(wordList, count, rng)
+        elif wordList:
+            quotas[key] = take_words(wordList, count, sample, rng,
+                                     keepLast)
+    return quotas, None
+
+
+def generate_shard(task):
+    """Rearrange one shard of the input in a worker process"""
+    text, seed, dictionary, wordMap = task
+    cmd = dict(WORKER_STATE["cmd"])
+    cmd["input"] = StringIO(text)
+    cmd["output"] = None
+    if dictionary is None:
+        dictionary = WORKER_STATE["dictionary"]
+    if wordMap is None:
+        wordMap = WORKER_STATE["wordMap"]
+    cmd["random"] = random.Random(seed)
+    writer = ShardWriter(cmd)
+    generate_text(cmd, dictionary, WORKER_STATE["filterList"], wordMap,
+                  writer)
+    return writer.get_output()
+
+
+def generate_text_parallel(cmd, dictionary, filterList, wordMap):
+    """
+    Rearrange the input in shards split across worker processes
+    Each shard is seeded from -R and its index, so output only depends
+    on the seed and shard size, and not on the number of workers
+    Usage limited modes give each shard its own quota of every bucket,
+    planned in input order, -U picks every word while planning, and -M
+    maps words in input order before sharing the map, so no word is used
+    more than it would be otherwise
+    Workers get everything else through WORKER_STATE, which only reaches
+    them because the pool forks, so this needs a platform that forks
+    """
     if cmd["random_seed"] != -1:
-        random.seed(cmd["random_seed"])
+        baseSeed = cmd["random_seed"]
+    else:
+        baseSeed = get_random(cmd).getrandbits(32)
+    rearranging = not (cmd["halt_rearranger"] or cmd["pure_mode"])
+    mapWords = rearranging and cmd["map_words"]
+    limited = rearranging and not mapWords and (cmd["limited_usage"] or
+        cmd["force_limited_usage"] or cmd["alphabetical_sort"])
+
+    workerCmd = dict(cmd)
+    workerCmd["mmap"] = False
+    # workers only look words up in the map they are given
+    workerCmd["map_words"] = False
+    if limited and cmd["force_limited_usage"] and not cmd["limited_usage"]:
+        # words were picked, and original words used up, while planning
+        # each shard
+        workerCmd["force_limited_usage"] = False
+        workerCmd["planned_words"] = True
+    WORKER_STATE.update(cmd=workerCmd, dictionary=dictionary,
+                        filterList=filterList, wordMap=wordMap)
+    if mapWords:
+        WORKER_STATE["dictionary"] = {}
+
+    if isinstance(cmd["input"], TokenSpool):
+        blocks = cmd["input"].text_blocks()
+    else:
+        blocks = read_blocks(cmd["input"], useMmap=cmd["mmap"])
+
+    pool = multiprocessing.Pool(cmd["workers"])
+    pending = collections.deque()
+    # shards are passed through one writer, so -N, and lines left
+    # unfinished, carry across them
+    writer = OutputWriter(cmd)
+    try:
+        shards = read_shards(blocks, cmd["shard_size"] * 1024)
+        for index, text in enumerate(shards):
+            quotas = shardMap = None
+            if mapWords or limited:
+                quotas, shardMap = plan_shard(cmd, dictionary, filterList,
+                                              wordMap, text, mapWords)
+            task = (text, shard_seed(baseSeed, index), quotas, shardMap)
+            pending.append(pool.apply_async(generate_shard, (task,)))
+            # only keep a few shards in flight at once
+            while len(pending) > 2 * cmd["workers"]:
+                ShardWriter.replay(writer, *pending.popleft().get())
+        while pending:
+            ShardWriter.replay(writer, *pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+    writer.finish()
+
+
+def generate_batch(rearranger):
+    """
+    Rearrange every input in a batch against one built dictionary
+    Each input gets fresh buckets, shuffled again just for it, so inputs
+    use up and order words apart from each other, like separate runs
+    """
+    for inName, outName in options.get_batch(rearranger.cmd):
+        with open(inName, "r") as inFile, open(outName, "w") as outFile:
+            rearranger.rearrange(inFile, outFile, fresh=True)
 
-    wordMap = {}
-    if cmd["word_map"]:
-        fill_word_map(cmd, wordMap)
-    filterList = get_filter_list(cmd)
-    dictionary = {}
-    occurences, wordCount = fill_dictionary(cmd, dictionary, filterList)
-    sort_dictionary(cmd, dictionary)
 
+def open_stream(stream, mode="r"):
+    """
+    Return an open file for a file name, or the given stream otherwise
+    Also return whether the file was opened here, and so should be closed
+    """
+    if isinstance(stream, basestring):
+        return open(stream, mode), True
+    return stream, False
+
+
+class Rearranger(object):
+    """
+    Rearrange text against a dictionary that is built once and kept
+    Settings are a dict like the one options.get_settings returns
+    With -I, only word counts are built, so the dictionary can only be
+    inspected
+    """
+
+    def __init__(self, settings=None):
+        if settings is None:
+            settings = options.get_settings()
+        self.cmd = dict(settings)
+        if self.cmd["timings"] is True:
+            self.cmd["timings"] = Timings()
+        # shared by every call, so tokens seen once stay parsed
+        self.cmd["token_cache"] = TokenCache(self.cmd)
+        self.filterList = set([])
+        self.dictionary = {}
+        self.occurences = {}
+        self.wordCount = 0
+        self.wordMap = {}
+        # built the first time the dictionary is inspected
+        self.frequencyIndex = None
+        self.built = False
+
+    def build(self, source=None, filterFile=None, wordMap=None):
+        """
+        Build the dictionary from a source, given as a file name or stream
+        The filter and word map files default to the ones in settings,
+        and a filter for -S or -D defaults to the source file
+        """
+        cmd = self.cmd
+        if source is None:
+            source = cmd["source"]
+        if filterFile is None:
+            filterFile = cmd["filter"]
+        if wordMap is None:
+            wordMap = cmd["word_map"]
+        if source is None:
+            raise ValueError("a source is needed to build a dictionary")
+        if (filterFile is None and isinstance(source, basestring) and
+                (cmd["filter_same"] or cmd["filter_different"])):
+            filterFile = source
+
+        opened = []
+        for name, stream in (("source", source), ("filter", filterFile),
+                             ("word_map", wordMap)):
+            cmd[name], isOpened = open_stream(stream)
+            if isOpened:
+                opened.append(cmd[name])
+        # seeded from -R apart from random itself, so building doesn't
+        # reset the random state of the code using it
+        if cmd["random_seed"] != -1:
+            cmd["random"] = random.Random(cmd["random_seed"])
+        try:
+            self.wordMap = {}
+            if cmd["word_map"]:
+                with time_stage(cmd, "word map"):
+                    fill_word_map(cmd, self.wordMap)
+                if cmd["timings"]:
+                    cmd["timings"].add("word map", tokens=len(self.wordMap))
+            (self.filterList, self.dictionary, self.occurences,
+                self.wordCount) = build_dictionary(cmd)
+            self.frequencyIndex = None
+            self.dictionary = prepare_dictionary(cmd, self.dictionary)
+        finally:
+            for f in opened:
+                f.close()
+        self.built = True
+        return self
+
+    def call_settings(self, output, changes):
+        """
+        Return settings for one call, writing to output or a string
+        Changes only last for the call, and shouldn't change bucketing
+        """
+        if not self.built:
+            raise RuntimeError("build a dictionary before using it")
+        callCmd = dict(self.cmd)
+        if changes:
+            callCmd.update(changes)
+        callCmd["output"] = output if output is not None else StringIO()
+        return callCmd
+
+    def rearrange(self, stream, output=None, fresh=True, changes=None):
+        """
+        Rearrange an open file, or a string of text
+        Writes to output if given, and returns the new text otherwise
+        Unless fresh is off, modes that use up words start from full
+        buckets on every call, so the dictionary is never changed, and
+        shuffled buckets are shuffled again for every call
+        """
+        callCmd = self.call_settings(output, changes)
+        if self.cmd["inspection_mode"]:
+            raise RuntimeError("dictionaries built with -I can only be "
+                               "inspected")
+        # a seeded call draws from its own generator, so calls made at
+        # the same time from other threads can't change its output
+        if changes and changes.get("random_seed", -1) != -1:
+            callCmd["random"] = random.Random(changes["random_seed"])
+        if isinstance(stream, basestring):
+            stream = StringIO(stream)
+        callCmd["input"] = stream
+        dictionary = self.dictionary
+        wordMap = self.wordMap
+        if fresh:
+            wordMap = dict(wordMap)
+            if (callCmd["limited_usage"] or callCmd["force_limited_usage"] or
+                    callCmd["alphabetical_sort"] or callCmd["map_words"]):
+                dictionary = buckets.CopyOnWriteDictionary(
+                    dictionary, compile_reshuffle_bucket(callCmd))
+
+        with time_stage(callCmd, "generate"):
+            if callCmd["workers"] > 1:
+                generate_text_parallel(callCmd, dictionary, self.filterList,
+                                       wordMap)
+            else:
+                generate_text(callCmd, dictionary, self.filterList, wordMap)
+        if output is None:
+            return callCmd["output"].getvalue()
+
+    def inspect(self, output=None, changes=None):
+        """
+        Write out how the dictionary arranges its words
+        Writes to output if given, and returns the report otherwise
+        """
+        callCmd = self.call_settings(output, changes)
+        with time_stage(callCmd, "analysis"):
+            if self.frequencyIndex is None:
+                self.frequencyIndex = load_frequency_index(
+                    callCmd, self.occurences, self.wordCount)
+            generate_analysis(callCmd, self.frequencyIndex)
+        if callCmd["timings"]:
+            callCmd["timings"].add("analysis", tokens=len(self.occurences))
+        if output is None:
+            return callCmd["output"].getvalue()
+
+
+def get_spool_limit(cmd):
+    """
+    Return the bytes of input kept in memory when it is also the source,
+    which is never more than --memory-budget
+    """
+    if cmd["memory_budget"]:
+        return min(SPOOL_MEMORY_LIMIT, cmd["memory_budget"] * 1024 * 1024)
+    return SPOOL_MEMORY_LIMIT
+
+
+def run(cmd):
+    """Build the dictionary, then rearrange or inspect with it"""
+    if cmd["serve"]:
+        # only imported when needed, as it relies on POSIX-only modules
+        import serve
+        serve.serve(cmd, Rearranger)
+        return
+    # read input only once when it is also the source
+    if cmd["source"] is cmd["input"]:
+        cmd["source"] = cmd["input"] = TokenSpool(cmd["input"], cmd["mmap"],
+                                                  get_spool_limit(cmd))
+    if cmd["clear_cache"]:
+        cache.clear(cmd)
+
+    rearranger = Rearranger(cmd).build()
     if cmd["inspection_mode"]:
-        generate_analysis(cmd, dictionary, occurences, wordCount)
+        rearranger.inspect(cmd["output"])
+    elif cmd["batch"] or cmd["batch_glob"]:
+        generate_batch(rearranger)
+    else:
+        rearranger.rearrange(cmd["input"], cmd["output"], fresh=False)
+    if cmd["timings"]:
+        cmd["timings"].notes.append(rearranger.cmd["token_cache"].describe())
+        if rearranger.cmd.get("spill_store"):
+            cmd["timings"].notes.append(
+                rearranger.cmd["spill_store"].describe())
+
+    with time_stage(cmd, "output"):
+        for f in ("input", "source", "filter", "word_map", "output"):
+            if type(cmd[f]) in (file, TokenSpool):
+                cmd[f].close()
+
+
+def main():
+    """Run the program"""
+
+    start = time.time()
+    cmd = options.get_command()
+    if cmd["timings"]:
+        cmd["timings"] = Timings()
+        cmd["timings"].add("options", time.time() - start)
+
+    if cmd["profile"]:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(run, cmd)
+        finally:
+            profiler.dump_stats(cmd["profile"])
     else:
-        generate_text(cmd, dictionary, filterList, wordMap)
+        run(cmd)
 
-    for f in ("input", "source", "filter", "word_map", "output"):
-        if type(cmd[f]) == file:
-            cmd[f].close()
+    if cmd["timings"]:
+        cmd["timings"].report(sys.stderr)
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file